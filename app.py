@@ -1,9 +1,9 @@
 import os
+import re
 import json
+import time
 import logging
 from logging.handlers import RotatingFileHandler
-import pdfplumber 
-import pptx 
 from flask import (
     Flask,
     request,
@@ -18,11 +18,25 @@ from filter import sanitizer
 import prompt_manager
 import siliconflow_client
 from llm_json_parser import stream_json_with_events
-from question_types import Question 
+from question_types import Question, validate_question_data
 import grading 
 import markdown_exporter 
 import user_profile_manager
-import threading
+import document_extractor
+from config_store import config_store, DEFAULT_PROFILE
+from extraction_pipeline import ExtractionPipeline
+from profile_update_queue import ProfileUpdateQueue
+import retrieval
+import exam_sharding
+from rate_limiter import rate_limiters
+from llm_cassette import llm_cassette
+import metrics
+from metrics import Trace, timed_parse, add_trace_id
+from cancellation import CancelScope, RequestCancelled, CLIENT_DISCONNECTED, DEFAULT_REQUEST_DEADLINE
+from question_bank import question_bank, source_key as question_bank_source_key
+from wrong_answer_notebook import wrong_answer_notebook
+from near_duplicates import NearDuplicateDetector, HistoryIndexCache, DEFAULT_THRESHOLD as NEAR_DUPLICATE_THRESHOLD
+import atexit
 
 def setup_logging():
     log_dir = 'log'
@@ -44,12 +58,12 @@ def setup_logging():
     logger.addHandler(stream_handler)
 
 setup_logging()
+prompt_manager.preload_prompts()
 
 app = Flask(__name__)
 socketio = SocketIO(app, cors_allowed_origins="*")
 
 UPLOAD_FOLDER = "uploads"
-CONFIG_FILE = "config.json"
 app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024
 app.config["UPLOAD_EXTENSIONS"] = [".txt", ".pdf", ".pptx", ".ppt"]  
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -61,47 +75,228 @@ def get_uploaded_files():
     except Exception:
         return []
 
+_emit_event = socketio.emit
+
+def set_event_emitter(emit_event):
+    """
+    替换广播事件所用的函数 (事件名, 数据)。ASGI 服务模式下 Socket.IO 连接由异步服务器管理，
+    广播需要转交给它。
+    """
+    global _emit_event
+    _emit_event = emit_event
+
 def broadcast_file_list():
     """向所有连接的客户端广播当前的文件列表"""
     with app.app_context():
         files = get_uploaded_files()
-        socketio.emit('file_list_update', {'files': files})
+        _emit_event('file_list_update', {'files': files})
+
+def broadcast_extraction_progress(progress):
+    """向所有连接的客户端广播后台文档提取进度"""
+    _emit_event('extraction_progress', progress)
+
+extraction_pipeline = ExtractionPipeline(
+    on_progress=broadcast_extraction_progress,
+    on_complete=retrieval.build_index,
+)
+atexit.register(extraction_pipeline.shutdown, wait=False)
 
 def load_config():
-    default_profile = "该用户暂无画像，请根据本次答题情况生成一份初始画像。"
-    if not os.path.exists(CONFIG_FILE):
-        app.logger.info(f"配置文件不存在，创建默认配置文件: {CONFIG_FILE}")
-        default_config = {
-            "temperature": 1.0,
-            "enhanced_structured_output": False,
-            "user_profile": default_profile,
-            "user_profile_enabled": True
-        }
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(default_config, f, indent=4, ensure_ascii=False)
-        return default_config
+    """返回共享配置服务中当前配置快照的副本。"""
+    return config_store.get()
+
+def format_question_types(question_settings):
+    """把题型设置格式化为提示词中的题型要求，例如 "选择题10道(每题5分)、简答题2道(每题10分)"。"""
+    return "、".join(
+        [
+            f"{k}{v['count']}道(每题{v['score']}分)"
+            for k, v in question_settings.items()
+            if int(v['count']) > 0
+        ]
+    )
+
+def take_banked_questions(question_settings, source, config):
+    """
+    按配置的复用比例从题库中取出部分题目。
+
+    :return: (题库中的题目列表, 仍需由LLM生成的题型设置)
+    """
+    reuse_ratio = config.get("question_bank_reuse_ratio", 0.0)
+    remaining_settings = {name: dict(setting) for name, setting in question_settings.items()}
+    if not config.get("question_bank_enabled", True) or reuse_ratio <= 0:
+        return [], remaining_settings
+
+    banked = []
+    for name, setting in remaining_settings.items():
+        count = int(setting["count"])
+        questions = question_bank.take_questions(
+            source, exam_sharding.QUESTION_TYPE_KEYS[name], int(count * min(reuse_ratio, 1.0))
+        )
+        for question in questions:
+            question["score"] = int(setting["score"])
+        banked.extend(questions)
+        setting["count"] = str(count - len(questions))
+    return banked, remaining_settings
+
+near_duplicate_history = HistoryIndexCache(question_bank.questions_since)
+
+def make_near_duplicate_detector(source, config):
+    """按配置创建近似重复检测器，near_duplicate_mode 为 off 时返回 None。"""
+    if config.get("near_duplicate_mode", "flag") not in ("flag", "drop", "replace"):
+        return None
+    history_index = near_duplicate_history.get(source) if config.get("question_bank_enabled", True) else None
+    return NearDuplicateDetector(history_index, config.get("near_duplicate_threshold", NEAR_DUPLICATE_THRESHOLD))
+
+def screen_near_duplicate(event, detector, mode, dropped_counts):
+    """
+    对一个题目事件做近似重复检测。flag 模式在 end 事件上附加 near_duplicate 字段；
+    drop/replace 模式把重复题目的 end 事件替换为 discard 事件，并在 dropped_counts 中按题型计数。
+    """
+    if event["type"] == "end" and detector is not None:
+        match = detector.check(event["data"])
+        if match is not None:
+            app.logger.info(f"检测到近似重复题目. 模式: {mode}, 相似度: {match['similarity']}, 来源: {match['source']}")
+            if mode == "flag":
+                event["near_duplicate"] = match
+            else:
+                q_type = event["data"].get("question_type")
+                dropped_counts[q_type] = dropped_counts.get(q_type, 0) + 1
+                event = {"type": "discard", "reason": "near_duplicate", "near_duplicate": match}
+    return event
+
+def screen_near_duplicates(events, detector, mode, dropped_counts):
+    """对题目事件流逐个做近似重复检测，见 screen_near_duplicate。"""
+    for event in events:
+        yield screen_near_duplicate(event, detector, mode, dropped_counts)
+
+def current_source_key():
+    """当前已上传参考资料的题库来源键。"""
+    return question_bank_source_key([
+        document_extractor.file_content_hash(os.path.join(UPLOAD_FOLDER, filename))
+        for filename in get_uploaded_files()
+    ])
+
+TRACE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+def start_trace(operation, config):
+    """
+    为当前请求创建跟踪。客户端通过 X-Trace-Id 请求头提供跟踪 ID 时沿用该 ID，
+    并在返回的每个 NDJSON 事件中附带 trace_id；配置 trace_ids_in_events 为真时对所有请求附带。
+
+    :return: (trace, 是否在事件中附带 trace_id)
+    """
+    trace_id = request.headers.get("X-Trace-Id", "")
+    if trace_id and not TRACE_ID_PATTERN.match(trace_id):
+        trace_id = ""
+    return Trace(operation, trace_id or None), bool(trace_id) or config.get("trace_ids_in_events", False)
+
+def start_cancel_scope(operation, config):
+    """为当前请求创建取消范围，截止时间由配置 request_deadline_seconds 决定（0 表示不限制）。"""
+    return CancelScope(operation, timeout=float(config.get("request_deadline_seconds", DEFAULT_REQUEST_DEADLINE)))
+
+def cancelled_event(error):
+    """请求被取消（超出截止时间）时推送给客户端的 error 事件。"""
+    return json.dumps({"type": "error", "error": str(error), "error_type": error.reason}) + "\n"
+
+class RequestError(Exception):
+    """请求参数有误或无法处理，由接口以 JSON 错误信息与对应的状态码返回。"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+def prepare_or_error(prepare, error_prefix):
+    """
+    在当前请求上下文中调用 prepare_* 函数。
+
+    :return: (job, None)，或请求无法处理时返回 (None, (错误信息, 状态码))。
+    """
     try:
-        app.logger.info(f"加载配置文件: {CONFIG_FILE}")
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-            if "user_profile" not in config:
-                config["user_profile"] = default_profile
-            if "user_profile_enabled" not in config:
-                config["user_profile_enabled"] = True
-            return config
-    except (json.JSONDecodeError, FileNotFoundError):
-        app.logger.error(f"加载配置文件失败: {CONFIG_FILE}")
-        return {
-            "temperature": 1.0,
-            "enhanced_structured_output": False,
-            "user_profile": default_profile,
-            "user_profile_enabled": True
-        }
-
-def save_config(config_data):
-    app.logger.info(f"保存配置文件: {CONFIG_FILE}")
-    with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(config_data, f, indent=4, ensure_ascii=False)
+        return prepare(), None
+    except RequestError as e:
+        return None, (e.message, e.status)
+    except Exception as e:
+        error_msg = f"{error_prefix}: {str(e)}"
+        app.logger.error(error_msg)
+        return None, (error_msg, 500)
+
+class StreamRecorder:
+    """
+    记录一个 NDJSON 事件流的推送：首个事件延迟、推送阶段的耗时与推送的字节数，流结束时完成跟踪。
+    需要时在每行事件中附带 trace_id。同步（WSGI）与异步（ASGI）两种服务模式共用。
+    """
+
+    def __init__(self, trace, echo_trace_id, cancel_scope=None):
+        self.trace = trace
+        self.echo_trace_id = echo_trace_id
+        self.cancel_scope = cancel_scope
+        self.streamed_bytes = 0
+        self.events = 0
+        self.stream_started = None
+
+    def line(self, line):
+        """登记一行即将推送的事件，返回实际推送的内容。"""
+        if self.echo_trace_id:
+            line = add_trace_id(line, self.trace.trace_id)
+        if self.stream_started is None:
+            self.stream_started = time.perf_counter()
+            self.trace.record("first_event", self.stream_started - self.trace.started)
+        self.streamed_bytes += len(line.encode("utf-8"))
+        self.events += 1
+        return line
+
+    def client_disconnected(self):
+        """客户端已断开：取消请求，进行中的上游流被关闭，尚未完成的生成与批改不再调用模型。"""
+        if self.cancel_scope is not None:
+            app.logger.info(f"客户端已断开，取消请求. Trace: {self.trace.trace_id}, 已推送事件: {self.events}")
+            self.cancel_scope.cancel(CLIENT_DISCONNECTED)
+
+    def finish(self):
+        if self.stream_started is not None:
+            self.trace.record("stream", time.perf_counter() - self.stream_started)
+        metrics.STREAMED_BYTES.inc(self.streamed_bytes, operation=self.trace.operation)
+        cancelled = self.cancel_scope.reason if self.cancel_scope is not None else None
+        self.trace.finish(events=self.events, streamed_bytes=self.streamed_bytes,
+                          **({"cancelled": cancelled} if cancelled else {}))
+
+def traced_ndjson_response(event_lines, trace, echo_trace_id, cancel_scope=None):
+    """
+    包装 NDJSON 事件流，由 StreamRecorder 记录推送过程。
+    响应头始终带有 X-Trace-Id，便于与日志中的跟踪记录对应。
+
+    客户端断开时服务器在写入失败后关闭响应流，此时取消 cancel_scope。
+    """
+    def stream():
+        recorder = StreamRecorder(trace, echo_trace_id, cancel_scope)
+        try:
+            for line in event_lines:
+                yield recorder.line(line)
+        except GeneratorExit:
+            recorder.client_disconnected()
+            raise
+        finally:
+            # 显式关闭事件生成器，使其中的 finally 与上游流的关闭立即执行
+            close = getattr(event_lines, "close", None)
+            if close:
+                close()
+            recorder.finish()
+
+    response = Response(stream(), mimetype="application/x-ndjson")
+    response.headers["X-Trace-Id"] = trace.trace_id
+    return response
+
+def build_document_context(documents, query, config, related_only=False):
+    """根据配置决定是检索相关片段还是直接拼接全部文档内容。"""
+    if not config.get("retrieval_enabled", True):
+        return document_extractor.format_documents(documents)
+    return retrieval.build_context(
+        documents,
+        query,
+        top_k=int(config.get("retrieval_top_k", 12)),
+        token_budget=int(config.get("retrieval_token_budget", 12000)),
+        related_only=related_only,
+    )
 
 @app.route("/")
 def index():
@@ -111,20 +306,20 @@ def index():
 @app.route("/api/settings", methods=["GET", "POST"])
 def manage_settings():
     if request.method == "GET":
-        app.logger.info(f"获取配置文件: {CONFIG_FILE}")
         return jsonify(load_config())
     
     if request.method == "POST":
-        app.logger.info(f"更新配置文件: {CONFIG_FILE}")
         data = request.json
         config = load_config()
-        config["temperature"] = float(data.get("temperature", config["temperature"]))
-        config["enhanced_structured_output"] = bool(data.get("enhanced_structured_output", config["enhanced_structured_output"]))
-        config["user_profile_enabled"] = bool(data.get("user_profile_enabled", config.get("user_profile_enabled", True)))
+        changes = {
+            "temperature": float(data.get("temperature", config["temperature"])),
+            "enhanced_structured_output": bool(data.get("enhanced_structured_output", config["enhanced_structured_output"])),
+            "user_profile_enabled": bool(data.get("user_profile_enabled", config.get("user_profile_enabled", True))),
+        }
         if "user_profile" in data:
-            config["user_profile"] = str(data.get("user_profile", ""))
+            changes["user_profile"] = str(data.get("user_profile", ""))
         
-        save_config(config)
+        config = config_store.update(changes)
         return jsonify({"message": "设置已保存", "config": config})
 
 @app.route("/api/upload", methods=["POST"])
@@ -148,11 +343,18 @@ def upload_file():
             errors[file.filename] = f"不支持的文件类型"
             continue
         
+        file_path = os.path.join(UPLOAD_FOLDER, filename)
         try:
-            file.save(os.path.join(UPLOAD_FOLDER, filename))
+            file.save(file_path)
             success_files.append(filename)
         except Exception as e:
             errors[file.filename] = f"保存文件失败: {str(e)}"
+            continue
+
+        try:
+            extraction_pipeline.submit(file_path)
+        except Exception as e:
+            app.logger.warning(f"提交文件 '{filename}' 的预提取任务失败，将在生成时重试: {e}")
 
     if not errors:
         broadcast_file_list()
@@ -182,219 +384,344 @@ def delete_file_route(filename):
         return jsonify({"error": "文件未找到"}), 404
         
     try:
+        remaining_paths = [os.path.join(UPLOAD_FOLDER, f) for f in get_uploaded_files() if f != filename]
+        extraction_pipeline.cancel(file_path)
+        retrieval.evict_index(document_extractor.file_content_hash(file_path), remaining_paths)
+        document_extractor.evict_document(file_path, remaining_paths)
         os.remove(file_path)
         broadcast_file_list()
         return jsonify({"message": f"文件 '{filename}' 已删除"}), 200
     except Exception as e:
         return jsonify({"error": f"删除文件失败: {str(e)}"}), 500
 
-@app.route("/api/process", methods=["POST"])
-def generate_exam():
-    app.logger.info(f"开始生成试卷.")
+class ExamGenerationJob:
+    """一次试卷生成请求：解析好的参数、检索到的参考资料上下文与题库中复用的题目。"""
+
+    def __init__(self, trace, echo_trace_id, cancel_scope, config):
+        self.trace = trace
+        self.echo_trace_id = echo_trace_id
+        self.cancel_scope = cancel_scope
+        self.config = config
+        self.api_key = None
+        self.user_text = None
+        self.user_profile = None
+        self.temperature = None
+        self.document_content = None
+        self.bank_source = None
+        self.banked_questions = []
+        self.question_settings = None
+        self.question_types_str = None
+        self.scores_data = None
+        self.formatting_instructions = None
+        self.enhanced_mode = False
+        self.sharding_mode = "off"
+        self.shards = []
+
+    def llm_kwargs(self, types_str, shard_hint=None, avoid_stems=None):
+        """为给定的题型与数量构造提示词，返回调用 invoke_llm / ainvoke_llm 的参数。"""
+        with self.trace.span("render_prompt"):
+            main_prompt = prompt_manager.get_prompt("exam_generation_prompt", document_content=self.document_content,
+            user_requirement=self.user_text,
+            question_types=types_str,
+            formatting_instructions=self.formatting_instructions,
+            scores=self.scores_data,
+            user_profile=self.user_profile,
+            shard_hint=shard_hint,
+            avoid_stems=avoid_stems)
+
+        return dict(
+            api_key=self.api_key,
+            model="Qwen/Qwen2.5-72B-Instruct",
+            messages=[{"role": "user", "content": main_prompt}],
+            stream=True,
+            temperature=self.temperature,
+            enhanced_structured_output=self.enhanced_mode,
+            formatting_prompt=self.formatting_instructions if self.enhanced_mode else None,
+            output_validator=validate_question_data,
+            user_inputs=[self.user_text, self.user_profile],
+            optimistic_security_check=self.config.get("optimistic_security_check", True),
+            trace=self.trace,
+            cancel_scope=self.cancel_scope,
+        )
+
+    def run_shard(self, shard, position, avoid_stems):
+        """exam_sharding.generate_sharded_stream 的 run_shard 回调。"""
+        shard_hint = None
+        if position and position[1] > 1:
+            shard_hint = f"本次试卷分{position[1]}批并行生成，这是第{position[0]}批，请尽量选取与其它批次不同的知识点。"
+        llm_stream = siliconflow_client.invoke_llm(**self.llm_kwargs(format_question_types(shard), shard_hint, avoid_stems))
+        return timed_parse(stream_json_with_events, llm_stream, self.trace)
+
+    def sharded_stream(self, shards, max_top_up_rounds, existing_questions):
+        return exam_sharding.generate_sharded_stream(
+            shards, self.run_shard,
+            max_concurrency=self.config.get("generation_concurrency", 4),
+            max_top_up_rounds=max_top_up_rounds,
+            existing_questions=existing_questions,
+        )
+
+    def replacement_shards(self, dropped_counts):
+        """replace 模式下为被丢弃的重复题目补题的分片。"""
+        type_names = {q_type: name for name, q_type in exam_sharding.QUESTION_TYPE_KEYS.items()}
+        return [
+            {type_names[q_type]: {"count": str(count), "score": self.question_settings[type_names[q_type]]["score"]}}
+            for q_type, count in dropped_counts.items() if q_type in type_names
+        ]
+
+def prepare_exam_generation():
+    """解析 /api/process 请求并准备参考资料上下文与题库题目。参数有误时抛出 RequestError。"""
     uploaded_filenames = [f for f in os.listdir(UPLOAD_FOLDER) if os.path.isfile(os.path.join(UPLOAD_FOLDER, f)) and not f.startswith('.')]
 
     if not uploaded_filenames:
-        return jsonify({"error": "请先上传至少一个参考资料文件"}), 400
-
-    try:
-        user_text = request.form.get("user_input", "无特定要求")
-        user_text = sanitizer.sanitize(user_text)
-        api_key = request.form.get("api_key")
-        
-        config = load_config()
-        temperature = config.get("temperature", 1.0)
-        
-        if config.get("user_profile_enabled", True):
-            user_profile = config.get("user_profile", "该用户暂无画像，请根据本次答题情况生成一份初始画像。")
-        else:
-            user_profile = "用户画像功能未开启。"
+        raise RequestError("请先上传至少一个参考资料文件")
 
-        if not api_key:
-            return jsonify({"error": "API Key缺失"}), 400
+    user_text = request.form.get("user_input", "无特定要求")
+    user_text = sanitizer.sanitize(user_text)
+    api_key = request.form.get("api_key")
 
-        short_answer_count = int(request.form.get("short_count", "0")) + int(
-            request.form.get("calc_count", "0")
-        )
+    config = load_config()
 
-        question_settings = {
-            "选择题": {
-                "count": request.form.get("choice_count", "0"),
-                "score": request.form.get("choice_score", "5"),
-            },
-            "填空题": {
-                "count": request.form.get("blank_count", "0"),
-                "score": request.form.get("blank_score", "5"),
-            },
-            "简答题": {
-                "count": str(short_answer_count),
-                "score": request.form.get("short_score", "10"),
-            },
-        }
+    if config.get("user_profile_enabled", True):
+        user_profile = config.get("user_profile", DEFAULT_PROFILE)
+    else:
+        user_profile = "用户画像功能未开启。"
+
+    if not api_key:
+        raise RequestError("API Key缺失")
+
+    short_answer_count = int(request.form.get("short_count", "0")) + int(
+        request.form.get("calc_count", "0")
+    )
+
+    question_settings = {
+        "选择题": {
+            "count": request.form.get("choice_count", "0"),
+            "score": request.form.get("choice_score", "5"),
+        },
+        "填空题": {
+            "count": request.form.get("blank_count", "0"),
+            "score": request.form.get("blank_score", "5"),
+        },
+        "简答题": {
+            "count": str(short_answer_count),
+            "score": request.form.get("short_score", "10"),
+        },
+    }
+
+    question_types_str = format_question_types(question_settings)
+    if not question_types_str:
+        raise RequestError("至少需要设置一种题型")
+
+    app.logger.info(f"开始生成试卷. 文件: {uploaded_filenames}, 要求: {question_types_str}")
+    trace, echo_trace_id = start_trace("generate_exam", config)
+    job = ExamGenerationJob(trace, echo_trace_id, start_cancel_scope("generate_exam", config), config)
+    job.api_key = api_key
+    job.user_text = user_text
+    job.user_profile = user_profile
+    job.temperature = config.get("temperature", 1.0)
 
-        question_types_str = "、".join(
-            [
-                f"{k}{v['count']}道(每题{v['score']}分)"
-                for k, v in question_settings.items()
-                if int(v['count']) > 0
-            ]
+    try:
+        with trace.span("load_documents", files=len(uploaded_filenames)):
+            documents = document_extractor.load_documents(
+                UPLOAD_FOLDER, uploaded_filenames, get_text=extraction_pipeline.get_text
+            )
+    except document_extractor.DocumentReadError as e:
+        raise RequestError(str(e), 500)
+    with trace.span("build_context"):
+        job.document_content = build_document_context(documents, f"{user_text} {question_types_str}", config)
+    app.logger.info(f"所有文件内容已聚合，总长度: {len(job.document_content)}")
+
+    job.bank_source = question_bank_source_key([content_hash for _, content_hash, _ in documents])
+    with trace.span("question_bank"):
+        job.banked_questions, job.question_settings = take_banked_questions(question_settings, job.bank_source, config)
+    job.question_types_str = format_question_types(job.question_settings)
+    if job.banked_questions:
+        app.logger.info(f"从题库中复用 {len(job.banked_questions)} 道题目, 仍需生成: {job.question_types_str or '无'}")
+
+    job.scores_data = {
+        "multiple_choice": job.question_settings["选择题"]["score"],
+        "fill_in_the_blank": job.question_settings["填空题"]["score"],
+        "short_answer": job.question_settings["简答题"]["score"],
+    }
+
+    job.formatting_instructions = prompt_manager.get_prompt("exam_generation_prompt_formatting")
+    job.enhanced_mode = config.get("enhanced_structured_output", False)
+
+    job.sharding_mode = config.get("generation_sharding", "off")
+    job.shards = exam_sharding.plan_shards(
+        job.question_settings, job.sharding_mode, config.get("generation_shard_size", exam_sharding.DEFAULT_SHARD_SIZE)
+    ) if job.sharding_mode in ("by_type", "by_count") else []
+    return job
+
+def validate_generated_event(event, enhanced_mode):
+    """非增强模式下把生成题目的 end 事件规整为 Question 的格式，无效题目返回 None。"""
+    if enhanced_mode or event["type"] != "end":
+        return event
+    try:
+        question_obj = Question.from_dict(event["data"])
+        event["data"] = question_obj.to_dict()
+    except (ValueError, KeyError) as e:
+        app.logger.warning(f"Skipping invalid question object: {e}, data: {event['data']}")
+        return None
+    return event
+
+def generate_question_events(job):
+    """生成仍需由LLM生成的题目，产出 stream_json_with_events 格式的事件。"""
+    banked_stems = [question["stem"] for question in job.banked_questions]
+    if len(job.shards) > 1:
+        app.logger.info(f"使用分片并行生成. 模式: {job.sharding_mode}, 分片数: {len(job.shards)}")
+        yield from job.sharded_stream(
+            job.shards,
+            job.config.get("generation_top_up_rounds", exam_sharding.DEFAULT_TOP_UP_ROUNDS),
+            job.banked_questions,
         )
-        if not question_types_str:
-            return jsonify({"error": "至少需要设置一种题型"}), 400
-
-        app.logger.info(f"开始生成试卷. 文件: {uploaded_filenames}, 要求: {question_types_str}")
-
-        document_contents = []
-        for filename in uploaded_filenames:
-            file_path = os.path.join(UPLOAD_FOLDER, filename)
-            file_ext = os.path.splitext(filename)[1].lower()
-            content = ""
-            try:
-                if file_ext == ".pdf":
-                    with pdfplumber.open(file_path) as pdf:
-                        all_text = [page.extract_text() for page in pdf.pages if page.extract_text()]
-                        content = "\n".join(all_text)
-                elif file_ext in [".pptx", ".ppt"]:
-                    pres = pptx.Presentation(file_path)
-                    all_text = []
-                    for slide in pres.slides:
-                        for shape in slide.shapes:
-                            if hasattr(shape, "text"):
-                                all_text.append(shape.text)
-                    content = "\n".join(all_text)
-                else:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-            except Exception as e:
-                 return jsonify({"error": f"读取文件 '{filename}' 时出错: {str(e)}"}), 500
-
-            document_contents.append(f"--- 来自文件: {filename} ---\n{content}")
-        document_content = "\n\n".join(document_contents)
-        app.logger.info(f"所有文件内容已聚合，总长度: {len(document_content)}")
-
-        scores_data = {
-            "multiple_choice": question_settings["选择题"]["score"],
-            "fill_in_the_blank": question_settings["填空题"]["score"],
-            "short_answer": question_settings["简答题"]["score"],
-        }
+        return
+
+    llm_stream = siliconflow_client.invoke_llm(**job.llm_kwargs(job.question_types_str, avoid_stems=banked_stems))
+    for event in timed_parse(stream_json_with_events, llm_stream, job.trace):
+        event = validate_generated_event(event, job.enhanced_mode)
+        if event is not None:
+            yield event
+
+def banked_question_lines(job):
+    for question in job.banked_questions:
+        yield json.dumps({"type": "start"}) + "\n"
+        yield json.dumps({"type": "end", "data": question}) + "\n"
+
+def make_generation_detector(job):
+    detector = make_near_duplicate_detector(job.bank_source, job.config)
+    if detector is not None:
+        for question in job.banked_questions:
+            detector.add(question)
+    return detector
+
+def generation_error_event(error):
+    """试卷生成过程中的异常对应的 error 事件。"""
+    if isinstance(error, AuthenticationError):
+        return json.dumps({"type": "error", "error": "API Key 无效或已过期，请检查您的输入。", "error_type": "authentication"}) + "\n"
+    if isinstance(error, RequestCancelled):
+        return cancelled_event(error)
+    if isinstance(error, ValueError):
+        if "输入内容被判定为不安全" in str(error):
+            return json.dumps({"type": "error", "error": str(error), "error_type": "security"}) + "\n"
+        return json.dumps({"type": "error", "error": f"生成过程中发生验证错误: {str(error)}", "error_type": "generation"}) + "\n"
+    return json.dumps({"type": "error", "error": f"生成过程中发生错误: {str(error)}", "error_type": "generation"}) + "\n"
+
+def save_generated_questions(job, generated_questions):
+    if generated_questions and job.config.get("question_bank_enabled", True):
+        try:
+            with job.trace.span("save_to_bank", questions=len(generated_questions)):
+                question_bank.add_questions(job.bank_source, generated_questions)
+        except Exception as e:
+            app.logger.error(f"保存题目到题库失败: {e}")
 
-        formatting_instructions = prompt_manager.get_prompt("exam_generation_prompt_formatting")
+def generate_question_stream(job):
+    generated_questions = []
+    try:
+        yield from banked_question_lines(job)
+        if not job.question_types_str:
+            return
+
+        duplicate_mode = job.config.get("near_duplicate_mode", "flag")
+        detector = make_generation_detector(job)
+        dropped_counts = {}
+
+        for event in screen_near_duplicates(generate_question_events(job), detector, duplicate_mode, dropped_counts):
+            if event["type"] == "end":
+                generated_questions.append(event["data"])
+            yield json.dumps(event) + "\n"
+
+        # replace 模式下为被丢弃的重复题目补题，补题结果同样经过重复检测
+        for _ in range(job.config.get("generation_top_up_rounds", exam_sharding.DEFAULT_TOP_UP_ROUNDS)):
+            if duplicate_mode != "replace" or not dropped_counts:
+                break
+            replacement_shards = job.replacement_shards(dropped_counts)
+            app.logger.info(f"为近似重复的题目生成替换题: {replacement_shards}")
+            dropped_counts = {}
+            replacement_events = job.sharded_stream(replacement_shards, 0, job.banked_questions + generated_questions)
+            for event in screen_near_duplicates(replacement_events, detector, duplicate_mode, dropped_counts):
+                if event["type"] == "end":
+                    generated_questions.append(event["data"])
+                yield json.dumps(event) + "\n"
 
-        main_prompt = prompt_manager.get_prompt("exam_generation_prompt", document_content=document_content,
-        user_requirement=user_text,
-        question_types=question_types_str,
-        formatting_instructions=formatting_instructions,
-        scores=scores_data,
-        user_profile=user_profile)
-        
-        messages = [{"role": "user", "content": main_prompt}]
-
-        def generate_question_stream():
-            try:
-                config = load_config()
-                enhanced_mode = config.get("enhanced_structured_output", False)
-
-                llm_stream = siliconflow_client.invoke_llm(
-                    api_key=api_key,
-                    model="Qwen/Qwen2.5-72B-Instruct",
-                    messages=messages,
-                    stream=True,
-                    temperature=temperature,
-                    enhanced_structured_output=enhanced_mode,
-                    formatting_prompt=formatting_instructions if enhanced_mode else None
-                )
-                
-                if enhanced_mode:
-                    event_stream = stream_json_with_events(llm_stream)
-                    for event in event_stream:
-                        yield json.dumps(event) + "\n"
-                    return
-
-                event_stream = stream_json_with_events(llm_stream)
-
-                for event in event_stream:
-                    if event["type"] == "end":
-                        try:
-                            question_obj = Question.from_dict(event["data"])
-                            event["data"] = question_obj.to_dict()
-                        except (ValueError, KeyError) as e:
-                            app.logger.warning(f"Skipping invalid question object: {e}, data: {event['data']}")
-                            continue
-                    
-                    yield json.dumps(event) + "\n"
-
-            except AuthenticationError:
-                yield json.dumps({"type": "error", "error": "API Key 无效或已过期，请检查您的输入。", "error_type": "authentication"}) + "\n"
-            except ValueError as e:
-                if "输入内容被判定为不安全" in str(e):
-                    yield json.dumps({"type": "error", "error": str(e), "error_type": "security"}) + "\n"
-                else:
-                    yield json.dumps({"type": "error", "error": f"生成过程中发生验证错误: {str(e)}", "error_type": "generation"}) + "\n"
-            except Exception as e:
-                yield json.dumps({"type": "error", "error": f"生成过程中发生错误: {str(e)}", "error_type": "generation"}) + "\n"
+    except Exception as e:
+        yield generation_error_event(e)
+    finally:
+        save_generated_questions(job, generated_questions)
 
-        app.logger.info("返回试卷生成流.")
-        return Response(generate_question_stream(), mimetype="application/x-ndjson")
+@app.route("/api/process", methods=["POST"])
+def generate_exam():
+    app.logger.info(f"开始生成试卷.")
+    job, error = prepare_or_error(prepare_exam_generation, "处理时出错")
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+    app.logger.info("返回试卷生成流.")
+    return traced_ndjson_response(generate_question_stream(job), job.trace, job.echo_trace_id, job.cancel_scope)
+
+class RegenerationJob:
+    """一次题目再生成请求。"""
+
+    def __init__(self, trace, echo_trace_id, cancel_scope, config):
+        self.trace = trace
+        self.echo_trace_id = echo_trace_id
+        self.cancel_scope = cancel_scope
+        self.config = config
+        self.original_question = None
+        self.action = None
+        self.bank_source = None
+        self.llm_kwargs = None
+
+def prepare_regeneration():
+    """解析 /api/regenerate_question 请求并构造提示词。参数有误时抛出 RequestError。"""
+    data = request.get_json()
+    original_question = data.get("question")
+    action = data.get("action") 
+    user_requirement = data.get("user_requirement", "无特定要求")
+    api_key = data.get("api_key")
+    
+    app.logger.info(f"开始题目再生成. Action: {action}, Q_Type: {original_question.get('question_type')}")
 
-    except Exception as e:
-        error_msg = f"处理时出错: {str(e)}"
-        app.logger.error(error_msg)
-        return jsonify({"error": error_msg}), 500
+    if not all([original_question, action, api_key]):
+        raise RequestError("缺少原始题目、操作类型或API Key")
 
-@app.route("/api/regenerate_question", methods=["POST"])
-def regenerate_question():
-    try:
-        data = request.get_json()
-        original_question = data.get("question")
-        action = data.get("action") 
-        user_requirement = data.get("user_requirement", "无特定要求")
-        api_key = data.get("api_key")
-        
-        app.logger.info(f"开始题目再生成. Action: {action}, Q_Type: {original_question.get('question_type')}")
-
-        if not all([original_question, action, api_key]):
-            return jsonify({"error": "缺少原始题目、操作类型或API Key"}), 400
-
-        uploaded_filenames = get_uploaded_files()
-        if not uploaded_filenames:
-            return jsonify({"error": "找不到参考资料文件"}), 400
-
-        document_contents = []
-        for filename in uploaded_filenames:
-            file_path = os.path.join(UPLOAD_FOLDER, filename)
-            file_ext = os.path.splitext(filename)[1].lower()
-            content = ""
-            try:
-                if file_ext == ".pdf":
-                    with pdfplumber.open(file_path) as pdf:
-                        all_text = [page.extract_text() for page in pdf.pages if page.extract_text()]
-                        content = "\n".join(all_text)
-                elif file_ext in [".pptx", ".ppt"]:
-                    pres = pptx.Presentation(file_path)
-                    all_text = [shape.text for slide in pres.slides for shape in slide.shapes if hasattr(shape, "text")]
-                    content = "\n".join(all_text)
-                else:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-            except Exception as e:
-                 return jsonify({"error": f"读取文件 '{filename}' 时出错: {str(e)}"}), 500
-            document_contents.append(f"--- 来自文件: {filename} ---\n{content}")
-        
-        document_content = "\n\n".join(document_contents)
-        app.logger.info(f"题目再生成 - 文件内容已聚合，总长度: {len(document_content)}")
+    uploaded_filenames = get_uploaded_files()
+    if not uploaded_filenames:
+        raise RequestError("找不到参考资料文件")
 
-        prompt_map = {
-            "regenerate": "regenerate_question_prompt",
-            "increase_difficulty": "increase_difficulty_prompt",
-            "decrease_difficulty": "decrease_difficulty_prompt",
-        }
-        prompt_name = prompt_map.get(action)
-        if not prompt_name:
-            return jsonify({"error": "无效的操作类型"}), 400
+    prompt_map = {
+        "regenerate": "regenerate_question_prompt",
+        "increase_difficulty": "increase_difficulty_prompt",
+        "decrease_difficulty": "decrease_difficulty_prompt",
+    }
+    prompt_name = prompt_map.get(action)
+    if not prompt_name:
+        raise RequestError("无效的操作类型")
 
-        config = load_config()
-        temperature = config.get("temperature", 1.0)
-        formatting_instructions = prompt_manager.get_prompt("exam_generation_prompt_formatting")
+    config = load_config()
+    trace, echo_trace_id = start_trace("regenerate_question", config)
+    job = RegenerationJob(trace, echo_trace_id, start_cancel_scope("regenerate_question", config), config)
+    job.original_question = original_question
+    job.action = action
 
+    try:
+        with trace.span("load_documents", files=len(uploaded_filenames)):
+            documents = document_extractor.load_documents(
+                UPLOAD_FOLDER, uploaded_filenames, get_text=extraction_pipeline.get_text
+            )
+    except document_extractor.DocumentReadError as e:
+        raise RequestError(str(e), 500)
+    question_query = " ".join([
+        str(original_question.get("stem", "")),
+        json.dumps(original_question.get("options", ""), ensure_ascii=False),
+        json.dumps(original_question.get("answer", ""), ensure_ascii=False),
+    ])
+    with trace.span("build_context"):
+        document_content = build_document_context(documents, question_query, config, related_only=True)
+    app.logger.info(f"题目再生成 - 文件内容已聚合，总长度: {len(document_content)}")
+    job.bank_source = question_bank_source_key([content_hash for _, content_hash, _ in documents])
+    formatting_instructions = prompt_manager.get_prompt("exam_generation_prompt_formatting")
+
+    with trace.span("render_prompt"):
         main_prompt = prompt_manager.get_prompt(
             prompt_name,
             document_content=document_content,
@@ -404,47 +731,77 @@ def regenerate_question():
             formatting_instructions=formatting_instructions
         )
 
-        messages = [{"role": "user", "content": main_prompt}]
-
-        def generate_stream():
-            try:
-                enhanced_mode = config.get("enhanced_structured_output", False)
-                llm_stream = siliconflow_client.invoke_llm(
-                    api_key=api_key,
-                    model="Qwen/Qwen2.5-72B-Instruct",
-                    messages=messages,
-                    stream=True,
-                    temperature=temperature,
-                    enhanced_structured_output=enhanced_mode,
-                    formatting_prompt=formatting_instructions if enhanced_mode else None
-                )
-
-                event_stream = stream_json_with_events(llm_stream)
-                for event in event_stream:
-                    if event["type"] == "end":
-                        try:
-                            question_obj = Question.from_dict(event["data"])
-                            question_obj.score = original_question.get('score', 5)
-                            event["data"] = question_obj.to_dict()
-                        except (ValueError, KeyError) as e:
-                            app.logger.warning(f"Skipping invalid regenerated question object: {e}, data: {event['data']}")
-                            continue
-                    yield json.dumps(event) + "\n"
-
-            except AuthenticationError:
-                yield json.dumps({"type": "error", "error": "API Key 无效或已过期。", "error_type": "authentication"}) + "\n"
-            except ValueError as e:
-                 yield json.dumps({"type": "error", "error": str(e), "error_type": "security"}) + "\n"
-            except Exception as e:
-                yield json.dumps({"type": "error", "error": f"生成过程中发生错误: {str(e)}", "error_type": "generation"}) + "\n"
-
-        app.logger.info("返回题目再生成流.")
-        return Response(generate_stream(), mimetype="application/x-ndjson")
-
+    enhanced_mode = config.get("enhanced_structured_output", False)
+    job.llm_kwargs = dict(
+        api_key=api_key,
+        model="Qwen/Qwen2.5-72B-Instruct",
+        messages=[{"role": "user", "content": main_prompt}],
+        stream=True,
+        temperature=config.get("temperature", 1.0),
+        enhanced_structured_output=enhanced_mode,
+        formatting_prompt=formatting_instructions if enhanced_mode else None,
+        output_validator=validate_question_data,
+        user_inputs=[user_requirement, json.dumps(original_question, ensure_ascii=False)],
+        optimistic_security_check=config.get("optimistic_security_check", True),
+        trace=trace,
+        cancel_scope=job.cancel_scope,
+    )
+    return job
+
+def make_regeneration_detector(job):
+    # 只对"重新生成"做近似重复检测（只标记不丢弃）；调整难度本来就应当与原题相近
+    if job.action != "regenerate":
+        return None
+    detector = make_near_duplicate_detector(job.bank_source, job.config)
+    if detector is not None:
+        detector.add(job.original_question)
+    return detector
+
+def regenerated_event_line(job, event, detector):
+    """把再生成的题目事件转换为推送的一行，无效题目返回 None。"""
+    if event["type"] == "end":
+        try:
+            question_obj = Question.from_dict(event["data"])
+            question_obj.score = job.original_question.get('score', 5)
+            event["data"] = question_obj.to_dict()
+        except (ValueError, KeyError) as e:
+            app.logger.warning(f"Skipping invalid regenerated question object: {e}, data: {event['data']}")
+            return None
+        if detector is not None:
+            match = detector.check(event["data"])
+            if match is not None:
+                app.logger.info(f"再生成的题目与已有题目近似重复. 相似度: {match['similarity']}")
+                event["near_duplicate"] = match
+    return json.dumps(event) + "\n"
+
+def regeneration_error_event(error):
+    """题目再生成过程中的异常对应的 error 事件。"""
+    if isinstance(error, AuthenticationError):
+        return json.dumps({"type": "error", "error": "API Key 无效或已过期。", "error_type": "authentication"}) + "\n"
+    if isinstance(error, RequestCancelled):
+        return cancelled_event(error)
+    if isinstance(error, ValueError):
+        return json.dumps({"type": "error", "error": str(error), "error_type": "security"}) + "\n"
+    return json.dumps({"type": "error", "error": f"生成过程中发生错误: {str(error)}", "error_type": "generation"}) + "\n"
+
+def generate_regeneration_stream(job):
+    try:
+        llm_stream = siliconflow_client.invoke_llm(**job.llm_kwargs)
+        detector = make_regeneration_detector(job)
+        for event in timed_parse(stream_json_with_events, llm_stream, job.trace):
+            line = regenerated_event_line(job, event, detector)
+            if line:
+                yield line
     except Exception as e:
-        error_msg = f"处理时出错: {str(e)}"
-        app.logger.error(error_msg)
-        return jsonify({"error": error_msg}), 500
+        yield regeneration_error_event(e)
+
+@app.route("/api/regenerate_question", methods=["POST"])
+def regenerate_question():
+    job, error = prepare_or_error(prepare_regeneration, "处理时出错")
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+    app.logger.info("返回题目再生成流.")
+    return traced_ndjson_response(generate_regeneration_stream(job), job.trace, job.echo_trace_id, job.cancel_scope)
 
 @app.route("/api/export/markdown", methods=["POST"])
 def export_markdown():
@@ -465,12 +822,29 @@ def export_markdown():
         app.logger.error(error_msg)
         return jsonify({"error": error_msg}), 500
 
-def _update_profile_task(api_key, questions, user_answers):
-    """在后台线程中生成答题总结并更新用户画像。"""
+def _update_profile_task(api_key, sessions):
+    """
+    在后台队列中生成答题总结并更新用户画像。
+    sessions 为合并后的多次答题会话 (questions, user_answers)，一次调用即可全部吸收。
+    配置项 profile_update_mode 选择更新方式：one_pass（默认，总结与画像更新合并为一次调用）、
+    one_pass_delta（一次调用，模型只输出结构化的画像修改）或 two_pass（先总结再更新画像）。
+    """
+    questions = [question for session_questions, _ in sessions for question in session_questions]
+    user_answers = [answer for _, session_answers in sessions for answer in session_answers]
+    update_mode = load_config().get("profile_update_mode", "one_pass")
     with app.app_context():
-        app.logger.info("后台任务：开始更新用户画像。")
+        app.logger.info(f"后台任务：开始更新用户画像。合并会话数: {len(sessions)}, 模式: {update_mode}")
         try:
-            
+            if update_mode in ("one_pass", "one_pass_delta"):
+                updated_profile = user_profile_manager.update_user_profile_one_pass(
+                    questions, user_answers, api_key, structured_delta=(update_mode == "one_pass_delta")
+                )
+                if updated_profile:
+                    app.logger.info(f"用户画像已成功更新: {updated_profile}")
+                else:
+                    app.logger.warning("用户画像更新失败。")
+                return
+
             summary_prompt = prompt_manager.get_prompt(
                 "grading_summary_prompt",
                 questions_with_answers=json.dumps(questions, ensure_ascii=False, indent=2),
@@ -483,7 +857,8 @@ def _update_profile_task(api_key, questions, user_answers):
                 model="Qwen/Qwen2.5-72B-Instruct",
                 messages=[{"role": "user", "content": summary_prompt}],
                 stream=False,
-                temperature=0.6 
+                temperature=0.6,
+                user_inputs=[json.dumps(user_answers, ensure_ascii=False)],
             )
             grading_summary = llm_response.choices[0].message.content.strip()
             app.logger.info(f"后台任务：生成答题总结完成，长度: {len(grading_summary)}")
@@ -503,60 +878,174 @@ def _update_profile_task(api_key, questions, user_answers):
 
         except Exception as e:
             app.logger.error(f"后台更新用户画像任务失败: {e}")
+            raise
+
+profile_update_queue = ProfileUpdateQueue(_update_profile_task)
+atexit.register(profile_update_queue.shutdown)
+
+class GradingJob:
+    """一次试卷批改请求。"""
+
+    def __init__(self, trace, echo_trace_id, cancel_scope, config):
+        self.trace = trace
+        self.echo_trace_id = echo_trace_id
+        self.cancel_scope = cancel_scope
+        self.config = config
+        self.questions = None
+        self.user_answers = None
+        self.api_key = None
+        self.grading_kwargs = None
+
+def prepare_grading():
+    """解析 /api/grade 请求。参数有误时抛出 RequestError。"""
+    data = request.get_json()
+    questions = data.get("questions")
+    user_answers = data.get("answers")
+    api_key = data.get("api_key")
+    
+    config = load_config()
 
-@app.route("/api/grade", methods=["POST"])
-def grade_submission():
-    try:
-        data = request.get_json()
-        questions = data.get("questions")
-        user_answers = data.get("answers")
-        api_key = data.get("api_key")
-        
-        config = load_config()
-        temperature = config.get("temperature", 0.7)
-        enhanced_mode = config.get("enhanced_structured_output", False)
-
-        if not all([questions, user_answers, api_key]):
-            return jsonify({"error": "缺少题目、答案或API Key"}), 400
-
-        app.logger.info(f"开始批改试卷. 题目数: {len(questions)}")
-
-        def generate_grade_stream():
-            grading_results = []
-            try:
-                grading_stream = grading.grade_exam_stream(
-                    questions, user_answers, api_key, temperature,
-                    enhanced_structured_output=enhanced_mode
+    if not all([questions, user_answers, api_key]):
+        raise RequestError("缺少题目、答案或API Key")
+
+    app.logger.info(f"开始批改试卷. 题目数: {len(questions)}")
+    trace, echo_trace_id = start_trace("grade_exam", config)
+    job = GradingJob(trace, echo_trace_id, start_cancel_scope("grade_exam", config), config)
+    job.questions = questions
+    job.user_answers = user_answers
+    job.api_key = api_key
+    job.grading_kwargs = dict(
+        temperature=config.get("temperature", 0.7),
+        enhanced_structured_output=config.get("enhanced_structured_output", False),
+        optimistic_security_check=config.get("optimistic_security_check", True),
+        max_concurrency=int(config.get("grading_concurrency", 4)),
+        event_order=config.get("grading_event_order", "as_completed"),
+        grading_mode=config.get("grading_mode", "per_question"),
+        batch_size=int(config.get("grading_batch_size", 10)),
+        skip_correct_choice_feedback=config.get("skip_correct_choice_feedback", False),
+        trace=trace,
+        cancel_scope=job.cancel_scope,
+    )
+    return job
+
+def grading_result(event_str):
+    """从批改事件中取出 (题目索引, 批改结果)，不是某道题的 end 事件时返回 None。"""
+    event = json.loads(event_str)
+    if event.get("type") == "end" and "question_index" in event:
+        return event["question_index"], event.get("data") or {}
+    return None
+
+def finish_grading(job, grading_results):
+    """批改完成后更新错题本并提交用户画像更新任务。"""
+    if job.config.get("wrong_answer_notebook_enabled", True) and grading_results:
+        try:
+            with job.trace.span("wrong_answer_notebook"):
+                wrong_answer_notebook.record_results(
+                    job.questions, job.user_answers, dict(grading_results), current_source_key()
                 )
-                for event_str in grading_stream:
-                    yield event_str + "\n" 
-                
-                
-                config = load_config()
-                if config.get("user_profile_enabled", True):
-                    app.logger.info("用户画像功能已启用，启动后台任务更新用户画像。")
-                    thread = threading.Thread(
-                        target=_update_profile_task,
-                        args=(api_key, questions, user_answers)
-                    )
-                    thread.start()
-                else:
-                    app.logger.info("用户画像功能未启用，跳过更新。")
+        except Exception as e:
+            app.logger.error(f"更新错题本失败: {e}")
+    
+    
+    if job.config.get("user_profile_enabled", True):
+        app.logger.info("用户画像功能已启用，提交用户画像更新任务。")
+        profile_update_queue.submit("default", job.api_key, job.questions, job.user_answers)
+    else:
+        app.logger.info("用户画像功能未启用，跳过更新。")
+
+def grading_error_event(error):
+    """批改流中未被转换为单题 error 事件的异常对应的 error 事件。"""
+    if isinstance(error, RequestCancelled):
+        return cancelled_event(error)
+    return json.dumps({"type": "error", "error": f"启动批改流失败: {str(error)}"}) + "\n"
+
+def generate_grade_stream(job):
+    grading_results = []
+    try:
+        grading_stream = grading.grade_exam_stream(
+            job.questions, job.user_answers, job.api_key, **job.grading_kwargs
+        )
+        for event_str in grading_stream:
+            result = grading_result(event_str)
+            if result is not None:
+                grading_results.append(result)
+            yield event_str + "\n" 
 
-            except Exception as e:
-                error_event = {
-                    "type": "error",
-                    "error": f"启动批改流失败: {str(e)}",
-                }
-                yield json.dumps(error_event) + "\n"
+        finish_grading(job, grading_results)
 
-        app.logger.info("返回批改结果流.")
-        return Response(generate_grade_stream(), mimetype="application/x-ndjson")
+    except Exception as e:
+        yield grading_error_event(e)
 
+@app.route("/api/grade", methods=["POST"])
+def grade_submission():
+    job, error = prepare_or_error(prepare_grading, "评分接口出错")
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+    app.logger.info("返回批改结果流.")
+    return traced_ndjson_response(generate_grade_stream(job), job.trace, job.echo_trace_id, job.cancel_scope)
+
+@app.route("/api/review_exam", methods=["GET"])
+def build_review_exam():
+    """
+    从错题本中取出已到期的题目组成复习试卷，不调用LLM。
+    可选参数：limit（题目数，默认10）、topic、source_key（传 current 表示当前上传的资料）。
+    """
+    try:
+        limit = max(1, min(int(request.args.get("limit", 10)), 100))
+    except ValueError:
+        return jsonify({"error": "limit 必须是整数"}), 400
+    source_key = request.args.get("source_key")
+    if source_key == "current":
+        source_key = current_source_key()
+
+    items = wrong_answer_notebook.due_items(limit, topic=request.args.get("topic"), source_key=source_key)
+    app.logger.info(f"生成错题复习试卷. 题目数: {len(items)}")
+    return jsonify({
+        "questions": [item["question"] for item in items],
+        "items": items,
+        "stats": wrong_answer_notebook.stats(),
+    })
+
+@app.route("/api/question_bank/export", methods=["GET"])
+def export_question_bank():
+    """导出题库，可通过 source_key 参数只导出某一组参考资料的题目。"""
+    records = question_bank.export_questions(request.args.get("source_key"))
+    app.logger.info(f"导出题库. 题目数: {len(records)}")
+    return jsonify({"questions": records})
+
+@app.route("/api/question_bank/import", methods=["POST"])
+def import_question_bank():
+    """批量导入题库，请求体为导出接口返回的 JSON（或其中的 questions 列表）。"""
+    data = request.get_json(silent=True)
+    records = data.get("questions") if isinstance(data, dict) else data
+    if not isinstance(records, list):
+        return jsonify({"error": "请求体必须是题目记录列表或包含 questions 列表的对象"}), 400
+    try:
+        result = question_bank.import_questions(records)
     except Exception as e:
-        error_msg = f"评分接口出错: {str(e)}"
-        app.logger.error(error_msg)
-        return jsonify({"error": error_msg}), 500
+        app.logger.error(f"导入题库失败: {e}")
+        return jsonify({"error": f"导入题库失败: {str(e)}"}), 500
+    app.logger.info(f"导入题库. 结果: {result}")
+    return jsonify(result)
+
+@app.route("/api/metrics", methods=["GET"])
+def get_metrics():
+    return jsonify({
+        "profile_update_queue": profile_update_queue.metrics(),
+        "llm_single_flight": siliconflow_client.llm_single_flight.metrics(),
+        "llm_rate_limiters": rate_limiters.metrics(),
+        "llm_cassette": llm_cassette.metrics(),
+    })
+
+metrics.registry.register_collector("profile_update_queue", profile_update_queue.metrics)
+metrics.registry.register_collector("llm_single_flight", siliconflow_client.llm_single_flight.metrics)
+metrics.registry.register_collector("llm_cassette", llm_cassette.metrics)
+metrics.registry.register_collector("llm_rate_limiter", rate_limiters.metrics, label="api_key_hash")
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Prometheus 文本格式的指标：各阶段耗时与模型调用的直方图、计数器，以及各组件的状态。"""
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
 
 @socketio.on('connect')
 def handle_connect():
@@ -0,0 +1,379 @@
+"""
+异步（ASGI）服务模式。
+
+三个流式接口 /api/process、/api/regenerate_question 与 /api/grade 在事件循环中以异步生成器推送事件，
+上游调用使用 AsyncOpenAI，单个进程即可同时保持数百个流而不必为每个流占用一个线程。
+Socket.IO 连接由 python-socketio 的 AsyncServer 管理，其余接口仍由 Flask 应用处理（在线程中执行）。
+
+启动:
+    uvicorn asgi_app:application --host 0.0.0.0 --port 5000
+"""
+import io
+import sys
+import json
+import asyncio
+import logging
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+import socketio
+
+import grading
+import siliconflow_client
+from llm_json_parser import astream_json_with_events
+from metrics import atimed_parse
+import exam_sharding
+from app import (
+    app,
+    get_uploaded_files,
+    set_event_emitter,
+    prepare_or_error,
+    StreamRecorder,
+    prepare_exam_generation,
+    banked_question_lines,
+    make_generation_detector,
+    screen_near_duplicate,
+    validate_generated_event,
+    generation_error_event,
+    save_generated_questions,
+    prepare_regeneration,
+    make_regeneration_detector,
+    regenerated_event_line,
+    regeneration_error_event,
+    prepare_grading,
+    grading_result,
+    finish_grading,
+    grading_error_event,
+)
+
+logger = logging.getLogger(__name__)
+
+# 分片生成与近似重复补题仍使用同步实现，在线程中执行并把事件转交给事件循环
+BRIDGE_WORKERS = 64
+_bridge_executor = ThreadPoolExecutor(max_workers=BRIDGE_WORKERS, thread_name_prefix="asgi-bridge")
+_DONE = object()
+
+sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*")
+
+
+@sio.event
+async def connect(sid, environ):
+    """当客户端连接时，立即向其发送当前的文件列表"""
+    logger.info('Client connected')
+    files = await asyncio.to_thread(get_uploaded_files)
+    await sio.emit('file_list_update', {'files': files}, to=sid)
+
+
+@sio.event
+async def disconnect(sid, reason=None):
+    logger.info('Client disconnected')
+
+
+def on_startup():
+    """在事件循环中启动：此后 Flask 接口与后台任务的广播都转交给 AsyncServer。"""
+    loop = asyncio.get_running_loop()
+    set_event_emitter(lambda event, data: asyncio.run_coroutine_threadsafe(sio.emit(event, data), loop))
+    logger.info("ASGI 服务模式已启动.")
+
+
+async def iterate_in_thread(make_iterator):
+    """
+    在线程中执行同步迭代器并以异步生成器的形式产出其结果。
+    生成器被关闭时通知线程停止；线程阻塞在上游读取时依靠请求的取消范围关闭上游流。
+
+    :param make_iterator: 无参函数，返回同步迭代器，在线程中调用。
+    """
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    stopped = threading.Event()
+
+    def put(item, error=None):
+        try:
+            loop.call_soon_threadsafe(items.put_nowait, (item, error))
+        except RuntimeError:
+            # 事件循环已关闭
+            stopped.set()
+
+    def run():
+        iterator = make_iterator()
+        try:
+            for item in iterator:
+                if stopped.is_set():
+                    break
+                put(item)
+        except BaseException as e:
+            put(_DONE, e)
+        else:
+            put(_DONE)
+        finally:
+            close = getattr(iterator, "close", None)
+            if close:
+                close()
+
+    loop.run_in_executor(_bridge_executor, run)
+    try:
+        while True:
+            item, error = await items.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+async def agenerate_question_events(job):
+    """generate_question_events 的异步版本。"""
+    banked_stems = [question["stem"] for question in job.banked_questions]
+    if len(job.shards) > 1:
+        logger.info(f"使用分片并行生成. 模式: {job.sharding_mode}, 分片数: {len(job.shards)}")
+        rounds = job.config.get("generation_top_up_rounds", exam_sharding.DEFAULT_TOP_UP_ROUNDS)
+        sharded = iterate_in_thread(lambda: job.sharded_stream(job.shards, rounds, job.banked_questions))
+        async with contextlib.aclosing(sharded) as events:
+            async for event in events:
+                yield event
+        return
+
+    llm_stream = await siliconflow_client.ainvoke_llm(**job.llm_kwargs(job.question_types_str, avoid_stems=banked_stems))
+    async with contextlib.aclosing(atimed_parse(astream_json_with_events, llm_stream, job.trace)) as events:
+        async for event in events:
+            event = validate_generated_event(event, job.enhanced_mode)
+            if event is not None:
+                yield event
+
+
+async def agenerate_question_stream(job):
+    """generate_question_stream 的异步版本。"""
+    generated_questions = []
+    try:
+        for line in banked_question_lines(job):
+            yield line
+        if not job.question_types_str:
+            return
+
+        duplicate_mode = job.config.get("near_duplicate_mode", "flag")
+        detector = await asyncio.to_thread(make_generation_detector, job)
+        dropped_counts = {}
+
+        async with contextlib.aclosing(agenerate_question_events(job)) as events:
+            async for event in events:
+                event = screen_near_duplicate(event, detector, duplicate_mode, dropped_counts)
+                if event["type"] == "end":
+                    generated_questions.append(event["data"])
+                yield json.dumps(event) + "\n"
+
+        # replace 模式下为被丢弃的重复题目补题，补题结果同样经过重复检测
+        for _ in range(job.config.get("generation_top_up_rounds", exam_sharding.DEFAULT_TOP_UP_ROUNDS)):
+            if duplicate_mode != "replace" or not dropped_counts:
+                break
+            replacement_shards = job.replacement_shards(dropped_counts)
+            logger.info(f"为近似重复的题目生成替换题: {replacement_shards}")
+            dropped_counts = {}
+            existing_questions = job.banked_questions + generated_questions
+            replacement_events = iterate_in_thread(
+                lambda: job.sharded_stream(replacement_shards, 0, existing_questions)
+            )
+            async with contextlib.aclosing(replacement_events) as events:
+                async for event in events:
+                    event = screen_near_duplicate(event, detector, duplicate_mode, dropped_counts)
+                    if event["type"] == "end":
+                        generated_questions.append(event["data"])
+                    yield json.dumps(event) + "\n"
+
+    except Exception as e:
+        yield generation_error_event(e)
+    finally:
+        await asyncio.to_thread(save_generated_questions, job, generated_questions)
+
+
+async def agenerate_regeneration_stream(job):
+    """generate_regeneration_stream 的异步版本。"""
+    try:
+        detector = await asyncio.to_thread(make_regeneration_detector, job)
+        llm_stream = await siliconflow_client.ainvoke_llm(**job.llm_kwargs)
+        async with contextlib.aclosing(atimed_parse(astream_json_with_events, llm_stream, job.trace)) as events:
+            async for event in events:
+                line = regenerated_event_line(job, event, detector)
+                if line:
+                    yield line
+    except Exception as e:
+        yield regeneration_error_event(e)
+
+
+async def agenerate_grade_stream(job):
+    """generate_grade_stream 的异步版本。"""
+    grading_results = []
+    try:
+        grading_stream = grading.agrade_exam_stream(job.questions, job.user_answers, job.api_key, **job.grading_kwargs)
+        async with contextlib.aclosing(grading_stream) as events:
+            async for event_str in events:
+                result = grading_result(event_str)
+                if result is not None:
+                    grading_results.append(result)
+                yield event_str + "\n"
+
+        await asyncio.to_thread(finish_grading, job, grading_results)
+
+    except Exception as e:
+        yield grading_error_event(e)
+
+
+# 路径 -> (准备函数, 事件流函数, 准备失败时的错误前缀, 开始推送时的日志)
+STREAM_ROUTES = {
+    "/api/process": (prepare_exam_generation, agenerate_question_stream, "处理时出错", "返回试卷生成流."),
+    "/api/regenerate_question": (prepare_regeneration, agenerate_regeneration_stream, "处理时出错", "返回题目再生成流."),
+    "/api/grade": (prepare_grading, agenerate_grade_stream, "评分接口出错", "返回批改结果流."),
+}
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+def build_environ(scope, body):
+    """由 ASGI 的 HTTP scope 与完整的请求体构造 WSGI environ。"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1")
+        value = value.decode("latin-1")
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+            continue
+        if name == "content-length":
+            continue
+        key = "HTTP_" + name.upper().replace("-", "_")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def call_wsgi(environ):
+    """在线程中调用 Flask 应用，返回 (状态码, 响应头, 响应体)。"""
+    response = {}
+    chunks = []
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+        return chunks.append
+
+    result = app(environ, start_response)
+    try:
+        for data in result:
+            chunks.append(data)
+    finally:
+        close = getattr(result, "close", None)
+        if close:
+            close()
+    return response["status"], response["headers"], b"".join(chunks)
+
+
+def prepare_in_request_context(environ, prepare, error_prefix):
+    with app.request_context(environ):
+        return prepare_or_error(prepare, error_prefix)
+
+
+async def send_response(send, status, headers, body):
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def pump_events(event_lines, recorder, send):
+    async with contextlib.aclosing(event_lines) as lines:
+        async for line in lines:
+            await send({"type": "http.response.body", "body": recorder.line(line).encode("utf-8"), "more_body": True})
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def stream_route(route, environ, receive, send):
+    """
+    处理一个流式接口：在线程中解析请求并准备参考资料，随后在事件循环中推送事件。
+    客户端断开时取消请求并停止推送，进行中的上游流随之关闭。
+    """
+    prepare, event_stream, error_prefix, log_message = route
+    job, error = await asyncio.to_thread(prepare_in_request_context, environ, prepare, error_prefix)
+    if error:
+        body = json.dumps({"error": error[0]}).encode("utf-8")
+        await send_response(send, error[1], [(b"content-type", b"application/json")], body)
+        return
+
+    logger.info(log_message)
+    recorder = StreamRecorder(job.trace, job.echo_trace_id, job.cancel_scope)
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"application/x-ndjson"),
+        (b"x-trace-id", job.trace.trace_id.encode("latin-1")),
+    ]})
+    pump = asyncio.create_task(pump_events(event_stream(job), recorder, send))
+    watcher = asyncio.create_task(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({pump, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        if pump.done() and pump.exception() is not None:
+            logger.warning(f"推送事件流失败. Trace: {job.trace.trace_id}, 错误: {pump.exception()!r}")
+        if not pump.done() or pump.exception() is not None:
+            recorder.client_disconnected()
+            pump.cancel()
+            await asyncio.gather(pump, return_exceptions=True)
+    finally:
+        if not pump.done():
+            # 服务器关闭时本任务被取消
+            recorder.client_disconnected()
+            pump.cancel()
+        watcher.cancel()
+        recorder.finish()
+
+
+async def http_app(scope, receive, send):
+    if scope["type"] != "http":
+        return
+    body = await read_body(receive)
+    if body is None:
+        return
+    environ = build_environ(scope, body)
+    route = STREAM_ROUTES.get(scope["path"]) if scope["method"] == "POST" else None
+    if route is not None:
+        await stream_route(route, environ, receive, send)
+        return
+    status, headers, response_body = await asyncio.to_thread(call_wsgi, environ)
+    await send_response(send, status, headers, response_body)
+
+
+application = socketio.ASGIApp(sio, other_asgi_app=http_app, on_startup=on_startup)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(application, host="0.0.0.0", port=5000)
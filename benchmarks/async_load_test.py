@@ -0,0 +1,250 @@
+"""
+对比同步（WSGI，线程池）与异步（ASGI，asgi_app）两种服务模式在大量并发流下的表现。
+
+两种模式的服务分别在子进程中启动，上游使用在另一个子进程中运行的本地模拟服务器。客户端以 httpx.AsyncClient 同时保持
+--concurrency 个 NDJSON 流，统计首个事件延迟与总耗时的 p50/p99、吞吐量、错误数，以及服务进程的
+线程数峰值与内存峰值。同步模式的工作线程数由 --sync-threads 限制（与常见的 WSGI 部署相同），
+超出的请求在监听队列中等待；异步模式在一个事件循环中处理全部流。
+
+每个虚拟用户使用不同的 API Key，使按 Key 划分的限流窗口不成为瓶颈。运行期间会在 uploads/ 中
+放入一份临时 PPTX 作为参考资料，并在结束后删除；config.json 在结束后恢复。
+
+用法:
+    python benchmarks/async_load_test.py --endpoints regenerate grade --concurrency 50 200
+    python benchmarks/async_load_test.py --modes async --concurrency 400 --ttft 1.0 --output async.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import statistics
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import ENDPOINTS, MATERIAL_FILENAME, write_material, build_request, percentile  # noqa: E402
+
+MODES = ("sync", "async")
+DEFAULT_SYNC_THREADS = 32
+SAMPLE_INTERVAL = 0.05
+
+
+def serve_sync(port, threads):
+    """以固定大小的线程池运行 Flask 应用（子进程中调用）。"""
+    from werkzeug.serving import BaseWSGIServer
+    import app
+
+    class PooledWSGIServer(BaseWSGIServer):
+        request_queue_size = 1024
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="wsgi")
+
+        def process_request(self, request, client_address):
+            self._executor.submit(self._process_request, request, client_address)
+
+        def _process_request(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    PooledWSGIServer("127.0.0.1", port, app.app).serve_forever()
+
+
+def serve_async(port):
+    """以 uvicorn 运行 asgi_app（子进程中调用）。"""
+    import uvicorn
+
+    uvicorn.run("asgi_app:application", host="127.0.0.1", port=port, log_level="warning", backlog=1024)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def spawn(name, args, env=None):
+    """在子进程中启动一个监听随机端口的服务，等待端口可连接后返回 (进程, 端口)。"""
+    port = free_port()
+    command = [sys.executable, *args, "--port", str(port)]
+    process = subprocess.Popen(command, cwd=ROOT, env=dict(os.environ, **(env or {})),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{name} 启动失败，退出码 {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{name} 在 60 秒内未能启动")
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def process_status(pid):
+    """读取 /proc/<pid>/status 中的线程数与内存峰值（KB），不支持时返回 None。"""
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(fields["Threads"]), int(fields["VmHWM"].split()[0])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+async def sample_process(pid, samples, stop):
+    while not stop.is_set():
+        status = process_status(pid)
+        if status is not None:
+            samples.append(status)
+        try:
+            await asyncio.wait_for(stop.wait(), SAMPLE_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_request(client, base_url, endpoint, index):
+    path, kwargs = build_request(endpoint, index, f"mock-key-{index}")
+    kwargs = {"data": kwargs["data"]} if "data" in kwargs else {"json": kwargs["json"]}
+    started = time.perf_counter()
+    first_event = None
+    events = errors = 0
+    try:
+        async with client.stream("POST", base_url + path, **kwargs) as response:
+            errors += response.status_code != 200
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                if first_event is None:
+                    first_event = time.perf_counter() - started
+                events += 1
+                try:
+                    errors += json.loads(line).get("type") == "error"
+                except ValueError:
+                    pass
+    except Exception:
+        errors += 1
+    return {"first_event": first_event, "total": time.perf_counter() - started, "events": events, "errors": errors}
+
+
+async def run_level(base_url, pid, endpoint, concurrency, requests):
+    """同时发起 concurrency 个请求（共 requests 个），统计延迟、吞吐量与服务进程的资源占用。"""
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    samples = []
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_process(pid, samples, stop))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(600.0, connect=60.0)) as client:
+        async def limited(index):
+            async with semaphore:
+                return await run_request(client, base_url, endpoint, index)
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*[limited(index) for index in range(requests)])
+        wall = time.perf_counter() - started
+    stop.set()
+    await sampler
+
+    totals = [r["total"] for r in results]
+    first_events = [r["first_event"] for r in results if r["first_event"] is not None]
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "wall_seconds": wall,
+        "throughput_rps": requests / wall if wall else None,
+        "first_event_p50": statistics.median(first_events) if first_events else None,
+        "first_event_p99": percentile(first_events, 0.99) if first_events else None,
+        "total_p50": statistics.median(totals),
+        "total_p99": percentile(totals, 0.99),
+        "events": sum(r["events"] for r in results),
+        "errors": sum(r["errors"] for r in results),
+        "peak_threads": max((threads for threads, _ in samples), default=None),
+        "peak_rss_mb": max((rss for _, rss in samples), default=0) / 1024 or None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=["regenerate", "grade"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[50, 200], help="同时保持的流数，可给出多档")
+    parser.add_argument("--requests", type=int, help="每档的请求数，默认与并发数相同")
+    parser.add_argument("--sync-threads", type=int, default=DEFAULT_SYNC_THREADS, help="同步模式的工作线程数")
+    parser.add_argument("--ttft", type=float, default=1.0, help="模拟服务器的首 token 延迟（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=30.0)
+    parser.add_argument("--output", help="将结果写入 JSON 文件")
+    parser.add_argument("--serve", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    if args.serve:
+        serve_sync(args.port, args.sync_threads) if args.serve == "sync" else serve_async(args.port)
+        return
+
+    mock, mock_port = spawn("模拟服务器", [os.path.join("benchmarks", "mock_llm_server.py"), "--ttft", str(args.ttft),
+                                           "--tokens-per-second", str(args.tokens_per_second)])
+    base_url = f"http://127.0.0.1:{mock_port}/v1"
+    with open("config.json", "rb") as f:
+        original_config = f.read()
+    material_path = os.path.join("uploads", MATERIAL_FILENAME)
+    os.makedirs("uploads", exist_ok=True)
+    write_material(material_path)
+    results = {"mock_ttft_seconds": args.ttft, "tokens_per_second": args.tokens_per_second,
+               "sync_threads": args.sync_threads, "modes": {}}
+    try:
+        for mode in args.modes:
+            process, port = spawn(f"{mode} 服务", [os.path.abspath(__file__), "--serve", mode,
+                                                    "--sync-threads", str(args.sync_threads)],
+                                  env={"SILICONFLOW_API_BASE": base_url})
+            app_url = f"http://127.0.0.1:{port}"
+            mode_results = results["modes"][mode] = {}
+            try:
+                for endpoint in args.endpoints:
+                    for concurrency in args.concurrency:
+                        level = asyncio.run(run_level(app_url, process.pid, endpoint, concurrency,
+                                                      args.requests or concurrency))
+                        mode_results.setdefault(endpoint, {})[str(concurrency)] = level
+                        print(f"{mode:5s} {endpoint:10s} 并发 {concurrency:4d}: "
+                              f"p50 {level['total_p50']:.2f}s, p99 {level['total_p99']:.2f}s, "
+                              f"首事件 p99 {level['first_event_p99'] or 0:.2f}s, "
+                              f"{level['throughput_rps']:.1f} req/s, 错误 {level['errors']}, "
+                              f"线程峰值 {level['peak_threads']}", file=sys.stderr)
+            finally:
+                stop(process)
+    finally:
+        os.remove(material_path)
+        with open("config.json", "wb") as f:
+            f.write(original_config)
+        stop(mock)
+
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+stream_json_with_events 的微基准：在约 50 KB 的模型输出上测量每个数据块的处理耗时。
+
+同时运行一份旧版（每个数据块都从头重新扫描缓冲区）的实现作为对照，
+比较输出开头与结尾处的单块耗时，增量解析器的单块耗时应基本保持不变。
+
+用法:
+    python benchmarks/bench_json_parser.py --size 50000 --chunk-size 4
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_json_parser import JsonStreamParser  # noqa: E402
+
+
+def legacy_feed_all(chunks):
+    """旧版算法：buffer += chunk 后从索引 0 重新扫描括号，用作对照。"""
+    buffer = ""
+    json_started = False
+    timings = []
+    for chunk in chunks:
+        started = time.perf_counter()
+        buffer += chunk
+        if not json_started:
+            if '{' in buffer:
+                json_started = True
+                buffer = buffer[buffer.index('{'):]
+        if json_started:
+            brace_counter = 0
+            for i, char in enumerate(buffer):
+                if char == '{':
+                    brace_counter += 1
+                elif char == '}':
+                    brace_counter -= 1
+                    if brace_counter == 0:
+                        json.loads(buffer[:i + 1])
+                        buffer = buffer[i + 1:]
+                        json_started = False
+                        break
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def incremental_feed_all(chunks):
+    parser = JsonStreamParser()
+    timings = []
+    for chunk in chunks:
+        started = time.perf_counter()
+        parser.feed(chunk)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def build_output(size):
+    """构造一个约 size 字节、题干很长的单个题目对象。"""
+    stem = ("牛顿第一定律指出，一切物体在没有受到外力作用时，总保持静止或匀速直线运动状态。" * (size // 40 + 1))[:size]
+    return json.dumps({"question_type": "short_answer", "stem": stem, "answer": "惯性", "score": 10}, ensure_ascii=False)
+
+
+def summarize(timings):
+    window = max(len(timings) // 10, 1)
+    head = statistics.mean(timings[:window]) * 1e6
+    tail = statistics.mean(timings[-window:]) * 1e6
+    return {
+        "chunks": len(timings),
+        "total_ms": sum(timings) * 1e3,
+        "first_10pct_us_per_chunk": head,
+        "last_10pct_us_per_chunk": tail,
+        "tail_to_head_ratio": tail / head if head else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=50_000)
+    parser.add_argument("--chunk-size", type=int, default=4)
+    parser.add_argument("--skip-legacy", action="store_true", help="不运行旧版实现（50 KB 时约需半分钟）")
+    parser.add_argument("--output", help="将结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    text = build_output(args.size)
+    chunks = [text[i:i + args.chunk_size] for i in range(0, len(text), args.chunk_size)]
+    results = {
+        "output_chars": len(text),
+        "incremental": summarize(incremental_feed_all(chunks)),
+    }
+    if not args.skip_legacy:
+        results["legacy"] = summarize(legacy_feed_all(chunks))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
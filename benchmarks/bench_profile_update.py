@@ -0,0 +1,121 @@
+"""
+用户画像更新的基准：比较 two_pass、one_pass 与 one_pass_delta 三种模式的耗时、调用次数与 token 用量。
+
+在本地模拟服务器上运行，不需要真实的 API Key；运行期间会临时修改 config.json 中的用户画像，结束后恢复。
+
+用法:
+    python benchmarks/bench_profile_update.py --rounds 3 --ttft 0.5 --tokens-per-second 50
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_llm_server import start_mock_server  # noqa: E402
+
+MODES = ("two_pass", "one_pass", "one_pass_delta")
+
+QUESTIONS = [
+    {"question_type": "multiple_choice", "stem": f"第{i}题：下列哪一项描述是正确的？",
+     "options": {"A": "选项A", "B": "选项B", "C": "选项C", "D": "选项D"}, "answer": "A", "score": 5}
+    for i in range(1, 9)
+] + [
+    {"question_type": "short_answer", "stem": "请简述牛顿第一定律的内容及其意义。",
+     "answer": "一切物体在没有受到外力作用时，总保持静止或匀速直线运动状态。", "score": 10},
+]
+USER_ANSWERS = ["A", "B", "A", "C", "A", "A", "D", "A", "物体会一直运动下去。"]
+
+
+class UsageRecorder:
+    """包装 siliconflow_client._call_llm_with_retry，统计调用次数与 token 用量。"""
+
+    def __init__(self, client_module):
+        self.client_module = client_module
+        self.original = client_module._call_llm_with_retry
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def __enter__(self):
+        def recording_call(client, retries=3, **kwargs):
+            response = self.original(client, retries, **kwargs)
+            self.calls += 1
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                self.prompt_tokens += usage.prompt_tokens
+                self.completion_tokens += usage.completion_tokens
+            return response
+        self.client_module._call_llm_with_retry = recording_call
+        return self
+
+    def __exit__(self, *exc):
+        self.client_module._call_llm_with_retry = self.original
+
+
+def run_mode(app_module, recorder, mode, rounds):
+    import user_profile_manager
+    from config_store import config_store
+
+    config_store.update({"profile_update_mode": mode})
+    wall_times = []
+    recorder.reset()
+    for round_index in range(rounds):
+        user_profile_manager.set_user_profile("该生对基础概念掌握较好。")
+        # 每轮使用不同的答案，避免安全检查命中缓存而低估调用次数
+        user_answers = USER_ANSWERS[:-1] + [f"{USER_ANSWERS[-1]}（{mode} 第{round_index + 1}轮）"]
+        started = time.perf_counter()
+        app_module._update_profile_task("mock-key", [(QUESTIONS, user_answers)])
+        wall_times.append(time.perf_counter() - started)
+    return {
+        "mean_wall_seconds": statistics.mean(wall_times),
+        "llm_calls_per_update": recorder.calls / rounds,
+        "prompt_tokens_per_update": recorder.prompt_tokens / rounds,
+        "completion_tokens_per_update": recorder.completion_tokens / rounds,
+        "final_profile": user_profile_manager.get_user_profile(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--ttft", type=float, default=0.5, help="模拟服务器的首 token 延迟（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--output", help="将结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    server, base_url = start_mock_server(ttft=args.ttft, tokens_per_second=args.tokens_per_second)
+    os.environ["SILICONFLOW_API_BASE"] = base_url
+    os.chdir(ROOT)
+
+    from config_store import config_store
+    original_config = config_store.get()
+
+    import app
+    import siliconflow_client
+
+    results = {}
+    try:
+        with UsageRecorder(siliconflow_client) as recorder:
+            for mode in MODES:
+                results[mode] = run_mode(app, recorder, mode, args.rounds)
+    finally:
+        config_store.replace(original_config)
+        server.shutdown()
+
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
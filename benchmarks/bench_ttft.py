@@ -0,0 +1,78 @@
+"""
+对比串行安全检查与乐观流式两种模式下 invoke_llm 的首 token 时间（TTFT）。
+
+在本地模拟服务器上运行，每次使用不同的用户输入以避开安全检查缓存。
+
+用法:
+    python benchmarks/bench_ttft.py --iterations 10 --ttft 0.5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_llm_server import start_mock_server  # noqa: E402
+
+
+def measure_ttft(siliconflow_client, optimistic, iteration):
+    user_text = f"请侧重考查基础概念 #{iteration}-{optimistic}"
+    started = time.perf_counter()
+    stream = siliconflow_client.invoke_llm(
+        api_key="mock-key",
+        model="Qwen/Qwen2.5-72B-Instruct",
+        messages=[{"role": "user", "content": f"学习材料...\n出题要求: {user_text}\n题型: 选择题2道"}],
+        stream=True,
+        user_inputs=[user_text],
+        optimistic_security_check=optimistic,
+    )
+    ttft = None
+    for chunk in stream:
+        if ttft is None and chunk.choices and chunk.choices[0].delta.content:
+            ttft = time.perf_counter() - started
+    return ttft, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--ttft", type=float, default=0.3, help="模拟服务器的首 token 延迟（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--output", help="将结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    server, base_url = start_mock_server(ttft=args.ttft, tokens_per_second=args.tokens_per_second)
+    os.environ["SILICONFLOW_API_BASE"] = base_url
+    import siliconflow_client
+
+    results = {"mock_ttft_seconds": args.ttft, "iterations": args.iterations, "modes": {}}
+    try:
+        for optimistic in (False, True):
+            ttfts, totals = [], []
+            for i in range(args.iterations):
+                ttft, total = measure_ttft(siliconflow_client, optimistic, i)
+                ttfts.append(ttft)
+                totals.append(total)
+            mode = "optimistic" if optimistic else "sequential"
+            results["modes"][mode] = {
+                "ttft_mean": statistics.mean(ttfts),
+                "ttft_p50": statistics.median(ttfts),
+                "total_mean": statistics.mean(totals),
+            }
+    finally:
+        server.shutdown()
+
+    sequential = results["modes"]["sequential"]["ttft_mean"]
+    optimistic = results["modes"]["optimistic"]["ttft_mean"]
+    results["ttft_speedup"] = sequential / optimistic if optimistic else None
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+检查流式调用在被取消或关闭后是否归还全部上游资源。
+
+对本地模拟服务器发起流式 invoke_llm 调用，在读取前、读取中途取消请求或直接关闭返回的流，
+之后确认请求合并层没有残留的上游流、限制器的并发位置已全部归还。任一场景失败时以非零状态退出。
+
+用法:
+    python benchmarks/check_cancellation.py
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_llm_server import start_mock_server  # noqa: E402
+
+SETTLE_SECONDS = 2.0
+
+
+def leaked_resources(siliconflow_client, rate_limiters):
+    """等待关闭生效，返回 (残留的合并上游流数, 未归还的并发位置数)。"""
+    deadline = time.monotonic() + SETTLE_SECONDS
+    while True:
+        flights = siliconflow_client.llm_single_flight.metrics()["in_flight"]
+        slots = sum(state["in_flight"] for state in rate_limiters.metrics().values())
+        if (flights, slots) == (0, 0) or time.monotonic() > deadline:
+            return flights, slots
+        time.sleep(0.05)
+
+
+def main():
+    server, base_url = start_mock_server(ttft=0.2, tokens_per_second=200.0)
+    os.environ["SILICONFLOW_API_BASE"] = base_url
+    import siliconflow_client
+    from cancellation import CancelScope
+    from rate_limiter import rate_limiters
+
+    scenarios = {
+        "取消后未读取": lambda stream, scope: scope.cancel(),
+        "读取一块后取消": lambda stream, scope: (next(stream), scope.cancel()),
+        "未读取即关闭": lambda stream, scope: stream.close(),
+    }
+    failures = 0
+    try:
+        for optimistic in (False, True):
+            for index, (name, action) in enumerate(scenarios.items()):
+                scope = CancelScope("check")
+                stream = siliconflow_client.invoke_llm(
+                    api_key="mock-key",
+                    model="mock-model",
+                    messages=[{"role": "user", "content": f"检查取消 #{index} {optimistic}"}],
+                    stream=True,
+                    user_inputs=[f"检查取消 #{index} {optimistic}"],
+                    optimistic_security_check=optimistic,
+                    cancel_scope=scope,
+                )
+                action(stream, scope)
+                flights, slots = leaked_resources(siliconflow_client, rate_limiters)
+                ok = (flights, slots) == (0, 0)
+                failures += not ok
+                print(f"{'通过' if ok else '失败'}: {name}（乐观安全检查: {optimistic}），"
+                      f"残留上游流 {flights}，未归还并发位置 {slots}")
+    finally:
+        server.shutdown()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
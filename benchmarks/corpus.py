@@ -0,0 +1,101 @@
+"""
+基准测试使用的固定语料：小、中、500 页的 PDF 与大型 PPTX。
+
+语料由固定种子确定性地生成并缓存在 benchmarks/corpus/ 中，不同提交之间的基准结果因此可以直接比较。
+修改生成逻辑时递增 CORPUS_VERSION，旧的缓存文件不再使用。
+PDF 由内置的最小 PDF 写入器生成（Helvetica 文本），不依赖额外的库。
+"""
+import os
+import random
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+CORPUS_VERSION = "1"
+
+# 名称: (类型, 页数/幻灯片数)
+CORPORA = {
+    "pdf_small": ("pdf", 5),
+    "pdf_medium": ("pdf", 50),
+    "pdf_500_pages": ("pdf", 500),
+    "pptx_large": ("pptx", 300),
+}
+
+LINES_PER_PAGE = 40
+_WORDS = (
+    "force mass acceleration velocity momentum energy work power pressure density temperature "
+    "heat current voltage resistance field wave frequency lens reflection refraction inertia "
+    "gravity friction torque equilibrium oscillation amplitude charge magnetic electric circuit"
+).split()
+
+
+def _sentences(rng, count):
+    for _ in range(count):
+        words = rng.choices(_WORDS, k=rng.randint(8, 14))
+        yield " ".join(words).capitalize() + "."
+
+
+def _escape_pdf_text(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, pages, seed):
+    """写入一个 pages 页、每页 LINES_PER_PAGE 行英文文本的 PDF。"""
+    rng = random.Random(seed)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # 页面树，在所有页面写完后填入
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_ids = []
+    for page_number in range(1, pages + 1):
+        lines = [f"Chapter {page_number}: {rng.choice(_WORDS)} and {rng.choice(_WORDS)}"]
+        lines.extend(_sentences(rng, LINES_PER_PAGE - 1))
+        content = "BT /F1 10 Tf 12 TL 50 770 Td " + " ".join(f"({_escape_pdf_text(line)}) '" for line in lines) + " ET"
+        content_bytes = content.encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content_bytes), content_bytes))
+        content_id = len(objects)
+        objects.append((
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>"
+        ).encode("ascii"))
+        page_ids.append(len(objects))
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode("ascii")
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for object_id, body in enumerate(objects, 1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n%s\nendobj\n" % (object_id, body)
+    xref_offset = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    output += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset)
+    with open(path, "wb") as f:
+        f.write(output)
+
+
+def write_pptx(path, slides, seed):
+    """写入一个 slides 张幻灯片、每张带标题与要点的 PPTX。"""
+    from pptx import Presentation
+
+    rng = random.Random(seed)
+    presentation = Presentation()
+    layout = presentation.slide_layouts[1]
+    for slide_number in range(1, slides + 1):
+        slide = presentation.slides.add_slide(layout)
+        slide.shapes.title.text = f"第{slide_number}节 {rng.choice(_WORDS)}"
+        slide.placeholders[1].text = "\n".join(_sentences(rng, 6))
+    presentation.save(path)
+
+
+def corpus_path(name):
+    """返回语料文件的路径，文件不存在时先生成。"""
+    kind, size = CORPORA[name]
+    path = os.path.join(CORPUS_DIR, f"{name}-v{CORPUS_VERSION}.{kind}")
+    if not os.path.exists(path):
+        os.makedirs(CORPUS_DIR, exist_ok=True)
+        temp_path = f"{path}.tmp"
+        writer = write_pdf if kind == "pdf" else write_pptx
+        writer(temp_path, size, seed=f"{name}-{CORPUS_VERSION}")
+        os.replace(temp_path, path)
+    return path
@@ -0,0 +1,191 @@
+"""
+离线压测 /api/process、/api/grade 与 /api/regenerate_question。
+
+在进程内通过 Flask 测试客户端并发发起请求，上游使用本地模拟服务器；指定 --cassette-dir 时
+模拟服务器回放 llm_cassette 录制的真实响应（--recorded-timing 按录制的时间间隔发送），
+从而以接近真实的时序进行压测。统计每个接口的首个事件延迟、总耗时、吞吐量与错误数。
+
+录制时用 --upstream 指向真实接口并设置 LLM_CASSETTE_MODE=record。提示词包含用户画像，
+录制与回放应从相同的 config.json 开始，否则请求的键不同，模拟服务器会退回模拟输出（计入 misses）。
+
+运行期间会在 uploads/ 中放入一份临时 PPTX 作为参考资料，并在结束后删除；config.json 在结束后恢复。
+
+用法:
+    python benchmarks/load_test.py --endpoints process grade regenerate --concurrency 8 --requests 32
+    LLM_CASSETTE_MODE=record python benchmarks/load_test.py --upstream https://api.siliconflow.cn/v1 \
+        --api-key sk-... --requests 4 --concurrency 1
+    python benchmarks/load_test.py --cassette-dir cassettes --recorded-timing --requests 4
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_llm_server import start_mock_server  # noqa: E402
+
+ENDPOINTS = ("process", "grade", "regenerate")
+MATERIAL_FILENAME = "load_test_material.pptx"
+
+QUESTIONS = [
+    {"question_type": "multiple_choice", "stem": f"第{i}题：关于牛顿运动定律，下列哪一项描述是正确的？",
+     "options": {"A": "选项A", "B": "选项B", "C": "选项C", "D": "选项D"}, "answer": "A", "score": 5}
+    for i in range(1, 5)
+] + [
+    {"question_type": "fill_in_the_blank", "stem": "物体保持原有运动状态的性质叫做___。", "answer": ["惯性"], "score": 5},
+    {"question_type": "short_answer", "stem": "请简述牛顿第一定律的内容及其意义。",
+     "answer": "一切物体在没有受到外力作用时，总保持静止或匀速直线运动状态。", "score": 10},
+]
+USER_ANSWERS = ["A", "B", "A", "C", "惯性", "物体会一直运动下去。"]
+
+
+def write_material(path):
+    from pptx import Presentation
+
+    presentation = Presentation()
+    for index in range(1, 6):
+        slide = presentation.slides.add_slide(presentation.slide_layouts[1])
+        slide.shapes.title.text = f"第{index}节 牛顿运动定律"
+        slide.placeholders[1].text = (
+            "一切物体在没有受到外力作用时，总保持静止或匀速直线运动状态。"
+            "物体加速度的大小跟作用力成正比，跟物体的质量成反比。"
+            "两个物体之间的作用力和反作用力总是大小相等，方向相反。"
+        )
+    presentation.save(path)
+
+
+def build_request(endpoint, index, api_key):
+    """第 index 个 POST 请求的 (路径, 测试客户端关键字参数)。请求内容由 index 确定，以便与录制对应。"""
+    if endpoint == "process":
+        return "/api/process", {"data": {
+            "api_key": api_key,
+            "user_input": f"请侧重考查基础概念 #{index}",
+            "choice_count": "3",
+            "blank_count": "1",
+            "short_count": "1",
+        }}
+    if endpoint == "grade":
+        answers = USER_ANSWERS[:-1] + [f"{USER_ANSWERS[-1]}（第{index}份答卷）"]
+        return "/api/grade", {"json": {"api_key": api_key, "questions": QUESTIONS, "answers": answers}}
+    return "/api/regenerate_question", {"json": {
+        "api_key": api_key,
+        "question": QUESTIONS[index % len(QUESTIONS)],
+        "action": ("regenerate", "increase_difficulty", "decrease_difficulty")[index % 3],
+        "user_requirement": f"换一个角度考查 #{index}",
+    }}
+
+
+def run_request(client, endpoint, index, api_key):
+    path, kwargs = build_request(endpoint, index, api_key)
+    started = time.perf_counter()
+    first_event = None
+    events = errors = 0
+    response = client.post(path, buffered=False, **kwargs)
+    if response.status_code != 200:
+        errors += 1
+    buffer = b""
+    for data in response.response:
+        if first_event is None and data.strip():
+            first_event = time.perf_counter() - started
+        buffer += data if isinstance(data, bytes) else data.encode("utf-8")
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if not line.strip():
+                continue
+            events += 1
+            try:
+                errors += json.loads(line).get("type") == "error"
+            except ValueError:
+                pass
+    response.close()
+    return {"first_event": first_event, "total": time.perf_counter() - started, "events": events, "errors": errors}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_endpoint(client, endpoint, requests, concurrency, api_key):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda index: run_request(client, endpoint, index, api_key), range(requests)))
+    wall = time.perf_counter() - started
+    totals = [r["total"] for r in results]
+    first_events = [r["first_event"] for r in results if r["first_event"] is not None]
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "wall_seconds": wall,
+        "throughput_rps": requests / wall if wall else None,
+        "first_event_p50": statistics.median(first_events) if first_events else None,
+        "first_event_p95": percentile(first_events, 0.95) if first_events else None,
+        "first_event_p99": percentile(first_events, 0.99) if first_events else None,
+        "total_p50": statistics.median(totals),
+        "total_p95": percentile(totals, 0.95),
+        "total_p99": percentile(totals, 0.99),
+        "events": sum(r["events"] for r in results),
+        "errors": sum(r["errors"] for r in results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument("--requests", type=int, default=16, help="每个接口的请求数")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--ttft", type=float, default=0.3, help="模拟服务器的首 token 延迟（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument("--cassette-dir", help="模拟服务器回放的录制目录")
+    parser.add_argument("--recorded-timing", action="store_true", help="按录制的时间偏移发送流式数据块")
+    parser.add_argument("--upstream", help="不启动模拟服务器，直接使用该接口地址（用于录制）")
+    parser.add_argument("--api-key", default=os.environ.get("SILICONFLOW_API_KEY", "mock-key"))
+    parser.add_argument("--output", help="将结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    server = None
+    if args.upstream:
+        os.environ["SILICONFLOW_API_BASE"] = args.upstream
+    else:
+        server, base_url = start_mock_server(ttft=args.ttft, tokens_per_second=args.tokens_per_second,
+                                             cassette_dir=args.cassette_dir, recorded_timing=args.recorded_timing)
+        os.environ["SILICONFLOW_API_BASE"] = base_url
+    os.chdir(ROOT)
+
+    from config_store import config_store
+    original_config = config_store.get()
+
+    import app
+
+    material_path = os.path.join(app.UPLOAD_FOLDER, MATERIAL_FILENAME)
+    os.makedirs(app.UPLOAD_FOLDER, exist_ok=True)
+    write_material(material_path)
+    client = app.app.test_client()
+    results = {"upstream": os.environ["SILICONFLOW_API_BASE"], "mock_ttft_seconds": None if args.upstream else args.ttft,
+               "cassette_dir": args.cassette_dir, "endpoints": {}}
+    try:
+        for endpoint in args.endpoints:
+            results["endpoints"][endpoint] = run_endpoint(client, endpoint, args.requests, args.concurrency, args.api_key)
+        results["metrics"] = client.get("/api/metrics").get_json()
+        if server is not None and server.RequestHandlerClass.cassette is not None:
+            results["mock_cassette"] = server.RequestHandlerClass.cassette.metrics()
+    finally:
+        os.remove(material_path)
+        config_store.replace(original_config)
+        if server is not None:
+            server.shutdown()
+
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
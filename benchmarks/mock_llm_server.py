@@ -0,0 +1,257 @@
+"""
+本地的 OpenAI 兼容模拟服务器，用于在没有 SiliconFlow API Key 的情况下离线压测与基准测试。
+
+支持 /v1/chat/completions 的流式（SSE）与非流式响应，可配置首 token 延迟与 token 速率。
+根据提示词内容返回安全检查结论、题目 JSON 流、批改 JSON 或纯文本总结。
+指定 --cassette-dir 时优先回放 llm_cassette 录制的真实响应（以请求参数为键），
+默认按配置的首 token 延迟与 token 速率发送录制的数据块，--recorded-timing 时按录制的时间偏移发送；
+没有匹配的录制时退回模拟输出。
+
+用法:
+    python benchmarks/mock_llm_server.py --port 8001 --ttft 0.5 --tokens-per-second 50
+    python benchmarks/mock_llm_server.py --port 8001 --cassette-dir cassettes --recorded-timing
+    SILICONFLOW_API_BASE=http://127.0.0.1:8001/v1 python app.py
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import argparse
+import random
+import itertools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_cassette import LLMCassette, cassette_key, chunk_content, take_text  # noqa: E402
+
+CHARS_PER_TOKEN = 4
+
+_TOPIC_CHARS = "力热光电磁声波能量动量质点速度加速度功率压强浮力密度温度比热电阻电压电流磁场透镜反射折射"
+
+
+def _topic(seed):
+    """由题目编号确定的伪随机知识点名称，使不同题目的题干互不相似。"""
+    return "".join(random.Random(str(seed)).choices(_TOPIC_CHARS, k=12))
+
+
+_QUESTION_TEMPLATES = {
+    "multiple_choice": lambda i: {
+        "question_type": "multiple_choice",
+        "stem": f"模拟选择题 {i}：关于{_topic(i)}，下列哪一项描述是正确的？",
+        "options": {"A": "选项A", "B": "选项B", "C": "选项C", "D": "选项D"},
+        "answer": "A",
+        "score": 5,
+    },
+    "fill_in_the_blank": lambda i: {
+        "question_type": "fill_in_the_blank",
+        "stem": f"模拟填空题 {i}：{_topic(i)}的主要场所是___。",
+        "answer": ["叶绿体"],
+        "score": 5,
+    },
+    "short_answer": lambda i: {
+        "question_type": "short_answer",
+        "stem": f"模拟简答题 {i}：请简述{_topic(i)}的核心思想。",
+        "answer": "参考答案要点。",
+        "score": 10,
+    },
+}
+_TYPE_NAMES = {"选择题": "multiple_choice", "填空题": "fill_in_the_blank", "简答题": "short_answer"}
+# 每次出题请求的编号，使不同请求生成的题干互不相同
+_request_counter = itertools.count(1)
+
+
+def build_reply(messages):
+    """根据请求的提示词内容构造一段模拟的模型输出。"""
+    system_text = "\n".join(m.get("content", "") for m in messages if m.get("role") == "system")
+    user_text = "\n".join(m.get("content", "") for m in messages if m.get("role") != "system")
+
+    if "内容安全审查员" in system_text:
+        return "unsafe\n模拟的不安全输入" if "MOCK_UNSAFE" in user_text else "safe"
+    if "grade a batch of student answers" in user_text:
+        indices = re.findall(r"question_index = (\d+)", user_text)
+        return "".join(json.dumps({"question_index": int(i), "score": 3, "feedback": f"模拟的批量批改评语 {i}。"},
+                                  ensure_ascii=False) for i in indices)
+    if "grade a student's answer" in user_text:
+        return json.dumps({"score": 3, "feedback": "模拟的批改评语：要点基本正确，但论述不够完整。"}, ensure_ascii=False)
+    if "profile_delta" in user_text:
+        return json.dumps({"replace": [], "remove": [], "append": ["模拟的画像补充：该生计算题失误较多。"]}, ensure_ascii=False)
+    if "答题情况总结" in user_text and "JSON" not in user_text:
+        return "模拟的答题总结：该生对基础概念掌握较好，计算题失误较多。"
+    if "用户画像" in user_text and "学习材料" not in user_text:
+        return "模拟的用户画像：该生概念理解扎实，计算能力有待提高。"
+
+    counts = {q_type: int(count) for name, q_type in _TYPE_NAMES.items()
+              for count in re.findall(rf"{name}(\d+)道", user_text)}
+    if not counts:
+        counts = {"multiple_choice": 1}
+    request_id = next(_request_counter)
+    questions = []
+    for q_type, count in counts.items():
+        questions.extend(_QUESTION_TEMPLATES[q_type](f"{request_id}-{i + 1}") for i in range(count))
+    return "".join(json.dumps(q, ensure_ascii=False) for q in questions)
+
+
+def split_tokens(text):
+    return [text[i:i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    ttft = 0.2
+    tokens_per_second = 100.0
+    reply_builder = staticmethod(build_reply)
+    # 回放模式的 LLMCassette，为 None 时只使用模拟输出
+    cassette = None
+    recorded_timing = False
+
+    def log_message(self, format, *args):
+        pass
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _schedule(self, body, messages):
+        """
+        本次响应的输出计划：(完整文本, [(相对开始的发送时间, 文本片段), ...])。
+        有匹配的录制时使用录制的输出，否则使用 reply_builder 的模拟输出。
+        """
+        take = self.cassette.next_take(cassette_key(body)) if self.cassette else None
+        if take is not None and self.recorded_timing and "chunks" in take:
+            pieces = [(offset, chunk_content(chunk)) for offset, chunk in take["chunks"]]
+            return take_text(take), [(offset, piece) for offset, piece in pieces if piece]
+        reply = take_text(take) if take is not None else self.reply_builder(messages)
+        interval = 1.0 / self.tokens_per_second
+        return reply, [(self.ttft + index * interval, token) for index, token in enumerate(split_tokens(reply))]
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        messages = body.get("messages", [])
+        model = body.get("model", "mock")
+        started = time.monotonic()
+        reply, schedule = self._schedule(body, messages)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        prompt_tokens = sum(len(m.get("content", "")) for m in messages) // CHARS_PER_TOKEN
+        completion_tokens = len(split_tokens(reply))
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+        def wait_until(offset):
+            delay = offset - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+        if not body.get("stream"):
+            wait_until(schedule[-1][0] if schedule else self.ttft)
+            payload = json.dumps({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                "usage": usage,
+            }, ensure_ascii=False).encode("utf-8")
+            try:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+            except (BrokenPipeError, ConnectionResetError):
+                # 客户端已超时或取消请求
+                pass
+            return
+
+        wait_until(schedule[0][0] if schedule else self.ttft)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for offset, token in schedule:
+                wait_until(offset)
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                }
+                self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            final_chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+            self._write_chunk(f"data: {json.dumps(final_chunk)}\n\n".encode("utf-8"))
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def _ignore_disconnects(server, request, client_address):
+    """客户端提前断开（例如取消请求时关闭连接）不是错误，其余异常照常输出。"""
+    if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+        ThreadingHTTPServer.handle_error(server, request, client_address)
+
+
+def start_mock_server(host="127.0.0.1", port=0, ttft=0.2, tokens_per_second=100.0,
+                      cassette_dir=None, recorded_timing=False):
+    """
+    在后台线程中启动模拟服务器。
+
+    :param cassette_dir: llm_cassette 的录制目录，指定时优先回放录制的响应。
+    :param recorded_timing: 是否按录制的时间偏移发送流式数据块。
+    :return: (server, base_url)，调用 server.shutdown() 停止。
+    """
+    handler = type("ConfiguredMockLLMHandler", (MockLLMHandler,), {
+        "ttft": ttft,
+        "tokens_per_second": tokens_per_second,
+        "cassette": LLMCassette(cassette_dir, mode="replay") if cassette_dir else None,
+        "recorded_timing": recorded_timing,
+    })
+    server_class = type("MockLLMServer", (ThreadingHTTPServer,), {
+        # 并发压测时同时建立的连接可能有数百个，加大监听队列以免连接被拒绝
+        "request_queue_size": 1024,
+        "handle_error": _ignore_disconnects,
+    })
+    server = server_class((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容模拟服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--ttft", type=float, default=0.2, help="首 token 延迟（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument("--cassette-dir", help="回放 llm_cassette 录制的响应")
+    parser.add_argument("--recorded-timing", action="store_true", help="按录制的时间偏移发送流式数据块")
+    args = parser.parse_args()
+
+    server, base_url = start_mock_server(args.host, args.port, args.ttft, args.tokens_per_second,
+                                         args.cassette_dir, args.recorded_timing)
+    print(f"Mock LLM server listening on {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,101 @@
+import time
+import logging
+import threading
+from metrics import REQUESTS_CANCELLED
+
+logger = logging.getLogger(__name__)
+
+CLIENT_DISCONNECTED = "client_disconnected"
+DEADLINE_EXCEEDED = "deadline_exceeded"
+DEFAULT_REQUEST_DEADLINE = 600
+
+
+class RequestCancelled(Exception):
+    """请求已被取消（客户端断开或超出截止时间），后续的上游调用不再进行。"""
+
+    def __init__(self, reason: str = CLIENT_DISCONNECTED):
+        super().__init__("请求已超出时间限制" if reason == DEADLINE_EXCEEDED else "请求已被取消")
+        self.reason = reason
+
+
+class DeadlineExceeded(RequestCancelled):
+    def __init__(self):
+        super().__init__(DEADLINE_EXCEEDED)
+
+
+class CancelScope:
+    """
+    一次请求的取消范围：客户端断开时由响应流调用 cancel()，到达截止时间后自动视为已取消。
+
+    上游流通过 add_callback 登记关闭函数，取消时被依次调用；各处的上游调用在发起前与
+    每读取一个数据块前检查 cancelled，并以 remaining() 作为超时上限。
+
+    :param operation: 请求类型，用于取消计数的标签。
+    :param timeout: 截止时间（秒，自创建时起），为 None 时不设截止时间。
+    """
+
+    def __init__(self, operation: str, timeout: float = None):
+        self.operation = operation
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.reason = None
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def cancel(self, reason: str = CLIENT_DISCONNECTED) -> bool:
+        """取消请求并调用已登记的回调。重复取消时不做任何事，返回 False。"""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        REQUESTS_CANCELLED.inc(operation=self.operation, reason=reason)
+        logger.info(f"请求已取消. 类型: {self.operation}, 原因: {reason}, 待关闭的上游流: {len(callbacks)}")
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"取消请求时关闭上游流失败: {e}")
+        return True
+
+    @property
+    def cancelled(self) -> bool:
+        if not self._event.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel(DEADLINE_EXCEEDED)
+        return self._event.is_set()
+
+    def remaining(self):
+        """距截止时间的秒数，没有截止时间时返回 None。"""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def error(self) -> RequestCancelled:
+        """与取消原因对应的异常。"""
+        return DeadlineExceeded() if self.reason == DEADLINE_EXCEEDED else RequestCancelled(self.reason)
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise self.error()
+
+    def wait(self, seconds: float) -> bool:
+        """最多等待 seconds 秒，期间被取消时提前返回。返回是否已取消。"""
+        remaining = self.remaining()
+        if remaining is not None and remaining <= seconds:
+            self._event.wait(remaining)
+            return self.cancelled
+        return self._event.wait(seconds)
+
+    def add_callback(self, callback):
+        """登记取消时调用的函数。已经取消时立即调用。"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
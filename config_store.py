@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FILE = "config.json"
+DEFAULT_PROFILE = "该用户暂无画像，请根据本次答题情况生成一份初始画像。"
+DEFAULT_CONFIG = {
+    "temperature": 1.0,
+    "enhanced_structured_output": False,
+    "user_profile": DEFAULT_PROFILE,
+    "user_profile_enabled": True,
+}
+# 两次检查配置文件修改时间之间的最小间隔（秒）
+RELOAD_CHECK_INTERVAL = 1.0
+
+
+class ConfigStore:
+    """
+    进程内共享的配置服务。
+
+    读取返回内存快照的副本，不加锁也不访问磁盘；更新以写时复制的方式生成新快照，
+    并通过临时文件+重命名原子地写回磁盘，避免读者看到写了一半的文件。
+    文件在外部被修改时，按修改时间自动重新加载。
+    """
+
+    def __init__(self, path: str = CONFIG_FILE, defaults: dict = None,
+                 reload_interval: float = RELOAD_CHECK_INTERVAL):
+        self.path = path
+        self.defaults = dict(defaults or DEFAULT_CONFIG)
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._snapshot = dict(self.defaults)
+        self._mtime = None
+        self._last_check = 0.0
+        self._load()
+
+    def _current_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load(self):
+        with self._lock:
+            mtime = self._current_mtime()
+            if mtime is None:
+                logger.info(f"配置文件不存在，创建默认配置文件: {self.path}")
+                self._persist(dict(self.defaults))
+                return
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    loaded_config = json.load(f)
+            except (json.JSONDecodeError, OSError) as e:
+                # 保留上一次成功加载的快照，而不是把损坏的文件内容暴露给读者
+                logger.error(f"加载配置文件失败: {self.path}, {e}")
+                self._mtime = mtime
+                return
+            config = dict(self.defaults)
+            config.update(loaded_config)
+            self._snapshot = config
+            self._mtime = mtime
+            logger.info(f"已加载配置文件: {self.path}")
+
+    def _persist(self, config: dict):
+        """原子地写入配置文件并替换内存快照。调用方需持有锁。"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        tmp_path = os.path.join(directory, f".{os.path.basename(self.path)}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(config, f, indent=4, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._snapshot = config
+        self._mtime = self._current_mtime()
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._last_check < self.reload_interval:
+            return
+        self._last_check = now
+        if self._current_mtime() != self._mtime:
+            self._load()
+
+    def get(self) -> dict:
+        """返回当前配置快照的副本。"""
+        self._maybe_reload()
+        return dict(self._snapshot)
+
+    def update(self, changes: dict) -> dict:
+        """
+        在当前快照的基础上合并 changes 并持久化。
+
+        :return: 更新后的配置副本。
+        """
+        with self._lock:
+            config = dict(self._snapshot)
+            config.update(changes)
+            self._persist(config)
+            logger.info(f"保存配置文件: {self.path}, 更新字段: {list(changes)}")
+            return dict(config)
+
+    def replace(self, config_data: dict) -> dict:
+        """用完整的配置字典替换当前配置并持久化。"""
+        with self._lock:
+            config = dict(self.defaults)
+            config.update(config_data)
+            self._persist(config)
+            logger.info(f"保存配置文件: {self.path}")
+            return dict(config)
+
+
+config_store = ConfigStore()
@@ -0,0 +1,198 @@
+import os
+import hashlib
+import logging
+import threading
+import pdfplumber
+import pptx
+
+logger = logging.getLogger(__name__)
+
+# 提取逻辑发生变化时递增此版本号，旧版本的缓存条目将不再命中
+EXTRACTOR_VERSION = "1"
+CACHE_DIR = os.path.join("cache", "extraction")
+
+_hash_index = {}
+_hash_index_lock = threading.Lock()
+
+
+class DocumentReadError(Exception):
+    """读取或解析某个上传文件失败时抛出。"""
+    def __init__(self, filename, original):
+        super().__init__(f"读取文件 '{filename}' 时出错: {str(original)}")
+        self.filename = filename
+        self.original = original
+
+
+def file_content_hash(file_path: str) -> str:
+    """
+    计算文件内容的SHA-256哈希。
+    以 (路径, mtime, 大小) 为键在内存中记忆结果，未修改的文件不会被重复读取。
+    """
+    stat = os.stat(file_path)
+    index_key = os.path.abspath(file_path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+
+    with _hash_index_lock:
+        cached = _hash_index.get(index_key)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    content_hash = digest.hexdigest()
+
+    with _hash_index_lock:
+        _hash_index[index_key] = (signature, content_hash)
+    return content_hash
+
+
+def count_units(file_path: str) -> int:
+    """返回文档可拆分的单元数量：PDF 为页数，PPTX 为幻灯片数，其它文件为 1。"""
+    file_ext = os.path.splitext(file_path)[1].lower()
+    if file_ext == ".pdf":
+        with pdfplumber.open(file_path) as pdf:
+            return len(pdf.pages)
+    elif file_ext in [".pptx", ".ppt"]:
+        return len(pptx.Presentation(file_path).slides)
+    return 1
+
+
+def extract_pdf_pages(file_path: str, start: int = 0, end: int = None) -> str:
+    """提取 PDF 中 [start, end) 范围内页面的文本，每页只调用一次 extract_text。"""
+    all_text = []
+    with pdfplumber.open(file_path) as pdf:
+        for page in pdf.pages[start:end]:
+            page_text = page.extract_text()
+            if page_text:
+                all_text.append(page_text)
+    return "\n".join(all_text)
+
+
+def extract_pptx_slides(file_path: str, start: int = 0, end: int = None) -> str:
+    """提取 PPTX 中 [start, end) 范围内幻灯片的文本。"""
+    pres = pptx.Presentation(file_path)
+    slides = list(pres.slides)[start:end]
+    all_text = [shape.text for slide in slides for shape in slide.shapes if hasattr(shape, "text")]
+    return "\n".join(all_text)
+
+
+def extract_range(file_path: str, start: int = 0, end: int = None) -> str:
+    """按文件类型提取指定单元范围的文本；纯文本文件忽略范围参数。"""
+    file_ext = os.path.splitext(file_path)[1].lower()
+    if file_ext == ".pdf":
+        return extract_pdf_pages(file_path, start, end)
+    elif file_ext in [".pptx", ".ppt"]:
+        return extract_pptx_slides(file_path, start, end)
+    else:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return f.read()
+
+
+def extract_text(file_path: str) -> str:
+    """直接从 PDF / PPTX / TXT 文件中提取纯文本，不经过缓存。"""
+    return extract_range(file_path)
+
+
+def _cache_path(content_hash: str) -> str:
+    return os.path.join(CACHE_DIR, f"{content_hash}-v{EXTRACTOR_VERSION}.txt")
+
+
+def read_cached_text(content_hash: str):
+    """按内容哈希读取缓存的提取结果，未命中时返回 None。"""
+    try:
+        with open(_cache_path(content_hash), "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_cached_text(content_hash: str, text: str):
+    """以临时文件+重命名的方式原子地写入缓存条目。"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    cache_path = _cache_path(content_hash)
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, cache_path)
+
+
+def get_document_text(file_path: str) -> str:
+    """
+    获取文档的纯文本内容，优先使用按内容哈希和提取器版本寻址的持久化缓存。
+
+    :param file_path: 文档路径。
+    :return: 提取出的文本。
+    """
+    content_hash = file_content_hash(file_path)
+    text = read_cached_text(content_hash)
+    if text is not None:
+        logger.info(f"提取缓存命中: {os.path.basename(file_path)} ({content_hash[:12]})")
+        return text
+
+    logger.info(f"提取缓存未命中，开始解析文件: {os.path.basename(file_path)}")
+    text = extract_text(file_path)
+    write_cached_text(content_hash, text)
+    return text
+
+
+def evict_document(file_path: str, remaining_paths=None):
+    """
+    删除某个文件对应的缓存条目（包括所有提取器版本）。
+    如果其它仍在使用的文件内容相同，则保留缓存。
+
+    :param file_path: 即将被删除的文件路径。
+    :param remaining_paths: 删除后仍然保留的文件路径列表。
+    """
+    try:
+        content_hash = file_content_hash(file_path)
+    except FileNotFoundError:
+        return
+
+    with _hash_index_lock:
+        _hash_index.pop(os.path.abspath(file_path), None)
+
+    for other_path in remaining_paths or []:
+        try:
+            if file_content_hash(other_path) == content_hash:
+                logger.info(f"其它文件仍引用相同内容，保留提取缓存: {content_hash[:12]}")
+                return
+        except FileNotFoundError:
+            continue
+
+    if not os.path.isdir(CACHE_DIR):
+        return
+    for entry in os.listdir(CACHE_DIR):
+        if entry.startswith(f"{content_hash}-"):
+            try:
+                os.remove(os.path.join(CACHE_DIR, entry))
+                logger.info(f"已清除提取缓存: {entry}")
+            except OSError as e:
+                logger.warning(f"清除提取缓存失败: {entry}, {e}")
+
+
+def load_documents(upload_folder: str, filenames, get_text=None):
+    """
+    读取多个上传文件的文本。
+    读取失败时抛出 DocumentReadError，其中包含出错的文件名。
+
+    :param get_text: 获取单个文件文本的函数，默认为 get_document_text。
+    :return: (文件名, 内容哈希, 文本) 列表。
+    """
+    get_text = get_text or get_document_text
+    documents = []
+    for filename in filenames:
+        file_path = os.path.join(upload_folder, filename)
+        try:
+            content = get_text(file_path)
+            content_hash = file_content_hash(file_path)
+        except Exception as e:
+            raise DocumentReadError(filename, e) from e
+        documents.append((filename, content_hash, content))
+    return documents
+
+
+def format_documents(documents) -> str:
+    """将 load_documents 的结果聚合为一个带来源标记的字符串。"""
+    return "\n\n".join(f"--- 来自文件: {filename} ---\n{content}" for filename, _, content in documents)
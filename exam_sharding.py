@@ -0,0 +1,170 @@
+import queue
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from openai import AuthenticationError
+from question_types import Question, question_fingerprint
+from cancellation import RequestCancelled
+
+logger = logging.getLogger(__name__)
+
+# 前端表单中的题型名称与题目 JSON 中 question_type 的对应关系
+QUESTION_TYPE_KEYS = {
+    "选择题": "multiple_choice",
+    "填空题": "fill_in_the_blank",
+    "简答题": "short_answer",
+}
+DEFAULT_SHARD_SIZE = 5
+DEFAULT_TOP_UP_ROUNDS = 2
+
+
+def plan_shards(question_settings: dict, mode: str = "by_type", shard_size: int = DEFAULT_SHARD_SIZE):
+    """
+    将题型设置拆分为可以独立生成的子请求。
+
+    :param question_settings: 形如 {"选择题": {"count": "20", "score": "5"}, ...} 的题型设置。
+    :param mode: 'by_type' 每种题型一个子请求；'by_count' 每个子请求最多 shard_size 道题。
+    :param shard_size: 'by_count' 模式下每个子请求的题目数。
+    :return: 子请求列表，每项与 question_settings 结构相同，只包含本子请求负责的题型与数量。
+    """
+    shards = []
+    for name, setting in question_settings.items():
+        count = int(setting["count"])
+        step = count if mode == "by_type" else max(shard_size, 1)
+        for offset in range(0, count, max(step, 1)):
+            shards.append({name: {"count": str(min(step, count - offset)), "score": setting["score"]}})
+    return shards
+
+
+def _requested_counts(shards):
+    counts = {}
+    for shard in shards:
+        for name, setting in shard.items():
+            q_type = QUESTION_TYPE_KEYS[name]
+            counts[q_type] = counts.get(q_type, 0) + int(setting["count"])
+    return counts
+
+
+def _is_fatal(error):
+    """API Key 无效、输入未通过安全检查或请求已被取消时，重试其它分片也没有意义。"""
+    return isinstance(error, (AuthenticationError, RequestCancelled)) or (
+        isinstance(error, ValueError) and "输入内容被判定为不安全" in str(error)
+    )
+
+
+def _run_shards(shards, run_shard, max_concurrency, avoid_stems, top_up):
+    """并发执行各分片，按到达顺序产出 (分片序号, 题目数据 或 异常)。"""
+    events = queue.Queue()
+
+    def run(index):
+        try:
+            position = None if top_up else (index + 1, len(shards))
+            for event in run_shard(shards[index], position, avoid_stems):
+                if event["type"] == "end":
+                    events.put((index, event["data"]))
+        except Exception as e:
+            events.put((index, e))
+        finally:
+            events.put((index, None))
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(shards))),
+                                  thread_name_prefix="exam-shard")
+    try:
+        for index in range(len(shards)):
+            executor.submit(run, index)
+        remaining = len(shards)
+        while remaining:
+            index, item = events.get()
+            if item is None:
+                remaining -= 1
+            else:
+                yield index, item
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def generate_sharded_stream(shards, run_shard, max_concurrency: int = 4,
+                            max_top_up_rounds: int = DEFAULT_TOP_UP_ROUNDS, existing_questions=()):
+    """
+    并发生成各分片的题目，去重并按请求数量截断后合并为一个事件流。
+
+    各分片的题目只在完整解析后以 'start' + 'end' 事件成对输出，避免不同分片的
+    'streaming' 片段交错写入前端的同一张题目卡片。分片失败或去重后数量不足时，
+    为缺少的题型追加补题请求，最多 max_top_up_rounds 轮。
+
+    :param shards: plan_shards 返回的子请求列表。
+    :param run_shard: 函数 (shard, position, avoid_stems) -> stream_json_with_events 事件生成器。
+                      position 为首轮分片的 (序号, 总数)，补题时为 None；
+                      avoid_stems 为已生成的题干列表，补题时用于提示模型避免重复。
+    :param max_concurrency: 同时执行的最大分片数。
+    :param max_top_up_rounds: 补题的最大轮数。
+    :param existing_questions: 已经输出的题目（例如取自题库的题目），新生成的题目不得与其重复。
+    :return: 事件字典生成器。API Key 无效、安全检查失败或请求被取消时直接抛出对应异常；
+             补题后数量仍不足时最后产出一个 error 事件，给出各题型的请求数与实际数，
+             一道题也没有生成时抛出最后一个分片的异常。
+    """
+    requested = _requested_counts(shards)
+    type_settings = {
+        QUESTION_TYPE_KEYS[name]: (name, setting["score"]) for shard in shards for name, setting in shard.items()
+    }
+    accepted = {q_type: 0 for q_type in requested}
+    fingerprints = {question_fingerprint(question) for question in existing_questions}
+    stems = [question["stem"] for question in existing_questions]
+    duplicates = 0
+    last_error = None
+
+    for round_index in range(max_top_up_rounds + 1):
+        if round_index:
+            shards = [
+                {name: {"count": str(requested[q_type] - accepted[q_type]), "score": score}}
+                for q_type, (name, score) in type_settings.items()
+                if accepted[q_type] < requested[q_type]
+            ]
+            if not shards:
+                break
+            logger.info(f"分片生成第 {round_index} 轮补题: {shards}")
+
+        for index, item in _run_shards(shards, run_shard, max_concurrency, list(stems), round_index > 0):
+            if isinstance(item, Exception):
+                if _is_fatal(item):
+                    raise item
+                logger.warning(f"分片 {index} 生成失败: {item}")
+                last_error = item
+                continue
+            try:
+                question = Question.from_dict(item).to_dict()
+            except (ValueError, KeyError) as e:
+                logger.warning(f"Skipping invalid question object: {e}, data: {item}")
+                continue
+            q_type = question["question_type"]
+            if accepted.get(q_type, 0) >= requested.get(q_type, 0):
+                logger.info(f"丢弃超出请求数量的题目, 类型: {q_type}")
+                continue
+            fingerprint = question_fingerprint(question)
+            if fingerprint in fingerprints:
+                duplicates += 1
+                continue
+            fingerprints.add(fingerprint)
+            stems.append(question["stem"])
+            accepted[q_type] += 1
+            yield {"type": "start"}
+            yield {"type": "end", "data": question}
+
+        if accepted == requested:
+            break
+
+    logger.info(f"分片生成完成. 请求: {requested}, 实际: {accepted}, 去重丢弃: {duplicates}")
+    if accepted != requested:
+        logger.warning(f"分片生成在补题后仍未达到请求数量. 请求: {requested}, 实际: {accepted}")
+        if not any(accepted.values()) and last_error is not None:
+            raise last_error
+        shortfall = "，".join(
+            f"{name}请求{requested[q_type]}道、实际{accepted[q_type]}道"
+            for q_type, (name, _) in type_settings.items() if accepted[q_type] < requested[q_type]
+        )
+        yield {
+            "type": "error",
+            "error": f"部分题目未能生成：{shortfall}。",
+            "error_type": "generation",
+            "requested": requested,
+            "accepted": accepted,
+        }
@@ -0,0 +1,193 @@
+import os
+import logging
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import document_extractor
+
+logger = logging.getLogger(__name__)
+
+PDF_PAGES_PER_JOB = 16
+PPTX_SLIDES_PER_JOB = 40
+
+
+class ExtractionJob:
+    """一个文件的后台提取任务，由若干按页/按幻灯片划分的子任务组成。"""
+
+    def __init__(self, file_path, content_hash, total_parts):
+        self.file_path = file_path
+        self.filename = os.path.basename(file_path)
+        self.content_hash = content_hash
+        self.total_parts = total_parts
+        self.completed_parts = 0
+        self.parts = [None] * total_parts
+        self.part_futures = []
+        self.result = Future()
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+
+class ExtractionPipeline:
+    def __init__(self, max_workers=None, on_progress=None, on_complete=None):
+        """
+        上传后立即在有界进程池中预提取文档文本。
+
+        :param max_workers: 进程池大小，默认为 CPU 核心数。
+        :param on_progress: 进度回调，参数为包含 file/status/completed/total 的字典。
+        :param on_complete: 提取完成回调，参数为 (内容哈希, 文本)，例如用于构建检索索引。
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.on_progress = on_progress
+        self.on_complete = on_complete
+        self._executor = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def _complete(self, job, text):
+        if not self.on_complete:
+            return
+        try:
+            self.on_complete(job.content_hash, text)
+        except Exception as e:
+            logger.warning(f"提取完成回调执行失败: {job.filename}, {e}")
+
+    def _emit(self, job, status, error=None):
+        if not self.on_progress:
+            return
+        payload = {
+            "file": job.filename,
+            "status": status,
+            "completed": job.completed_parts,
+            "total": job.total_parts,
+        }
+        if error:
+            payload["error"] = error
+        try:
+            self.on_progress(payload)
+        except Exception as e:
+            logger.warning(f"推送提取进度失败: {e}")
+
+    def _split(self, file_path):
+        file_ext = os.path.splitext(file_path)[1].lower()
+        if file_ext == ".pdf":
+            per_job = PDF_PAGES_PER_JOB
+        elif file_ext in [".pptx", ".ppt"]:
+            per_job = PPTX_SLIDES_PER_JOB
+        else:
+            return [(0, None)]
+        total_units = document_extractor.count_units(file_path)
+        if total_units == 0:
+            return [(0, None)]
+        return [(start, min(start + per_job, total_units)) for start in range(0, total_units, per_job)]
+
+    def submit(self, file_path):
+        """
+        为文件提交后台提取任务。内容已在缓存中或已有相同内容的任务在进行时直接复用。
+
+        :return: 对应的 ExtractionJob。
+        """
+        content_hash = document_extractor.file_content_hash(file_path)
+        with self._lock:
+            existing = self._jobs.get(content_hash)
+            if existing and not existing.cancelled:
+                return existing
+
+        cached_text = document_extractor.read_cached_text(content_hash)
+        if cached_text is not None:
+            job = ExtractionJob(file_path, content_hash, 0)
+            job.result.set_result(cached_text)
+            self._complete(job, cached_text)
+            self._emit(job, "done")
+            return job
+
+        ranges = self._split(file_path)
+        job = ExtractionJob(file_path, content_hash, len(ranges))
+        with self._lock:
+            self._jobs[content_hash] = job
+        logger.info(f"提交后台提取任务: {job.filename}, 子任务数: {len(ranges)}")
+        self._emit(job, "running")
+
+        executor = self._get_executor()
+        for part_index, (start, end) in enumerate(ranges):
+            future = executor.submit(document_extractor.extract_range, file_path, start, end)
+            job.part_futures.append(future)
+            future.add_done_callback(lambda f, i=part_index: self._on_part_done(job, i, f))
+        return job
+
+    def _on_part_done(self, job, part_index, future):
+        if job.cancelled or job.result.done():
+            return
+        try:
+            part_text = future.result()
+        except Exception as e:
+            logger.error(f"后台提取失败: {job.filename}, {e}")
+            with job.lock:
+                if job.result.done():
+                    return
+                job.result.set_exception(e)
+            self._finish(job)
+            self._emit(job, "error", str(e))
+            return
+
+        with job.lock:
+            job.parts[part_index] = part_text
+            job.completed_parts += 1
+            finished = job.completed_parts == job.total_parts
+        if not finished:
+            self._emit(job, "running")
+            return
+
+        text = "\n".join(part for part in job.parts if part)
+        with job.lock:
+            if job.cancelled or job.result.done():
+                return
+            document_extractor.write_cached_text(job.content_hash, text)
+            job.result.set_result(text)
+        self._finish(job)
+        logger.info(f"后台提取完成: {job.filename}, 长度: {len(text)}")
+        self._complete(job, text)
+        self._emit(job, "done")
+
+    def _finish(self, job):
+        with self._lock:
+            if self._jobs.get(job.content_hash) is job:
+                del self._jobs[job.content_hash]
+
+    def cancel(self, file_path):
+        """取消文件对应的未完成任务，已完成的结果不再写入缓存。"""
+        try:
+            content_hash = document_extractor.file_content_hash(file_path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            job = self._jobs.pop(content_hash, None)
+        if job:
+            with job.lock:
+                job.cancelled = True
+                if not job.result.done():
+                    job.result.cancel()
+            # 在锁外取消子任务：取消会同步调用 _on_part_done，其中需要获取 job.lock
+            for future in job.part_futures:
+                future.cancel()
+
+    def get_text(self, file_path):
+        """获取文件文本：如有进行中的后台任务则等待其完成，否则走同步的缓存提取路径。"""
+        content_hash = document_extractor.file_content_hash(file_path)
+        with self._lock:
+            job = self._jobs.get(content_hash)
+        if job and not job.cancelled:
+            return job.result.result()
+        return document_extractor.get_document_text(file_path)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor:
+            executor.shutdown(wait=wait, cancel_futures=True)
@@ -1,12 +1,36 @@
 import json
+import time
+import math
+import queue
+import asyncio
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from openai import AuthenticationError
 import prompt_manager
 import siliconflow_client
-from llm_json_parser import stream_json_with_events
+from llm_json_parser import stream_json_with_events, astream_json_with_events
+from metrics import Trace, timed_parse, atimed_parse
+from cancellation import CancelScope
 import logging
 
 logger = logging.getLogger(__name__)
 
+GRADING_MODEL = "Qwen/Qwen2.5-72B-Instruct"
+
+
+def _is_grading_result(data):
+    """检查批改结果对象是否符合 grading_prompt_formatting 中的格式：数字 score 与非空 feedback。"""
+    score = data.get("score")
+    return (isinstance(score, (int, float)) and not isinstance(score, bool)
+            and isinstance(data.get("feedback"), str) and bool(data["feedback"].strip()))
+
+
+def _is_batch_grading_result(data):
+    """在单题批改格式的基础上，要求带有整数 question_index。"""
+    index = data.get("question_index")
+    return isinstance(index, int) and not isinstance(index, bool) and _is_grading_result(data)
+
+
 def _get_grading_prompt(question, user_answer, is_correct=None):
     """
     准备用于批改的提示词，手动将复杂数据转换为JSON字符串以避免Jinja2版本问题。
@@ -28,96 +52,528 @@ def _get_grading_prompt(question, user_answer, is_correct=None):
     return prompt_manager.get_prompt("grading_prompt", **prompt_context)
 
 
-def grade_exam_stream(questions, user_answers, api_key, temperature=0.7, enhanced_structured_output: bool = False):
+def _get_batch_grading_prompt(batch, user_answers):
+    """
+    准备批量批改的提示词，题目数据同样预先转换为JSON字符串。
+
+    :param batch: (题目索引, 题目) 列表。
+    """
+    items = []
+    for i, question in batch:
+        user_answer = user_answers[i]
+        item = {
+            "question_index": i,
+            "question_type": question.get("question_type"),
+            "stem": question.get("stem"),
+            "answer": json.dumps(question.get("answer"), ensure_ascii=False),
+            "score": question.get("score", 0),
+            "user_answer": json.dumps(user_answer, ensure_ascii=False),
+        }
+        if question.get("question_type") == "multiple_choice":
+            item["options"] = json.dumps(question.get("options"), ensure_ascii=False)
+            item["is_correct"] = user_answer == question.get("answer")
+        items.append(item)
+
+    formatting_instructions = prompt_manager.get_prompt("batch_grading_prompt_formatting")
+    return prompt_manager.get_prompt("batch_grading_prompt", questions=items, formatting_instructions=formatting_instructions)
+
+
+def _local_result_stream(i, score, feedback):
+    """不调用LLM，直接输出本地判定的批改结果。"""
+    yield json.dumps({"type": "start", "question_index": i}) + "\n"
+    yield json.dumps({"type": "end", "question_index": i, "data": {"score": score, "feedback": feedback}}) + "\n"
+
+
+def _error_line(i, error):
+    return json.dumps({"type": "error", "question_index": i, "error": error}) + "\n"
+
+
+def _grading_error_message(error):
+    if isinstance(error, AuthenticationError):
+        return "API Key 无效或已过期。"
+    return f"批改过程中发生错误: {str(error)}"
+
+
+def _grading_llm_kwargs(prompt, user_answer_json, api_key, temperature, enhanced_structured_output,
+                        formatting_prompt, output_validator, optimistic_security_check, trace, cancel_scope):
+    """批改单元调用 invoke_llm / ainvoke_llm 的参数。"""
+    return dict(
+        api_key=api_key,
+        model=GRADING_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        stream=True,
+        temperature=temperature,
+        enhanced_structured_output=enhanced_structured_output,
+        formatting_prompt=formatting_prompt,
+        output_validator=output_validator,
+        user_inputs=[user_answer_json],
+        optimistic_security_check=optimistic_security_check,
+        trace=trace,
+        cancel_scope=cancel_scope,
+    )
+
+
+def _clamp_score(score, full_score):
+    """把模型给出的分数限制在 [0, 满分] 内，两者都可以是数字字符串；无法识别时返回 None。"""
+    try:
+        score, full_score = float(score), float(full_score)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(score) or math.isnan(full_score):
+        return None
+    score = max(0.0, min(score, full_score))
+    return int(score) if score.is_integer() else score
+
+
+class _BatchGrading:
+    """
+    一个批量批改单元：把解析出的每个结果按 question_index 映射回本批次的题目。
+    选择题的分数始终以本地判分为准，缺失的结果以 error 事件补齐。
+    """
+
+    def __init__(self, batch, user_answers):
+        self.indices = [i for i, _ in batch]
+        self.batch = batch
+        self.user_answers = user_answers
+        self.questions_by_index = dict(batch)
+        self.pending = set(self.indices)
+
+    def start_lines(self):
+        return [json.dumps({"type": "start", "question_index": i}) + "\n" for i in self.indices]
+
+    def llm_kwargs(self, api_key, temperature, enhanced_structured_output, optimistic_security_check,
+                   trace, cancel_scope):
+        prompt = _get_batch_grading_prompt(self.batch, self.user_answers)
+        formatting_prompt = None
+        if enhanced_structured_output:
+            formatting_prompt = prompt_manager.get_prompt("batch_grading_prompt_formatting")
+        answers = json.dumps([self.user_answers[i] for i in self.indices], ensure_ascii=False)
+        return _grading_llm_kwargs(prompt, answers, api_key, temperature, enhanced_structured_output,
+                                   formatting_prompt, _is_batch_grading_result, optimistic_security_check,
+                                   trace, cancel_scope)
+
+    def result_line(self, event):
+        """把一个解析事件映射为对应题目的 end 事件（分数无法识别时为 error 事件），无法对应到本批次待批改题目时返回 None。"""
+        if event["type"] != "end":
+            return None
+        data = event["data"]
+        try:
+            i = int(data.pop("question_index"))
+        except (KeyError, TypeError, ValueError):
+            logger.warning(f"批量批改结果缺少有效的 question_index: {data}")
+            return None
+        if i not in self.pending:
+            logger.warning(f"批量批改结果的 question_index 不属于本批次或重复: {i}")
+            return None
+
+        question = self.questions_by_index[i]
+        full_score = question.get("score", 0)
+        self.pending.discard(i)
+        if question.get("question_type") == "multiple_choice":
+            data["score"] = full_score if self.user_answers[i] == question.get("answer") else 0
+        else:
+            score = _clamp_score(data.get("score", 0), full_score)
+            if score is None:
+                logger.warning(f"第 {i+1} 题的批量批改分数无法识别. 得分: {data.get('score')!r}, 满分: {full_score!r}")
+                return _error_line(i, "批量批改返回的分数无法识别。")
+            data["score"] = score
+        return json.dumps({"type": "end", "question_index": i, "data": data}) + "\n"
+
+    def error_lines(self, error):
+        return [_error_line(i, error) for i in sorted(self.pending)]
+
+
+def _grade_batch_stream(batch, user_answers, api_key, temperature, enhanced_structured_output,
+                        optimistic_security_check, trace, cancel_scope=None):
+    """
+    用一次LLM调用批改一批选择题/填空题，并把解析出的每个结果按 question_index 映射回对应题目。
+    选择题的分数始终以本地判分为准，缺失的结果以 error 事件补齐。
+    """
+    started = time.perf_counter()
+    try:
+        yield from _grade_batch_events(batch, user_answers, api_key, temperature, enhanced_structured_output,
+                                       optimistic_security_check, trace, cancel_scope)
+    finally:
+        trace.record("grade_batch", time.perf_counter() - started, questions=len(batch))
+
+
+def _grade_batch_events(batch, user_answers, api_key, temperature, enhanced_structured_output,
+                        optimistic_security_check, trace, cancel_scope=None):
+    grading = _BatchGrading(batch, user_answers)
+    logger.info(f"批量批改题目: {[i + 1 for i in grading.indices]}")
+    yield from grading.start_lines()
+
+    try:
+        llm_stream = siliconflow_client.invoke_llm(**grading.llm_kwargs(
+            api_key, temperature, enhanced_structured_output, optimistic_security_check, trace, cancel_scope,
+        ))
+        for event in timed_parse(stream_json_with_events, llm_stream, trace):
+            line = grading.result_line(event)
+            if line:
+                yield line
+        yield from grading.error_lines("批量批改未返回该题的结果。")
+    except Exception as e:
+        yield from grading.error_lines(_grading_error_message(e))
+
+
+def _question_grading_prompt(i, question, user_answer):
+    """
+    准备单题批改的提示词。
+
+    :return: (提示词, 本地判定的分数)，分数仅对选择题给出，其余题型为 None；未知题型返回 None。
+    """
+    q_type = question.get("question_type")
+    if q_type == "multiple_choice":
+        # 本地判分
+        correct_answer = question.get("answer")
+        is_correct = user_answer == correct_answer
+        score = question.get("score", 0) if is_correct else 0
+        logger.info(f"第 {i+1} 题 (选择题) 本地判分完成. 正确答案: {correct_answer}, 用户答案: {user_answer}, 得分: {score}")
+        return _get_grading_prompt(question, user_answer, is_correct), score
+    if q_type in ["fill_in_the_blank", "short_answer"]:
+        logger.info(f"第 {i+1} 题 ({q_type}) 使用LLM判分.")
+        return _get_grading_prompt(question, user_answer), None
+    logger.warning(f"第 {i+1} 题是未知题型 ({q_type})，无法批改.")
+    return None
+
+
+def _question_event_line(i, event, score):
+    # 为每个事件添加题目索引，选择题的 end 事件注入本地判定的分数
+    event["question_index"] = i
+    if score is not None and event["type"] == "end":
+        event["data"]["score"] = score
+    return json.dumps(event) + "\n"
+
+
+def _unknown_type_line(i):
+    error_data = {"score": 0, "feedback": "未知题型，无法批改。"}
+    return json.dumps({"type": "end", "question_index": i, "data": error_data}) + "\n"
+
+
+def _grade_question_stream(i, question, user_answer, api_key, temperature, enhanced_structured_output,
+                           formatting_prompt, optimistic_security_check, trace, cancel_scope=None):
+    """
+    批改单道题目，为其批改过程生成事件字符串。异常会被转换为带题目索引的 error 事件。
+    """
+    started = time.perf_counter()
+    try:
+        yield from _grade_question_events(i, question, user_answer, api_key, temperature, enhanced_structured_output,
+                                          formatting_prompt, optimistic_security_check, trace, cancel_scope)
+    finally:
+        trace.record("grade_question", time.perf_counter() - started, question_index=i)
+
+
+def _grade_question_events(i, question, user_answer, api_key, temperature, enhanced_structured_output,
+                           formatting_prompt, optimistic_security_check, trace, cancel_scope=None):
+    logger.info(f"开始批改第 {i+1} 题, 类型: {question.get('question_type')}")
+
+    # 为每道题的开始发送一个事件
+    yield json.dumps({"type": "start", "question_index": i}) + "\n"
+
+    try:
+        plan = _question_grading_prompt(i, question, user_answer)
+        if plan is None:
+            yield _unknown_type_line(i)
+            return
+        prompt, score = plan
+        llm_stream = siliconflow_client.invoke_llm(**_grading_llm_kwargs(
+            prompt, json.dumps(user_answer, ensure_ascii=False), api_key, temperature, enhanced_structured_output,
+            formatting_prompt, _is_grading_result, optimistic_security_check, trace, cancel_scope,
+        ))
+        for event in timed_parse(stream_json_with_events, llm_stream, trace):
+            yield _question_event_line(i, event, score)
+    except Exception as e:
+        yield _error_line(i, _grading_error_message(e))
+
+
+class _EventRelease:
+    """
+    决定并发批改单元的事件何时输出。
+
+    :param total: 批改单元数。
+    :param event_order: 'ordered' 按批改单元顺序输出（当前单元的事件实时转发，其余单元的事件暂存），
+                        'as_completed' 按事件到达顺序直接输出。
+    """
+
+    def __init__(self, total: int, event_order: str):
+        self._total = total
+        self._ordered = event_order != "as_completed"
+        self._buffers = [[] for _ in range(total)]
+        self._finished = [False] * total
+        self._current = 0
+        self._remaining = total
+
+    @property
+    def done(self) -> bool:
+        return self._remaining == 0 if not self._ordered else self._current >= self._total
+
+    def push(self, index: int, event: str) -> list:
+        """单元 index 产出一个事件，返回现在可以输出的事件。"""
+        if not self._ordered or index == self._current:
+            return [event]
+        self._buffers[index].append(event)
+        return []
+
+    def finish(self, index: int) -> list:
+        """单元 index 已结束，返回现在可以输出的事件。"""
+        if not self._ordered:
+            self._remaining -= 1
+            return []
+        if index != self._current:
+            self._finished[index] = True
+            return []
+        # 当前单元已完成，依次放行后续单元已暂存的事件
+        released = []
+        self._current += 1
+        while self._current < self._total:
+            released.extend(self._buffers[self._current])
+            self._buffers[self._current] = []
+            if not self._finished[self._current]:
+                break
+            self._current += 1
+        return released
+
+
+def _multiplex_events(question_streams, max_concurrency: int, event_order: str):
+    """
+    在线程池中并发执行每个批改单元（单题或一个批次）的生成器，并将其事件复用到一个输出流中。
+
+    :param question_streams: 返回各批改单元事件生成器的函数列表。
+    :param max_concurrency: 同时执行的最大批改单元数。
+    :param event_order: 'ordered' 或 'as_completed'，见 _EventRelease。
+    """
+    total = len(question_streams)
+    events = queue.Queue()
+    release = _EventRelease(total, event_order)
+
+    def run(index):
+        try:
+            for event in question_streams[index]():
+                events.put((index, event))
+        finally:
+            events.put((index, None))
+
+    executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="grading")
+    try:
+        for index in range(total):
+            executor.submit(run, index)
+        while not release.done:
+            index, event = events.get()
+            yield from release.finish(index) if event is None else release.push(index, event)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _grading_units(questions, user_answers, grading_mode: str, batch_size: int, skip_correct_choice_feedback: bool):
+    """
+    把试卷划分为批改单元，依次为 ("local", 题目索引, 分数)、("batch", [(题目索引, 题目), ...]) 或
+    ("question", 题目索引, 题目, 用户答案)。
+    """
+    units = []
+    batch = []
+    for i, (question, user_answer) in enumerate(zip(questions, user_answers)):
+        q_type = question.get("question_type")
+        if (skip_correct_choice_feedback and q_type == "multiple_choice"
+                and user_answer == question.get("answer")):
+            units.append(("local", i, question.get("score", 0)))
+        elif grading_mode == "batched" and q_type in ["multiple_choice", "fill_in_the_blank"]:
+            batch.append((i, question))
+            if len(batch) >= batch_size:
+                units.append(("batch", batch))
+                batch = []
+        else:
+            units.append(("question", i, question, user_answer))
+    if batch:
+        units.append(("batch", batch))
+    return units
+
+
+def grade_exam_stream(questions, user_answers, api_key, temperature=0.7, enhanced_structured_output: bool = False,
+                      optimistic_security_check: bool = False, max_concurrency: int = 1, event_order: str = "ordered",
+                      grading_mode: str = "per_question", batch_size: int = 10,
+                      skip_correct_choice_feedback: bool = False, trace: Trace = None,
+                      cancel_scope: CancelScope = None):
     """
     批改整份试卷，为每道题的批改过程生成事件。
     这是一个生成器函数。
+
+    :param max_concurrency: 同时进行的批改单元（单题或一个批次）上限，为 1 时串行批改。
+    :param event_order: 并发批改时的事件输出顺序，'ordered' 或 'as_completed'。
+    :param grading_mode: 'per_question' 每题一次LLM调用；'batched' 将选择题和填空题每 batch_size 道合并为一次调用。
+    :param batch_size: 批量模式下每次调用包含的题目数。
+    :param skip_correct_choice_feedback: 答对的选择题直接给出满分，不再调用LLM生成评语。
+    :param trace: 请求跟踪，记录每个批改单元、模型调用阶段与JSON解析的耗时。
+    :param cancel_scope: 请求的取消范围。客户端断开或超出截止时间后，进行中的模型流被关闭，
+                         尚未开始的批改单元不再调用模型。
     """
+    trace = trace or Trace("grade_exam")
     formatting_prompt = None
     if enhanced_structured_output:
         formatting_prompt = prompt_manager.get_prompt("grading_prompt_formatting")
-        
-    for i, (question, user_answer) in enumerate(zip(questions, user_answers)):
-        q_type = question.get("question_type")
-        logger.info(f"开始批改第 {i+1} 题, 类型: {q_type}")
 
-        # 为每道题的开始发送一个事件
-        yield json.dumps({"type": "start", "question_index": i}) + "\n"
-
-        try:
-            if q_type == "multiple_choice":
-                # 本地判分
-                correct_answer = question.get("answer")
-                is_correct = user_answer == correct_answer
-                score = question.get("score", 0) if is_correct else 0
-                logger.info(f"第 {i+1} 题 (选择题) 本地判分完成. 正确答案: {correct_answer}, 用户答案: {user_answer}, 得分: {score}")
-                
-                prompt = _get_grading_prompt(question, user_answer, is_correct)
-                messages = [{"role": "user", "content": prompt}]
-
-                llm_stream = siliconflow_client.invoke_llm(
-                    api_key=api_key,
-                    model="Qwen/Qwen2.5-72B-Instruct",
-                    messages=messages,
-                    stream=True,
-                    temperature=temperature,
-                    enhanced_structured_output=enhanced_structured_output,
-                    formatting_prompt=formatting_prompt,
+    question_streams = []
+    for unit in _grading_units(questions, user_answers, grading_mode, batch_size, skip_correct_choice_feedback):
+        if unit[0] == "local":
+            question_streams.append(lambda i=unit[1], score=unit[2]: _local_result_stream(i, score, "回答正确。"))
+        elif unit[0] == "batch":
+            question_streams.append(
+                lambda batch=unit[1]: _grade_batch_stream(
+                    batch, user_answers, api_key, temperature, enhanced_structured_output,
+                    optimistic_security_check, trace, cancel_scope,
                 )
-
-                event_stream = stream_json_with_events(llm_stream)
-                
-                for event in event_stream:
-                    event["question_index"] = i
-                    if event["type"] == "end":
-                        # 注入本地判定的分数
-                        event["data"]["score"] = score
-                    yield json.dumps(event) + "\n"
-
-            elif q_type in ["fill_in_the_blank", "short_answer"]:
-                logger.info(f"第 {i+1} 题 ({q_type}) 使用LLM判分.")
-                prompt = _get_grading_prompt(question, user_answer)
-                messages = [{"role": "user", "content": prompt}]
-
-                llm_stream = siliconflow_client.invoke_llm(
-                    api_key=api_key,
-                    model="Qwen/Qwen2.5-72B-Instruct",
-                    messages=messages,
-                    stream=True,
-                    temperature=temperature,
-                    enhanced_structured_output=enhanced_structured_output,
-                    formatting_prompt=formatting_prompt,
+            )
+        else:
+            question_streams.append(
+                lambda i=unit[1], question=unit[2], user_answer=unit[3]: _grade_question_stream(
+                    i, question, user_answer, api_key, temperature, enhanced_structured_output,
+                    formatting_prompt, optimistic_security_check, trace, cancel_scope,
                 )
+            )
 
-                # 使用事件生成器来处理JSON解析
-                event_stream = stream_json_with_events(llm_stream)
+    if max_concurrency <= 1 or len(question_streams) <= 1:
+        for question_stream in question_streams:
+            yield from question_stream()
+        return
 
-                for event in event_stream:
-                    # 为每个事件添加题目索引
-                    event["question_index"] = i
-                    yield json.dumps(event) + "\n"
+    logger.info(f"并发批改. 批改单元数: {len(question_streams)}, 并发上限: {max_concurrency}, 输出顺序: {event_order}")
+    yield from _multiplex_events(question_streams, max_concurrency, event_order)
 
+
+async def _alocal_result_stream(i, score, feedback):
+    for line in _local_result_stream(i, score, feedback):
+        yield line
+
+
+async def _agrade_batch_stream(batch, user_answers, api_key, temperature, enhanced_structured_output,
+                               optimistic_security_check, trace, cancel_scope=None):
+    """_grade_batch_stream 的异步版本。"""
+    started = time.perf_counter()
+    grading = _BatchGrading(batch, user_answers)
+    logger.info(f"批量批改题目: {[i + 1 for i in grading.indices]}")
+    try:
+        for line in grading.start_lines():
+            yield line
+        try:
+            llm_stream = await siliconflow_client.ainvoke_llm(**grading.llm_kwargs(
+                api_key, temperature, enhanced_structured_output, optimistic_security_check, trace, cancel_scope,
+            ))
+            async with contextlib.aclosing(atimed_parse(astream_json_with_events, llm_stream, trace)) as events:
+                async for event in events:
+                    line = grading.result_line(event)
+                    if line:
+                        yield line
+            lines = grading.error_lines("批量批改未返回该题的结果。")
+        except Exception as e:
+            lines = grading.error_lines(_grading_error_message(e))
+        for line in lines:
+            yield line
+    finally:
+        trace.record("grade_batch", time.perf_counter() - started, questions=len(batch))
+
+
+async def _agrade_question_stream(i, question, user_answer, api_key, temperature, enhanced_structured_output,
+                                  formatting_prompt, optimistic_security_check, trace, cancel_scope=None):
+    """_grade_question_stream 的异步版本。"""
+    started = time.perf_counter()
+    logger.info(f"开始批改第 {i+1} 题, 类型: {question.get('question_type')}")
+    try:
+        yield json.dumps({"type": "start", "question_index": i}) + "\n"
+        try:
+            plan = _question_grading_prompt(i, question, user_answer)
+            if plan is None:
+                lines = [_unknown_type_line(i)]
             else:
-                logger.warning(f"第 {i+1} 题是未知题型 ({q_type})，无法批改.")
-                # 处理未知题型
-                error_data = {"score": 0, "feedback": "未知题型，无法批改。"}
-                yield json.dumps(
-                    {"type": "end", "question_index": i, "data": error_data}
-                ) + "\n"
-
-        except AuthenticationError:
-            yield json.dumps(
-                {
-                    "type": "error",
-                    "question_index": i,
-                    "error": "API Key 无效或已过期。",
-                }
-            ) + "\n"
+                prompt, score = plan
+                llm_stream = await siliconflow_client.ainvoke_llm(**_grading_llm_kwargs(
+                    prompt, json.dumps(user_answer, ensure_ascii=False), api_key, temperature,
+                    enhanced_structured_output, formatting_prompt, _is_grading_result, optimistic_security_check,
+                    trace, cancel_scope,
+                ))
+                async with contextlib.aclosing(atimed_parse(astream_json_with_events, llm_stream, trace)) as events:
+                    async for event in events:
+                        yield _question_event_line(i, event, score)
+                lines = []
         except Exception as e:
-            yield json.dumps(
-                {
-                    "type": "error",
-                    "question_index": i,
-                    "error": f"批改过程中发生错误: {str(e)}",
-                }
-            ) + "\n"
+            lines = [_error_line(i, _grading_error_message(e))]
+        for line in lines:
+            yield line
+    finally:
+        trace.record("grade_question", time.perf_counter() - started, question_index=i)
+
+
+async def _amultiplex_events(question_streams, max_concurrency: int, event_order: str):
+    """
+    _multiplex_events 的异步版本：每个批改单元是事件循环中的一个任务，由信号量限制同时执行的单元数。
+    输出流被关闭时取消全部任务，任务中的上游流随之关闭。
+    """
+    total = len(question_streams)
+    events = asyncio.Queue()
+    release = _EventRelease(total, event_order)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(index):
+        try:
+            async with semaphore:
+                async with contextlib.aclosing(question_streams[index]()) as stream:
+                    async for event in stream:
+                        events.put_nowait((index, event))
+        finally:
+            events.put_nowait((index, None))
+
+    tasks = [asyncio.create_task(run(index)) for index in range(total)]
+    try:
+        while not release.done:
+            index, event = await events.get()
+            for line in release.finish(index) if event is None else release.push(index, event):
+                yield line
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def agrade_exam_stream(questions, user_answers, api_key, temperature=0.7,
+                             enhanced_structured_output: bool = False, optimistic_security_check: bool = False,
+                             max_concurrency: int = 1, event_order: str = "ordered",
+                             grading_mode: str = "per_question", batch_size: int = 10,
+                             skip_correct_choice_feedback: bool = False, trace: Trace = None,
+                             cancel_scope: CancelScope = None):
+    """
+    grade_exam_stream 的异步版本，参数相同。这是一个异步生成器，用于 ASGI 服务模式，
+    批改单元在事件循环中并发执行，不占用线程。
+    """
+    trace = trace or Trace("grade_exam")
+    formatting_prompt = None
+    if enhanced_structured_output:
+        formatting_prompt = prompt_manager.get_prompt("grading_prompt_formatting")
+
+    question_streams = []
+    for unit in _grading_units(questions, user_answers, grading_mode, batch_size, skip_correct_choice_feedback):
+        if unit[0] == "local":
+            question_streams.append(lambda i=unit[1], score=unit[2]: _alocal_result_stream(i, score, "回答正确。"))
+        elif unit[0] == "batch":
+            question_streams.append(
+                lambda batch=unit[1]: _agrade_batch_stream(
+                    batch, user_answers, api_key, temperature, enhanced_structured_output,
+                    optimistic_security_check, trace, cancel_scope,
+                )
+            )
+        else:
+            question_streams.append(
+                lambda i=unit[1], question=unit[2], user_answer=unit[3]: _agrade_question_stream(
+                    i, question, user_answer, api_key, temperature, enhanced_structured_output,
+                    formatting_prompt, optimistic_security_check, trace, cancel_scope,
+                )
+            )
+
+    if max_concurrency <= 1 or len(question_streams) <= 1:
+        for question_stream in question_streams:
+            async with contextlib.aclosing(question_stream()) as events:
+                async for line in events:
+                    yield line
+        return
+
+    logger.info(f"并发批改. 批改单元数: {len(question_streams)}, 并发上限: {max_concurrency}, 输出顺序: {event_order}")
+    async with contextlib.aclosing(_amultiplex_events(question_streams, max_concurrency, event_order)) as events:
+        async for line in events:
+            yield line
@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_MODE_ENV = "LLM_CASSETTE_MODE"
+CASSETTE_DIR_ENV = "LLM_CASSETTE_DIR"
+CASSETTE_REALTIME_ENV = "LLM_CASSETTE_REALTIME"
+DEFAULT_CASSETTE_DIR = "cassettes"
+CASSETTE_MODES = ("off", "record", "replay")
+# 不影响模型输出内容的请求参数，不参与键的计算
+_IGNORED_PARAMS = ("stream", "stream_options")
+
+
+class CassetteMissError(LookupError):
+    """回放模式下没有找到与请求匹配的录制。"""
+
+
+def cassette_key(request: dict) -> str:
+    """由规范化的请求参数生成录制的键。同一请求的流式与非流式调用共用一份录制，不包含 API Key。"""
+    payload = {k: v for k, v in request.items() if k not in _IGNORED_PARAMS}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+
+def take_text(take: dict) -> str:
+    """一次录制的完整输出文本。"""
+    if "chunks" in take:
+        return "".join(chunk_content(chunk) for _, chunk in take["chunks"])
+    return take["response"]["choices"][0]["message"].get("content") or ""
+
+
+def chunk_content(chunk: dict) -> str:
+    choices = chunk.get("choices") or []
+    if not choices:
+        return ""
+    return (choices[0].get("delta") or {}).get("content") or ""
+
+
+def _completion_from_chunks(chunks) -> dict:
+    """把录制的流式数据块合成为非流式响应。"""
+    first = chunks[0][1] if chunks else {}
+    usage = next((chunk["usage"] for _, chunk in reversed(chunks) if chunk.get("usage")), None)
+    return {
+        "id": first.get("id", "chatcmpl-cassette"),
+        "object": "chat.completion",
+        "created": first.get("created", 0),
+        "model": first.get("model", ""),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": "".join(chunk_content(chunk) for _, chunk in chunks)},
+            "finish_reason": "stop",
+        }],
+        "usage": usage,
+    }
+
+
+def _chunks_from_completion(response: dict) -> list:
+    """把录制的非流式响应拆成一个内容块与一个结束块。"""
+    base = {"id": response.get("id"), "object": "chat.completion.chunk",
+            "created": response.get("created", 0), "model": response.get("model", "")}
+    content = response["choices"][0]["message"].get("content") or ""
+    return [
+        (0.0, dict(base, choices=[{"index": 0, "delta": {"role": "assistant", "content": content}, "finish_reason": None}])),
+        (0.0, dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}], usage=response.get("usage"))),
+    ]
+
+
+class _RecordingStream:
+    """包装上游流，转发数据块的同时记录每块相对开始时间的偏移；流完整读完后写入录制。"""
+
+    def __init__(self, stream, on_complete, started: float):
+        self._stream = stream
+        self._iterator = iter(stream)
+        self._on_complete = on_complete
+        self._started = started
+        self._chunks = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._iterator)
+        except StopIteration:
+            self._on_complete({"chunks": self._chunks})
+            raise
+        self._chunks.append((round(time.monotonic() - self._started, 4), chunk.model_dump(mode="json")))
+        return chunk
+
+    def close(self):
+        # 提前关闭的流输出不完整，不写入录制
+        self._stream.close()
+
+
+def _replay_stream(chunks, realtime: bool):
+    started = time.monotonic()
+    for offset, chunk in chunks:
+        if realtime:
+            delay = offset - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+        yield ChatCompletionChunk.model_validate(chunk)
+
+
+class LLMCassette:
+    """
+    模型调用的录制/回放层。
+
+    - record：正常调用上游，把完整的响应（流式响应连同每块的时间偏移）按请求的键写入目录；
+    - replay：不访问网络，按键读取录制并返回与 SDK 相同类型的对象，找不到录制时抛出 CassetteMissError；
+    - off：直接调用上游。
+
+    同一请求可录制多次（temperature 不为 0 时每次输出不同），回放时按调用顺序依次循环使用。
+    realtime 为 True 时按录制的时间偏移回放流式数据块。
+    """
+
+    def __init__(self, directory: str = DEFAULT_CASSETTE_DIR, mode: str = "off", realtime: bool = False):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"未知的录制模式: {mode}，可选: {', '.join(CASSETTE_MODES)}")
+        self.directory = directory
+        self.mode = mode
+        self.realtime = realtime
+        self._lock = threading.Lock()
+        self._loaded = {}
+        self._replay_positions = {}
+        self._metrics = {"recorded": 0, "replayed": 0, "misses": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            directory=os.environ.get(CASSETTE_DIR_ENV, DEFAULT_CASSETTE_DIR),
+            mode=os.environ.get(CASSETTE_MODE_ENV, "off").lower() or "off",
+            realtime=os.environ.get(CASSETTE_REALTIME_ENV, "") in ("1", "true", "yes"),
+        )
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def load(self, key: str):
+        """读取某个键的录制，返回 {"request": ..., "takes": [...]}，不存在时返回 None。"""
+        with self._lock:
+            if key in self._loaded:
+                return self._loaded[key]
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as f:
+                    cassette = json.load(f)
+            except FileNotFoundError:
+                cassette = None
+            self._loaded[key] = cassette
+            return cassette
+
+    def next_take(self, key: str):
+        """按调用顺序循环取出某个键的下一次录制，没有录制时返回 None。"""
+        cassette = self.load(key)
+        with self._lock:
+            if not cassette or not cassette.get("takes"):
+                self._metrics["misses"] += 1
+                return None
+            position = self._replay_positions.get(key, 0)
+            self._replay_positions[key] = position + 1
+            self._metrics["replayed"] += 1
+        return cassette["takes"][position % len(cassette["takes"])]
+
+    def _save_take(self, key: str, request: dict, take: dict):
+        with self._lock:
+            cassette = self._loaded.get(key)
+            if cassette is None:
+                try:
+                    with open(self._path(key), "r", encoding="utf-8") as f:
+                        cassette = json.load(f)
+                except FileNotFoundError:
+                    cassette = {"request": request, "takes": []}
+            cassette["takes"].append(take)
+            self._loaded[key] = cassette
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(cassette, f, ensure_ascii=False, default=str)
+            os.replace(temp_path, self._path(key))
+            self._metrics["recorded"] += 1
+        logger.info(f"已录制模型响应. Model: {request.get('model')}, Key: {key}, 录制次数: {len(cassette['takes'])}")
+
+    def call(self, request: dict, fn):
+        """
+        :param request: 传递给 client.chat.completions.create 的参数。
+        :param fn: 实际发起上游调用的无参函数。
+        :return: ChatCompletion，或流式时可迭代的 ChatCompletionChunk 流。
+        """
+        if self.mode == "off":
+            return fn()
+        stream = bool(request.get("stream"))
+        key = cassette_key(request)
+
+        if self.mode == "replay":
+            take = self.next_take(key)
+            if take is None:
+                logger.warning(f"回放模式下没有找到录制. Model: {request.get('model')}, Key: {key}")
+                raise CassetteMissError(f"没有找到与请求匹配的录制: {self._path(key)}")
+            if stream:
+                chunks = take["chunks"] if "chunks" in take else _chunks_from_completion(take["response"])
+                return _replay_stream(chunks, self.realtime)
+            response = take["response"] if "response" in take else _completion_from_chunks(take["chunks"])
+            return ChatCompletion.model_validate(response)
+
+        started = time.monotonic()
+        response = fn()
+        request_record = json.loads(json.dumps(request, ensure_ascii=False, default=str))
+        if stream:
+            return _RecordingStream(response, lambda take: self._save_take(key, request_record, take), started)
+        self._save_take(key, request_record, {
+            "latency": round(time.monotonic() - started, 4),
+            "response": response.model_dump(mode="json"),
+        })
+        return response
+
+    def metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics["mode"] = self.mode
+        return metrics
+
+
+llm_cassette = LLMCassette.from_env()
@@ -1,98 +1,337 @@
 import json
-from typing import Generator, Dict, Any
+import re
+from typing import Generator, AsyncGenerator, AsyncIterable, Dict, Any, List, Callable, Optional
 import logging
 
 logger = logging.getLogger(__name__)
 
+_STRING_SPECIAL = re.compile(r'["\\]')
+_STRUCTURAL = re.compile(r'[{}\[\]",:]')
+
+
+class JsonStreamParser:
+    """
+    增量式的 JSON 对象流解析器。
+
+    扫描位置、字符串/转义状态与嵌套深度在多次 feed 之间保持，每个字符只被扫描一次，
+    因此每个数据块的处理开销只与数据块本身的长度有关，与已接收的对象大小无关。
+    字符串中的花括号不会影响对象边界的判断。
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.expect_key = True
+        self.current_key = None
+        self.object_parts: List[str] = []
+        # 正在追踪的顶层字符串（键或值）的片段，None 表示当前字符串不需要追踪
+        self.string_parts = None
+        self.string_is_key = False
+
+    def _close_string(self, literal: str, events: List[Dict[str, Any]]):
+        try:
+            value = json.loads(literal)
+        except json.JSONDecodeError:
+            return
+        if self.string_is_key:
+            self.current_key = value
+        elif self.current_key is not None:
+            events.append({'type': 'field', 'key': self.current_key, 'value': value})
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        """
+        处理一个文本块，返回由此产生的事件列表。
+
+        :param chunk: 新到达的文本块。
+        :return: 事件字典列表，顺序与旧版解析器一致：'start'、'streaming'、'field'、'end'/'error'。
+        """
+        events = []
+        field_events = []
+        length = len(chunk)
+        segment_start = 0 if self.depth > 0 else None
+        string_start = 0 if self.string_parts is not None else None
+        i = 0
+
+        while i < length:
+            if self.depth == 0:
+                brace = chunk.find('{', i)
+                if brace == -1:
+                    break
+                self.depth = 1
+                self.expect_key = True
+                self.current_key = None
+                self.object_parts = []
+                segment_start = brace
+                events.append({'type': 'start'})
+                i = brace + 1
+                continue
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                    i += 1
+                    continue
+                match = _STRING_SPECIAL.search(chunk, i)
+                if match is None:
+                    i = length
+                    break
+                position = match.start()
+                if chunk[position] == '\\':
+                    self.escape = True
+                    i = position + 1
+                    continue
+                self.in_string = False
+                if self.string_parts is not None:
+                    self.string_parts.append(chunk[string_start:position + 1])
+                    self._close_string("".join(self.string_parts), field_events)
+                    self.string_parts = None
+                    string_start = None
+                i = position + 1
+                continue
+
+            match = _STRUCTURAL.search(chunk, i)
+            if match is None:
+                i = length
+                break
+            position = match.start()
+            char = chunk[position]
+            if char == '"':
+                self.in_string = True
+                if self.depth == 1:
+                    self.string_parts = []
+                    self.string_is_key = self.expect_key
+                    string_start = position
+            elif char in '{[':
+                self.depth += 1
+            elif char in '}]':
+                self.depth -= 1
+                if self.depth == 0:
+                    segment = chunk[segment_start:position + 1]
+                    self.object_parts.append(segment)
+                    events.append({'type': 'streaming', 'content': segment})
+                    events.extend(field_events)
+                    field_events = []
+                    events.append(self._finish_object())
+                    segment_start = None
+            elif self.depth == 1:
+                if char == ':':
+                    self.expect_key = False
+                elif char == ',':
+                    self.expect_key = True
+            i = position + 1
+
+        if self.depth > 0 and segment_start is not None:
+            segment = chunk[segment_start:]
+            if segment:
+                self.object_parts.append(segment)
+                events.append({'type': 'streaming', 'content': segment})
+            if self.string_parts is not None and string_start is not None:
+                self.string_parts.append(chunk[string_start:])
+        events.extend(field_events)
+        return events
+
+    def _finish_object(self) -> Dict[str, Any]:
+        potential_json_str = "".join(self.object_parts)
+        self.object_parts = []
+        self.in_string = False
+        self.escape = False
+        self.string_parts = None
+        try:
+            return {'type': 'end', 'data': json.loads(potential_json_str)}
+        except json.JSONDecodeError:
+            # It looked like a full object, but wasn't. Discard it and wait for the next one.
+            return {'type': 'error', 'message': f"JSON Decode Error for: {potential_json_str[:100]}..."}
+
+
+def extract_chunk_text(raw_chunk):
+    """从OpenAI流式数据块（或旧式的字符串流）中取出文本内容，没有内容时返回 None。"""
+    if hasattr(raw_chunk, 'choices'):
+        if raw_chunk.choices:
+            delta = raw_chunk.choices[0].delta
+            return getattr(delta, 'content', None)
+        return None
+    # Fallback for old string-based stream
+    return str(raw_chunk)
+
+
 def stream_json_with_events(text_stream: Generator[str, None, None]) -> Generator[Dict[str, Any], None, None]:
     """
     Receives a text stream, parses JSON objects from it, and generates events during parsing.
     - 'start': Fired when the start of a JSON object ('{') is detected.
-    - 'streaming': Transmits raw text chunks as they arrive.
+    - 'streaming': Transmits the raw text of the current object as it arrives.
+    - 'field': Fired as soon as a top-level string field (e.g. 'stem') of the current object closes.
     - 'end': Fired when a complete JSON object has been successfully parsed, containing the parsed data.
     - 'error': Fired when a JSON parsing error occurs.
 
     :param text_stream: A generator that continuously produces text chunks.
     :return: A generator that produces event dictionaries one by one.
     """
-    buffer = ""
-    json_started = False
-    
-    while True:
-        try:
-            # Read from the stream until we have something to process
-            raw_chunk = next(text_stream)
-
-            # Extract content from the chunk object
-            chunk = None
-            if hasattr(raw_chunk, 'choices') and raw_chunk.choices:
-                delta = raw_chunk.choices[0].delta
-                if hasattr(delta, 'content'):
-                    chunk = delta.content
+    parser = JsonStreamParser()
+    for raw_chunk in text_stream:
+        chunk = extract_chunk_text(raw_chunk)
+        if not chunk:
+            continue
+        logger.debug(chunk) # Server-side debug print
+        yield from parser.feed(chunk)
+    # Leftover content of an unfinished object is ignored.
+
+
+async def astream_json_with_events(text_stream: AsyncIterable) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    stream_json_with_events 的异步版本，从异步数据块流（例如 AsyncOpenAI 的流式响应）中解析事件。
+
+    :param text_stream: 异步产生文本数据块的可迭代对象。
+    :return: 逐个产出事件字典的异步生成器。
+    """
+    parser = JsonStreamParser()
+    async for raw_chunk in text_stream:
+        chunk = extract_chunk_text(raw_chunk)
+        if not chunk:
+            continue
+        logger.debug(chunk)
+        for event in parser.feed(chunk):
+            yield event
+
+
+_CODE_FENCE = re.compile(r'```[A-Za-z]*')
+_STRING_ESCAPES = {'\n': '\\n', '\r': '\\r', '\t': '\\t'}
+_TRUNCATION_SUFFIXES = ('', 'null', ':null')
+
+
+def _next_significant(text: str, start: int) -> str:
+    """返回 start 之后第一个非空白字符，没有时返回空字符串。"""
+    for i in range(start, len(text)):
+        if not text[i].isspace():
+            return text[i]
+    return ''
+
+
+def _close_truncated(parts: List[str], stack: List[str], in_string: bool) -> List[str]:
+    """为被截断的对象生成若干种补全方式（补上引号、缺失的值与括号），按优先级排列。"""
+    text = "".join(parts)
+    if in_string:
+        text += '"'
+    text = text.rstrip()
+    if text.endswith(','):
+        text = text[:-1]
+    closers = "".join(reversed(stack))
+    return [text + suffix + closers for suffix in _TRUNCATION_SUFFIXES]
+
+
+def _scan_repair(text: str) -> List[List[str]]:
+    """
+    逐字符扫描文本，找出其中的顶层 JSON 对象，返回每个对象的候选文本列表。
+
+    本身就是合法 JSON 的对象原样返回，其余对象做确定性的修复：
+    - 对象之前、之间和之后的说明文字与代码块标记被丢弃，字符串中的代码块标记原样保留；
+    - 悬挂逗号被删除；
+    - 字符串中未转义的引号（其后不是 , : } ] 或代码块标记的引号）和原始换行符被转义；
+    - 错配的右括号按当前嵌套改为正确的括号；
+    - 末尾被截断的对象按多种方式补全，由调用方挑选第一个能解析的候选；对象中（字符串外）出现过
+      代码块标记时，优先在第一个标记处截断（标记之后通常是模型附加的说明文字），再补全整段文本。
+    """
+    decoder = json.JSONDecoder()
+    candidates = []
+    parts: List[str] = []
+    stack: List[str] = []
+    in_string = False
+    escape = False
+    fence_state = None
+
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if not stack:
+            if char == '{':
+                try:
+                    _, end = decoder.raw_decode(text, i)
+                except json.JSONDecodeError:
+                    parts = ['{']
+                    stack = ['}']
+                    fence_state = None
+                else:
+                    candidates.append([text[i:end]])
+                    i = end
+                    continue
+            i += 1
+            continue
+
+        if in_string:
+            if escape:
+                escape = False
+                parts.append(char)
+            elif char == '\\':
+                escape = True
+                parts.append(char)
+            elif char == '"':
+                if _next_significant(text, i + 1) in (',', ':', '}', ']', '`', ''):
+                    in_string = False
+                    parts.append(char)
+                else:
+                    parts.append('\\"')
             else:
-                # Fallback for old string-based stream
-                chunk = str(raw_chunk)
-            
-            if chunk is None:
-                continue
+                parts.append(_STRING_ESCAPES.get(char, char))
+            i += 1
+            continue
+
+        fence = _CODE_FENCE.match(text, i)
+        if fence:
+            if fence_state is None:
+                fence_state = (list(parts), list(stack))
+            i = fence.end()
+            continue
+
+        if char == '"':
+            in_string = True
+            parts.append(char)
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+            parts.append(char)
+        elif char in '}]':
+            parts.append(stack.pop())
+            if not stack:
+                candidates.append(["".join(parts)])
+                parts = []
+        elif char == ',':
+            if _next_significant(text, i + 1) not in ('}', ']'):
+                parts.append(char)
+        else:
+            parts.append(char)
+        i += 1
+
+    if stack:
+        closed = _close_truncated(parts, stack, in_string)
+        if fence_state is not None:
+            fence_parts, fence_stack = fence_state
+            closed = _close_truncated(fence_parts, fence_stack, False) + closed
+        candidates.append(closed)
+    return candidates
+
 
-            logger.debug(chunk) # Server-side debug print
-            buffer += chunk
-        except StopIteration:
-            # Stream ended
-            break
+def repair_json_objects(text: str, validator: Callable[[Dict[str, Any]], bool] = None) -> Optional[List[Dict[str, Any]]]:
+    """
+    在本地修复模型输出中不规范的 JSON 对象流（代码块标记、首尾说明文字、悬挂逗号、
+    未转义的引号、被截断的对象），并逐个校验。
 
-        if not json_started:
+    :param text: 模型的完整输出文本。
+    :param validator: 校验单个对象是否符合预期结构的函数，为 None 时只要求是 JSON 对象。
+    :return: 修复后的对象列表；没有找到对象、或末尾之前的某个对象无法修复/未通过校验时返回 None。
+             只有末尾的对象无法修复时丢弃该对象，返回它之前的对象。
+    """
+    objects = []
+    candidate_lists = _scan_repair(text)
+    for index, candidate_texts in enumerate(candidate_lists):
+        for candidate in candidate_texts:
             try:
-                start_index = buffer.index('{')
-                json_started = True
-                yield {'type': 'start'}
-                
-                # Yield the content from the brace onwards as the first streaming chunk
-                content_chunk = buffer[start_index:]
-                yield {'type': 'streaming', 'content': content_chunk}
-
-                # The buffer for our JSON object starts from the first brace
-                buffer = content_chunk
-            except ValueError:
-                # Still waiting for '{', clear buffer if it gets too large to avoid memory issues
-                if len(buffer) > 1024:
-                    buffer = ""
+                data = json.loads(candidate)
+            except json.JSONDecodeError:
                 continue
+            if isinstance(data, dict) and (validator is None or validator(data)):
+                objects.append(data)
+                break
         else:
-            # Already in a JSON object, the whole chunk is content
-            yield {'type': 'streaming', 'content': chunk}
-
-        # Attempt to find and parse a complete JSON object in the buffer
-        if json_started:
-            brace_counter = 0
-            end_index = -1
-            for i, char in enumerate(buffer):
-                if char == '{':
-                    brace_counter += 1
-                elif char == '}':
-                    brace_counter -= 1
-                    if brace_counter == 0:
-                        end_index = i
-                        break
-            
-            if end_index != -1:
-                potential_json_str = buffer[:end_index + 1]
-                try:
-                    parsed_json = json.loads(potential_json_str)
-                    yield {'type': 'end', 'data': parsed_json}
-                    
-                    # Reset for the next object
-                    buffer = buffer[end_index + 1:]
-                    json_started = False
-                except json.JSONDecodeError as e:
-                    # It looked like a full object, but wasn't. This is an error case.
-                    # We should probably discard this attempt and restart.
-                    yield {'type': 'error', 'message': f"JSON Decode Error for: {potential_json_str[:100]}..."}
-                    # Discard the invalid part and reset
-                    buffer = buffer[end_index + 1:]
-                    json_started = False
-
-    # After stream ends, there might be leftover buffer content. We can try to parse it.
-    # This part is complex and might not be needed if the stream is guaranteed to finish with a complete JSON.
-    # For now, we'll ignore leftovers.
+            logger.info(f"本地JSON修复失败: {candidate_texts[0][:100]}...")
+            if index < len(candidate_lists) - 1:
+                return None
+    return objects or None
@@ -0,0 +1,322 @@
+import re
+import json
+import time
+import uuid
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "reviewgenius"
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKENS_PER_SECOND_BUCKETS = (1, 2.5, 5, 10, 20, 40, 80, 160, 320)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+_INVALID_NAME_CHARS = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """按标签分组的累积直方图，输出格式与 Prometheus 的 histogram 相同。"""
+
+    def __init__(self, name: str, documentation: str, label_names=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: (list(counts), count, total) for key, (counts, count, total) in self._series.items()}
+        for key, (counts, count, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+
+class Counter:
+    """按标签分组的单调递增计数器。"""
+
+    def __init__(self, name: str, documentation: str, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    进程内的指标注册表，render() 输出 Prometheus 文本格式。
+
+    除直方图与计数器外，还可以注册采集函数：各组件已有的 metrics() 字典在采集时
+    被展开为 gauge，例如 profile_update_queue.metrics()["pending"] 输出为
+    reviewgenius_profile_update_queue_pending。
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        name = f"{METRIC_PREFIX}_{name}"
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def histogram(self, name: str, documentation: str, label_names=(), buckets=DURATION_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, label_names, buckets)
+
+    def counter(self, name: str, documentation: str, label_names=()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, label_names)
+
+    def register_collector(self, name: str, collect, label: str = None):
+        """
+        :param name: gauge 名称前缀。
+        :param collect: 无参函数，返回数值字典（嵌套字典被展开，非数值被忽略）。
+        :param label: 指定时 collect 返回 {标签值: 数值字典}，例如按 API Key 哈希区分的限制器状态。
+        """
+        with self._lock:
+            self._collectors.append((name, collect, label))
+
+    @staticmethod
+    def _flatten(values, prefix=""):
+        for key, value in values.items():
+            name = _INVALID_NAME_CHARS.sub("_", f"{prefix}{key}")
+            if isinstance(value, dict):
+                yield from MetricsRegistry._flatten(value, f"{name}_")
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield name, value
+
+    def _render_collectors(self) -> list:
+        gauges = {}
+        with self._lock:
+            collectors = list(self._collectors)
+        for name, collect, label in collectors:
+            try:
+                collected = collect()
+            except Exception as e:
+                logger.warning(f"采集指标 {name} 失败: {e}")
+                continue
+            groups = collected.items() if label else [(None, collected)]
+            for label_value, values in groups:
+                for key, value in self._flatten(values):
+                    labels = _format_labels((label,), (label_value,)) if label else ""
+                    gauges.setdefault(f"{METRIC_PREFIX}_{name}_{key}", []).append((labels, value))
+        lines = []
+        for gauge_name, samples in sorted(gauges.items()):
+            lines.append(f"# TYPE {gauge_name} gauge")
+            lines.extend(f"{gauge_name}{labels} {_format_value(value)}" for labels, value in samples)
+        return lines
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics)]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        lines.extend(self._render_collectors())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+STAGE_DURATION = registry.histogram(
+    "stage_duration_seconds", "各请求阶段的耗时（秒）。", ("operation", "stage"))
+LLM_CALL_DURATION = registry.histogram(
+    "llm_call_duration_seconds", "模型调用从发起到输出结束的耗时（秒）。", ("model", "call"))
+LLM_TIME_TO_FIRST_TOKEN = registry.histogram(
+    "llm_time_to_first_token_seconds", "流式模型调用的首 token 延迟（秒）。", ("model",))
+LLM_TOKENS_PER_SECOND = registry.histogram(
+    "llm_tokens_per_second", "模型输出速率（token/秒，流式调用从首 token 起计）。", ("model", "call"), TOKENS_PER_SECOND_BUCKETS)
+LLM_OUTPUT_BYTES = registry.histogram(
+    "llm_output_bytes", "每次模型调用输出（流式时为推送）的字节数。", ("model", "call"), BYTES_BUCKETS)
+LLM_CALLS = registry.counter(
+    "llm_calls_total", "上游模型调用次数（不含重试）。", ("model", "outcome"))
+LLM_RETRIES = registry.counter(
+    "llm_retries_total", "上游模型调用的重试次数。", ("model", "reason"))
+LLM_STREAMS_CANCELLED = registry.counter(
+    "llm_streams_cancelled_total", "因所属请求被取消而提前关闭的上游流。", ("model", "reason"))
+STREAMED_BYTES = registry.counter(
+    "streamed_bytes_total", "NDJSON 接口推送给客户端的字节数。", ("operation",))
+REQUESTS_CANCELLED = registry.counter(
+    "requests_cancelled_total", "因客户端断开或超出截止时间而取消的请求数。", ("operation", "reason"))
+
+
+class StreamTimer:
+    """包装一个迭代器，累计调用方等待下一个元素所花的时间。"""
+
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.elapsed = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            return next(self._iterator)
+        finally:
+            self.elapsed += time.perf_counter() - started
+
+    def close(self):
+        close = getattr(self._iterator, "close", None)
+        if close:
+            close()
+
+
+class AsyncStreamTimer:
+    """StreamTimer 的异步版本，包装一个异步迭代器。"""
+
+    def __init__(self, iterable):
+        self._iterator = iterable.__aiter__()
+        self.elapsed = 0.0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        started = time.perf_counter()
+        try:
+            return await self._iterator.__anext__()
+        finally:
+            self.elapsed += time.perf_counter() - started
+
+    async def aclose(self):
+        aclose = getattr(self._iterator, "aclose", None)
+        if aclose:
+            await aclose()
+
+
+def timed_parse(parse, stream, trace, stage: str = "json_parsing"):
+    """
+    用 parse 解析上游流并逐个产出结果，把解析本身（不含等待上游数据的时间）的耗时记录为 trace 的一个阶段。
+
+    :param parse: 接收一个迭代器、返回结果生成器的函数，例如 stream_json_with_events。
+    """
+    upstream = StreamTimer(stream)
+    parsed = StreamTimer(parse(upstream))
+    try:
+        yield from parsed
+    finally:
+        trace.record(stage, max(parsed.elapsed - upstream.elapsed, 0.0))
+
+
+async def atimed_parse(parse, stream, trace, stage: str = "json_parsing"):
+    """timed_parse 的异步版本：parse 接收异步迭代器并返回异步生成器，例如 astream_json_with_events。"""
+    upstream = AsyncStreamTimer(stream)
+    parsed = AsyncStreamTimer(parse(upstream))
+    try:
+        async for item in parsed:
+            yield item
+    finally:
+        # 异步生成器不会随引用释放而立即关闭，显式关闭解析器与上游流
+        await parsed.aclose()
+        await upstream.aclose()
+        trace.record(stage, max(parsed.elapsed - upstream.elapsed, 0.0))
+
+
+class Trace:
+    """
+    一次请求的跟踪：按阶段记录耗时并写入 STAGE_DURATION，请求结束时输出一条结构化的汇总日志。
+
+    :param operation: 请求类型，例如 generate_exam。
+    :param trace_id: 调用方提供的跟踪 ID，为 None 时自动生成。
+    """
+
+    def __init__(self, operation: str, trace_id: str = None):
+        self.operation = operation
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        self.spans = []
+        self.attributes = {}
+        self._lock = threading.Lock()
+        self._finished = False
+
+    def record(self, stage: str, duration: float, **attributes):
+        """记录一个已测量好耗时的阶段，用于跨越生成器或线程的阶段。"""
+        STAGE_DURATION.observe(duration, operation=self.operation, stage=stage)
+        span = {"stage": stage, "duration_ms": round(duration * 1000, 2)}
+        span.update(attributes)
+        with self._lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, stage: str, **attributes):
+        """测量 with 块的耗时。块内可以向返回的字典中补充属性。"""
+        started = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            self.record(stage, time.perf_counter() - started, **attributes)
+
+    def finish(self, **attributes):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+            self.attributes.update(attributes)
+            spans = list(self.spans)
+        total = time.perf_counter() - self.started
+        STAGE_DURATION.observe(total, operation=self.operation, stage="total")
+        summary = {"trace_id": self.trace_id, "operation": self.operation, "total_ms": round(total * 1000, 2),
+                   "spans": spans}
+        summary.update(self.attributes)
+        logger.info(f"请求跟踪: {json.dumps(summary, ensure_ascii=False, default=str)}")
+
+
+def add_trace_id(line: str, trace_id: str) -> str:
+    """在一行 NDJSON 事件中加入 trace_id 字段。事件都是 JSON 对象，直接在开头的 '{' 之后插入。"""
+    if line.startswith("{") and not line.startswith("{}"):
+        return '{' + f'"trace_id": {json.dumps(trace_id)}, ' + line[1:]
+    return line
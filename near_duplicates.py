@@ -0,0 +1,163 @@
+import re
+import struct
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+SHINGLE_SIZE = 3
+NUM_BANDS = 8
+ROWS_PER_BAND = 4
+# blake2b 最长 64 字节摘要，恰好拆成 NUM_BANDS * ROWS_PER_BAND 个 16 位哈希值
+NUM_HASHES = NUM_BANDS * ROWS_PER_BAND
+_DIGEST_FORMAT = struct.Struct(f"<{NUM_HASHES}H")
+DEFAULT_THRESHOLD = 0.7
+HISTORY_CACHE_SIZE = 16
+
+_IGNORED = re.compile(r'[\s\W_]+')
+
+
+def question_text(question: dict) -> str:
+    """参与近似重复比较的文本：题干加选项内容。"""
+    options = question.get("options")
+    option_text = " ".join(str(value) for value in options.values()) if isinstance(options, dict) else ""
+    return f"{question.get('stem', '')} {option_text}"
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> frozenset:
+    """
+    文本的字符 shingle 集合。忽略空白、标点与大小写，按字符而不是按词切分，
+    因此中文文本不需要分词。
+    """
+    normalized = _IGNORED.sub('', text).lower()
+    if len(normalized) <= size:
+        return frozenset([normalized]) if normalized else frozenset()
+    return frozenset(normalized[i:i + size] for i in range(len(normalized) - size + 1))
+
+
+def minhash_signature(shingle_set) -> tuple:
+    """
+    MinHash 签名。每个 shingle 只计算一次 blake2b，把 64 字节摘要拆成 NUM_HASHES 个
+    独立的 16 位哈希值，再在 C 层面按列取最小值。
+    """
+    rows = [_DIGEST_FORMAT.unpack(hashlib.blake2b(s.encode("utf-8"), digest_size=64).digest()) for s in shingle_set]
+    return tuple(map(min, zip(*rows)))
+
+
+def jaccard(a, b) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class MinHashIndex:
+    """
+    基于 LSH 分段的近似重复索引。
+
+    签名被切成 NUM_BANDS 段，任一段完全相同的条目成为候选，
+    再用精确的 Jaccard 相似度确认，因此不会因为签名碰撞产生误报。
+    """
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self._buckets = {}
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _bands(signature):
+        return [(band, signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]) for band in range(NUM_BANDS)]
+
+    def query(self, shingle_set, signature=None, threshold=None):
+        """
+        :param threshold: 本次查询使用的相似度阈值，默认使用索引的阈值。
+        :return: (key, payload, similarity)，没有超过阈值的条目时返回 None。
+        """
+        if not shingle_set:
+            return None
+        threshold = self.threshold if threshold is None else threshold
+        signature = signature or minhash_signature(shingle_set)
+        candidates = set()
+        for band in self._bands(signature):
+            candidates.update(self._buckets.get(band, ()))
+        best = None
+        for key in candidates:
+            entry_shingles, payload = self._entries[key]
+            similarity = jaccard(shingle_set, entry_shingles)
+            if similarity >= threshold and (best is None or similarity > best[2]):
+                best = (key, payload, similarity)
+        return best
+
+    def add(self, key, shingle_set, payload=None, signature=None):
+        if not shingle_set or key in self._entries:
+            return
+        signature = signature or minhash_signature(shingle_set)
+        self._entries[key] = (shingle_set, payload)
+        for band in self._bands(signature):
+            self._buckets.setdefault(band, []).append(key)
+
+
+class NearDuplicateDetector:
+    """
+    检测一道新题与本次试卷中已接受的题目、以及历史题目（只读索引）是否近似重复。
+    """
+
+    def __init__(self, history_index: MinHashIndex = None, threshold: float = DEFAULT_THRESHOLD):
+        self.history_index = history_index
+        self.threshold = threshold
+        self.current_index = MinHashIndex(threshold)
+        self.flagged = 0
+
+    def check(self, question: dict):
+        """
+        检查题目，未重复时把它加入本次试卷的索引。
+
+        :return: None，或 {"source": "current"|"history", "stem": 相似题干, "similarity": 相似度}
+        """
+        shingle_set = shingles(question_text(question))
+        signature = minhash_signature(shingle_set) if shingle_set else None
+        for source, index in (("current", self.current_index), ("history", self.history_index)):
+            if index is None:
+                continue
+            match = index.query(shingle_set, signature, self.threshold)
+            if match is not None:
+                self.flagged += 1
+                return {"source": source, "stem": match[1], "similarity": round(match[2], 3)}
+        self.add(question, shingle_set, signature)
+        return None
+
+    def add(self, question: dict, shingle_set=None, signature=None):
+        """不经检查直接把题目加入本次试卷的索引，例如取自题库的题目或被替换的原题。"""
+        shingle_set = shingle_set if shingle_set is not None else shingles(question_text(question))
+        self.current_index.add(len(self.current_index), shingle_set, question.get("stem"), signature)
+
+
+class HistoryIndexCache:
+    """
+    按来源键缓存历史题目的 MinHash 索引，只增量加入上次构建之后新增的题目。
+
+    :param load_since: 函数 (source, after_id) -> [(id, question), ...]，按 id 升序返回。
+    """
+
+    def __init__(self, load_since, max_size: int = HISTORY_CACHE_SIZE):
+        self.load_since = load_since
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._indexes = OrderedDict()
+
+    def get(self, source) -> MinHashIndex:
+        with self._lock:
+            index, last_id = self._indexes.pop(source, (None, 0))
+            if index is None:
+                index = MinHashIndex()
+            for question_id, question in self.load_since(source, last_id):
+                index.add(question_id, shingles(question_text(question)), question.get("stem"))
+                last_id = question_id
+            self._indexes[source] = (index, last_id)
+            while len(self._indexes) > self.max_size:
+                self._indexes.popitem(last=False)
+            return index
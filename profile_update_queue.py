@@ -0,0 +1,157 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+MAX_PENDING_JOBS = 16
+MAX_SESSIONS_PER_JOB = 20
+DEBOUNCE_SECONDS = 5.0
+MAX_DELAY_SECONDS = 30.0
+
+
+class ProfileUpdateJob:
+    """同一用户画像的待处理更新，可合并多次答题会话。"""
+
+    def __init__(self, profile_key, api_key):
+        self.profile_key = profile_key
+        self.api_key = api_key
+        self.sessions = []
+        self.first_enqueued = time.monotonic()
+        self.last_enqueued = self.first_enqueued
+
+
+class ProfileUpdateQueue:
+    def __init__(self, handler, max_pending: int = MAX_PENDING_JOBS, debounce_seconds: float = DEBOUNCE_SECONDS,
+                 max_sessions_per_job: int = MAX_SESSIONS_PER_JOB, num_workers: int = 1,
+                 max_delay_seconds: float = MAX_DELAY_SECONDS):
+        """
+        有界的用户画像更新队列。
+
+        同一画像的待处理任务会被合并，在最后一次提交后等待 debounce_seconds 再执行，
+        从而一次 LLM 调用即可吸收多次答题会话；持续有新提交时，最迟在第一次提交后
+        max_delay_seconds 执行。待处理任务数达到上限时拒绝新任务。
+
+        :param handler: 执行更新的函数，参数为 (api_key, sessions)，sessions 为 (questions, user_answers) 列表。
+        :param max_pending: 待处理任务（不同画像）的最大数量。
+        :param debounce_seconds: 最后一次提交后的等待时间。
+        :param max_sessions_per_job: 单个任务最多合并的会话数，超出时丢弃最早的会话（计入 sessions_dropped）。
+        :param num_workers: 工作线程数。
+        :param max_delay_seconds: 第一次提交后的最长等待时间。
+        """
+        self.handler = handler
+        self.max_pending = max_pending
+        self.debounce_seconds = debounce_seconds
+        self.max_sessions_per_job = max_sessions_per_job
+        self.max_delay_seconds = max_delay_seconds
+        self._pending = OrderedDict()
+        self._in_flight = 0
+        self._shutting_down = False
+        self._condition = threading.Condition()
+        self._metrics = {
+            "submitted": 0,
+            "coalesced": 0,
+            "rejected": 0,
+            "completed": 0,
+            "failed": 0,
+            "sessions_processed": 0,
+            "sessions_dropped": 0,
+            "last_duration_seconds": 0.0,
+        }
+        self._workers = [
+            threading.Thread(target=self._worker_loop, name=f"profile-update-{i}", daemon=True)
+            for i in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, profile_key, api_key, questions, user_answers) -> bool:
+        """
+        提交一次答题会话。
+
+        :return: 是否被接受；队列已满或正在关闭时返回 False。
+        """
+        with self._condition:
+            if self._shutting_down:
+                return False
+            self._metrics["submitted"] += 1
+            job = self._pending.get(profile_key)
+            if job is None:
+                if len(self._pending) >= self.max_pending:
+                    self._metrics["rejected"] += 1
+                    logger.warning(f"用户画像更新队列已满 ({self.max_pending})，丢弃本次更新。")
+                    return False
+                job = ProfileUpdateJob(profile_key, api_key)
+                self._pending[profile_key] = job
+            else:
+                self._metrics["coalesced"] += 1
+                job.api_key = api_key
+                job.last_enqueued = time.monotonic()
+            job.sessions.append((questions, user_answers))
+            if len(job.sessions) > self.max_sessions_per_job:
+                job.sessions.pop(0)
+                self._metrics["sessions_dropped"] += 1
+                logger.warning(f"用户画像更新任务合并的会话数超过上限 ({self.max_sessions_per_job})，丢弃最早的会话。")
+            self._condition.notify()
+            return True
+
+    def _next_ready_job(self):
+        """返回已过去抖时间（或已达到最长等待时间）的最早任务及需要继续等待的秒数。调用方需持有锁。"""
+        now = time.monotonic()
+        wait = None
+        for key, job in self._pending.items():
+            ready_at = min(job.last_enqueued + self.debounce_seconds, job.first_enqueued + self.max_delay_seconds)
+            remaining = ready_at - now
+            if remaining <= 0 or self._shutting_down:
+                del self._pending[key]
+                return job, None
+            wait = remaining if wait is None else min(wait, remaining)
+        return None, wait
+
+    def _worker_loop(self):
+        while True:
+            with self._condition:
+                while True:
+                    job, wait = self._next_ready_job()
+                    if job is not None:
+                        self._in_flight += 1
+                        break
+                    if self._shutting_down:
+                        return
+                    self._condition.wait(timeout=wait)
+
+            started = time.monotonic()
+            succeeded = False
+            try:
+                logger.info(f"开始处理用户画像更新任务，合并会话数: {len(job.sessions)}")
+                self.handler(job.api_key, job.sessions)
+                succeeded = True
+            except Exception as e:
+                logger.error(f"用户画像更新任务失败: {e}")
+            finally:
+                with self._condition:
+                    self._in_flight -= 1
+                    self._metrics["completed" if succeeded else "failed"] += 1
+                    self._metrics["sessions_processed"] += len(job.sessions)
+                    self._metrics["last_duration_seconds"] = time.monotonic() - started
+                    self._condition.notify_all()
+
+    def metrics(self) -> dict:
+        with self._condition:
+            metrics = dict(self._metrics)
+            metrics["pending"] = len(self._pending)
+            metrics["pending_sessions"] = sum(len(job.sessions) for job in self._pending.values())
+            metrics["in_flight"] = self._in_flight
+            metrics["max_pending"] = self.max_pending
+            return metrics
+
+    def shutdown(self, timeout: float = 60.0):
+        """停止接收新任务，立即执行所有待处理任务（忽略去抖等待），并等待其完成。"""
+        with self._condition:
+            self._shutting_down = True
+            self._condition.notify_all()
+        deadline = time.monotonic() + timeout
+        for worker in self._workers:
+            worker.join(timeout=max(deadline - time.monotonic(), 0))
+        logger.info(f"用户画像更新队列已关闭. 指标: {self.metrics()}")
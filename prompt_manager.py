@@ -1,28 +1,73 @@
 import os
-from jinja2 import Template
+import time
+import threading
+from jinja2 import Environment, FileSystemLoader, TemplateNotFound
 import logging
 
 logger = logging.getLogger(__name__)
 
+PROMPTS_DIR = os.path.join(os.path.dirname(__file__), "prompts")
+# 两次检查模板文件修改时间之间的最小间隔（秒），间隔内的调用完全不访问磁盘
+RELOAD_CHECK_INTERVAL = 2.0
+
+
+class PromptRegistry:
+    """
+    基于 Jinja Environment 的已编译模板注册表。
+    编译结果由 Environment 缓存，文件修改时间变化后自动重新加载；
+    修改时间的检查按 RELOAD_CHECK_INTERVAL 节流，热路径上不访问磁盘。
+    """
+
+    def __init__(self, prompts_dir: str = PROMPTS_DIR, reload_interval: float = RELOAD_CHECK_INTERVAL):
+        self.prompts_dir = prompts_dir
+        self.reload_interval = reload_interval
+        self._env = Environment(loader=FileSystemLoader(prompts_dir, encoding="utf-8"), auto_reload=True, cache_size=-1)
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def get_template(self, prompt_name: str):
+        now = time.monotonic()
+        entry = self._templates.get(prompt_name)
+        if entry is not None and now - entry[1] < self.reload_interval:
+            return entry[0]
+
+        with self._lock:
+            try:
+                template = self._env.get_template(f"{prompt_name}.txt")
+            except TemplateNotFound:
+                self._templates.pop(prompt_name, None)
+                prompt_file_path = os.path.join(self.prompts_dir, f"{prompt_name}.txt")
+                raise FileNotFoundError(f"Prompt a '{prompt_name}' not found at '{prompt_file_path}'")
+            if entry is not None and entry[0] is not template:
+                logger.info(f"提示词模板已更新，重新加载: {prompt_name}")
+            self._templates[prompt_name] = (template, now)
+            return template
+
+    def preload(self):
+        """编译 prompts 目录下的全部模板，启动后首次调用也无需读盘。"""
+        names = [f[:-len(".txt")] for f in os.listdir(self.prompts_dir) if f.endswith(".txt")]
+        for name in names:
+            self.get_template(name)
+        logger.info(f"已预加载 {len(names)} 个提示词模板.")
+
+
+registry = PromptRegistry()
+
+
+def preload_prompts():
+    registry.preload()
+
+
 def get_prompt(prompt_name: str, is_template=False, **kwargs) -> str:
     """
     从prompts文件夹中读取一个prompt模板文件，并用传入的参数渲染它。
+    模板编译后缓存在注册表中，文件修改后会自动重新加载。
 
     :param prompt_name: prompt文件的名称（不含扩展名）。
     :param kwargs: 用于渲染模板的键值对。
     :return: 渲染后的prompt字符串。
     """
-    # 构建prompts文件夹的路径
-    prompts_dir = os.path.join(os.path.dirname(__file__), "prompts")
-    prompt_file_path = os.path.join(prompts_dir, f"{prompt_name}.txt")
-
-    if not os.path.exists(prompt_file_path):
-        raise FileNotFoundError(f"Prompt a '{prompt_name}' not found at '{prompt_file_path}'")
-
-    with open(prompt_file_path, "r", encoding="utf-8") as f:
-        prompt_template_str = f.read()
-    
-        template = Template(prompt_template_str)
+    template = registry.get_template(prompt_name)
     if is_template:
         return template
     else:
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+import threading
+from question_types import Question, validate_question_data, question_fingerprint
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = "data"
+QUESTION_BANK_PATH = os.path.join(DATA_DIR, "question_bank.sqlite3")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS questions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    source_key TEXT NOT NULL,
+    question_type TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL DEFAULT 0,
+    use_count INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (source_key, fingerprint)
+);
+DROP INDEX IF EXISTS idx_questions_lookup;
+CREATE INDEX IF NOT EXISTS idx_questions_usage
+    ON questions (source_key, question_type, use_count, last_used_at);
+CREATE INDEX IF NOT EXISTS idx_questions_fingerprint ON questions (fingerprint);
+"""
+
+
+def source_key(content_hashes) -> str:
+    """由参考资料的内容哈希生成题库的来源键，与文件名和上传顺序无关。"""
+    return hashlib.sha256("\n".join(sorted(content_hashes)).encode("utf-8")).hexdigest()
+
+
+def normalize_question(data):
+    """用 Question 模型校验并规范化题目字典，不合法时返回 None。"""
+    try:
+        question = Question.from_dict(data).to_dict()
+    except (ValueError, KeyError, AttributeError):
+        return None
+    return question if validate_question_data(question) else None
+
+
+class QuestionBank:
+    """
+    基于 SQLite 的本地题库。
+
+    题目以 Question.to_dict() 的形式存储，按来源资料、题型与题干指纹建立索引；
+    同一来源下题干指纹相同的题目只保存一份。每个线程使用独立的连接。
+    """
+
+    def __init__(self, path: str = QUESTION_BANK_PATH):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def add_questions(self, source, questions) -> int:
+        """
+        批量保存题目，已存在（同一来源下题干指纹相同）的题目被忽略。
+
+        :param source: source_key() 生成的来源键。
+        :param questions: 题目字典列表，不合法的题目会被跳过。
+        :return: 实际新增的题目数。
+        """
+        now = time.time()
+        rows = []
+        for data in questions:
+            question = normalize_question(data)
+            if question is None:
+                logger.warning(f"跳过不合法的题目，不存入题库: {data}")
+                continue
+            rows.append((
+                source,
+                question["question_type"],
+                question_fingerprint(question),
+                json.dumps(question, ensure_ascii=False),
+                now,
+            ))
+        if not rows:
+            return 0
+        with self._connect() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO questions (source_key, question_type, fingerprint, data, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            added = conn.total_changes - before
+        logger.info(f"题库新增题目 {added} 道（提交 {len(rows)} 道）.")
+        return added
+
+    def take_questions(self, source, question_type: str, limit: int, exclude_fingerprints=()) -> list:
+        """
+        取出同一来源下指定题型的题目，优先使用次数最少、最久未使用的题目，并记录本次使用。
+
+        :return: 题目字典列表，数量不超过 limit。
+        """
+        if limit <= 0:
+            return []
+        query = "SELECT id, fingerprint, data FROM questions WHERE source_key = ? AND question_type = ?"
+        query += " ORDER BY use_count, last_used_at LIMIT ?"
+        params = [source, question_type, limit + len(exclude_fingerprints)]
+
+        excluded = set(exclude_fingerprints)
+        with self._connect() as conn:
+            rows = [row for row in conn.execute(query, params) if row["fingerprint"] not in excluded][:limit]
+            conn.executemany(
+                "UPDATE questions SET use_count = use_count + 1, last_used_at = ? WHERE id = ?",
+                [(time.time(), row["id"]) for row in rows],
+            )
+        return [json.loads(row["data"]) for row in rows]
+
+    def questions_since(self, source, after_id: int = 0) -> list:
+        """按 id 升序返回同一来源下 id 大于 after_id 的 (id, 题目字典)，用于增量构建索引。"""
+        rows = self._connect().execute(
+            "SELECT id, data FROM questions WHERE source_key = ? AND id > ? ORDER BY id", (source, after_id)
+        )
+        return [(row["id"], json.loads(row["data"])) for row in rows]
+
+    def export_questions(self, source=None) -> list:
+        """导出题库中的题目，可按来源键过滤。"""
+        query = "SELECT source_key, data FROM questions"
+        params = []
+        if source:
+            query += " WHERE source_key = ?"
+            params.append(source)
+        query += " ORDER BY id"
+        return [
+            {"source_key": row["source_key"], "question": json.loads(row["data"])}
+            for row in self._connect().execute(query, params)
+        ]
+
+    def import_questions(self, records) -> dict:
+        """
+        批量导入 export_questions 格式的记录。
+
+        :return: {"received": 记录数, "imported": 新增题目数}
+        """
+        grouped = {}
+        for record in records:
+            if not isinstance(record, dict) or not isinstance(record.get("question"), dict):
+                continue
+            grouped.setdefault(record.get("source_key") or "imported", []).append(record["question"])
+        imported = sum(self.add_questions(source, questions) for source, questions in grouped.items())
+        return {"received": len(records), "imported": imported}
+
+    def count(self, source=None) -> int:
+        if source:
+            row = self._connect().execute("SELECT COUNT(*) FROM questions WHERE source_key = ?", (source,)).fetchone()
+        else:
+            row = self._connect().execute("SELECT COUNT(*) FROM questions").fetchone()
+        return row[0]
+
+
+question_bank = QuestionBank()
@@ -1,3 +1,6 @@
+import re
+
+
 class Question:
     def __init__(self, question_type, stem, answer, score=5):
         self.question_type = question_type
@@ -69,4 +72,32 @@ class ShortAnswerQuestion(Question):
             stem=data.get("stem"),
             answer=data.get("answer"),
             score=data.get("score", 10),
-        ) 
\ No newline at end of file
+        ) 
+
+# 每种题型的 JSON 对象必须包含的字段，与 exam_generation_prompt_formatting 中的格式定义一致
+REQUIRED_FIELDS = {
+    "multiple_choice": ("stem", "options", "answer", "score"),
+    "fill_in_the_blank": ("stem", "answer", "score"),
+    "short_answer": ("stem", "answer", "score"),
+}
+
+
+def validate_question_data(data):
+    """检查模型输出的题目对象是否符合对应题型的结构。"""
+    fields = REQUIRED_FIELDS.get(data.get("question_type"))
+    if fields is None or any(data.get(field) in (None, "") for field in fields):
+        return False
+    if not isinstance(data.get("stem"), str):
+        return False
+    if "options" in fields and not isinstance(data.get("options"), dict):
+        return False
+    return isinstance(data.get("score"), (int, float)) and not isinstance(data.get("score"), bool)
+
+
+_FINGERPRINT_IGNORED = re.compile(r'[\s\W_]+')
+
+
+def question_fingerprint(question):
+    """题目去重用的指纹：忽略空白、标点与大小写后的题型与题干。"""
+    stem = _FINGERPRINT_IGNORED.sub('', str(question.get("stem", ""))).lower()
+    return f"{question.get('question_type')}:{stem}"
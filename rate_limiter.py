@@ -0,0 +1,240 @@
+import time
+import asyncio
+import random
+import hashlib
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger(__name__)
+
+# 每个 API Key 每秒允许发起的请求数及突发容量
+DEFAULT_REQUESTS_PER_SECOND = 10.0
+DEFAULT_BURST = 20
+# AIMD 并发窗口
+INITIAL_WINDOW = 8.0
+MIN_WINDOW = 1.0
+MAX_WINDOW = 32.0
+DECREASE_FACTOR = 0.5
+# 延迟超过基线的该倍数时，视为上游开始排队，窗口温和收缩
+LATENCY_TOLERANCE = 2.0
+LATENCY_DECREASE_FACTOR = 0.9
+# 延迟至少比基线高出该秒数才触发收缩，避免基线很小时被正常抖动误触发
+LATENCY_SLACK = 0.5
+# 等待配额的最长时间（秒）
+ACQUIRE_TIMEOUT = 120.0
+# 等待配额期间检查请求是否已取消的间隔（秒）
+CANCEL_POLL_INTERVAL = 0.25
+# 异步等待配额时重新检查的最长间隔（秒）
+ASYNC_POLL_INTERVAL = 0.05
+# 指数退避
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+
+class LimiterTimeout(Exception):
+    """在 ACQUIRE_TIMEOUT 内没有等到上游调用配额。"""
+
+
+def parse_retry_after(headers):
+    """
+    从响应头中解析服务器要求的等待时间（秒），支持 retry-after-ms、
+    以秒为单位的 Retry-After 以及 HTTP 日期格式的 Retry-After。无法解析时返回 None。
+    """
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(float(value) / 1000, 0.0)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: float = None, base: float = BACKOFF_BASE, cap: float = BACKOFF_MAX) -> float:
+    """带完全抖动的指数退避；服务器给出 Retry-After 时至少等待该时长。"""
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, cap))
+    return delay
+
+
+class KeyRateLimiter:
+    """
+    单个 API Key 的上游调用限制器：令牌桶限制请求速率，AIMD 窗口限制并发数。
+
+    - 成功的调用使窗口每个往返加性增长约 1；
+    - 429 使窗口减半，并让所有请求在 Retry-After 之前暂停；
+    - 延迟明显高于基线（观测到的最低延迟的滑动估计）时窗口温和收缩。
+    """
+
+    def __init__(self, requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND, burst: int = DEFAULT_BURST,
+                 initial_window: float = INITIAL_WINDOW, min_window: float = MIN_WINDOW,
+                 max_window: float = MAX_WINDOW):
+        self.rate = requests_per_second
+        self.capacity = burst
+        self.min_window = min_window
+        self.max_window = max_window
+        self.window = initial_window
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._in_flight = 0
+        self._baseline_latency = {}
+        self._condition = threading.Condition()
+        self._metrics = {"acquired": 0, "throttled": 0, "latency_decreases": 0, "timeouts": 0, "total_wait_seconds": 0.0}
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def _try_acquire(self, started: float, deadline: float, timeout: float, cancelled):
+        """
+        尝试取得配额，调用方需持有锁。成功时返回 None，否则返回建议的等待时间（秒）。
+        超时或已取消时抛出 LimiterTimeout。
+        """
+        now = time.monotonic()
+        if cancelled is not None and cancelled():
+            raise LimiterTimeout("请求已取消，放弃等待上游调用配额")
+        self._refill(now)
+        if now >= self._paused_until and self._in_flight < int(self.window) and self._tokens >= 1:
+            self._tokens -= 1
+            self._in_flight += 1
+            self._metrics["acquired"] += 1
+            self._metrics["total_wait_seconds"] += now - started
+            return None
+        if now >= deadline:
+            self._metrics["timeouts"] += 1
+            raise LimiterTimeout(f"等待上游调用配额超时 ({timeout:.0f} 秒)")
+        waits = [deadline - now]
+        if now < self._paused_until:
+            waits.append(self._paused_until - now)
+        elif self._tokens < 1:
+            waits.append((1 - self._tokens) / self.rate)
+        if cancelled is not None:
+            waits.append(CANCEL_POLL_INTERVAL)
+        return max(min(waits), 0.001)
+
+    def acquire(self, timeout: float = ACQUIRE_TIMEOUT, cancelled=None):
+        """
+        等待令牌与并发窗口中的空位。超时抛出 LimiterTimeout。
+
+        :param cancelled: 可选的无参函数，返回 True 时放弃等待并抛出 LimiterTimeout（例如请求已被取消）。
+        """
+        started = time.monotonic()
+        deadline = started + timeout
+        with self._condition:
+            while True:
+                wait = self._try_acquire(started, deadline, timeout, cancelled)
+                if wait is None:
+                    return
+                # 并发窗口已满时等待 release 的通知
+                self._condition.wait(timeout=wait)
+
+    async def acquire_async(self, timeout: float = ACQUIRE_TIMEOUT, cancelled=None):
+        """
+        acquire 的异步版本，等待时不占用线程。
+
+        事件循环中无法等待 release 的通知，并发窗口已满时每 ASYNC_POLL_INTERVAL 秒重新检查一次。
+        """
+        started = time.monotonic()
+        deadline = started + timeout
+        while True:
+            with self._condition:
+                wait = self._try_acquire(started, deadline, timeout, cancelled)
+            if wait is None:
+                return
+            await asyncio.sleep(min(wait, ASYNC_POLL_INTERVAL))
+
+    def release(self, outcome: str = "ok", latency: float = None, kind: str = "default", retry_after: float = None):
+        """
+        归还并发窗口中的位置，并根据本次调用的结果调整窗口。
+
+        :param outcome: "ok" 表示成功，"throttled" 表示收到 429，"error" 表示其他失败（窗口不变）。
+        :param latency: 可比较的延迟（如流式调用的首包延迟），为 None 时成功的调用只做加性增长。
+        :param kind: 延迟基线的类别，不同模型、不同调用方式的延迟不可比，分别统计。
+        :param retry_after: 服务器要求的等待时间，期间暂停该 API Key 的所有调用。
+        """
+        with self._condition:
+            self._in_flight = max(self._in_flight - 1, 0)
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            if outcome == "throttled":
+                self.window = max(self.min_window, self.window * DECREASE_FACTOR)
+                self._metrics["throttled"] += 1
+                logger.warning(f"上游返回 429，并发窗口收缩为 {self.window:.2f}，暂停 {retry_after or 0:.1f} 秒.")
+            elif outcome == "ok":
+                if self._latency_exceeded(latency, kind):
+                    self.window = max(self.min_window, self.window * LATENCY_DECREASE_FACTOR)
+                    self._metrics["latency_decreases"] += 1
+                else:
+                    self.window = min(self.max_window, self.window + 1.0 / self.window)
+            self._condition.notify_all()
+
+    def _latency_exceeded(self, latency, kind) -> bool:
+        """更新延迟基线，并判断本次延迟是否明显高于基线。调用方需持有锁。"""
+        if latency is None:
+            return False
+        baseline = self._baseline_latency.get(kind)
+        if baseline is None or latency < baseline:
+            baseline = latency
+        else:
+            # 基线缓慢向上漂移，以适应上游的正常变化
+            baseline += (latency - baseline) * 0.01
+        self._baseline_latency[kind] = baseline
+        return latency > max(baseline * LATENCY_TOLERANCE, baseline + LATENCY_SLACK) and self.window > self.min_window
+
+    def state(self) -> dict:
+        with self._condition:
+            self._refill(time.monotonic())
+            state = dict(self._metrics)
+            state.update({
+                "window": round(self.window, 2),
+                "in_flight": self._in_flight,
+                "tokens": round(self._tokens, 2),
+                "paused_for_seconds": round(max(self._paused_until - time.monotonic(), 0.0), 2),
+                "baseline_latency": {kind: round(value, 3) for kind, value in self._baseline_latency.items()},
+            })
+            return state
+
+
+class RateLimiterRegistry:
+    """按 API Key 的哈希维护各自的限制器。"""
+
+    def __init__(self, **limiter_kwargs):
+        self.limiter_kwargs = limiter_kwargs
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_id(api_key: str) -> str:
+        return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:12]
+
+    def get(self, api_key: str) -> KeyRateLimiter:
+        key = self.key_id(api_key)
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                limiter = KeyRateLimiter(**self.limiter_kwargs)
+                self._limiters[key] = limiter
+            return limiter
+
+    def metrics(self) -> dict:
+        """各 API Key（以哈希前缀标识）的限制器状态。"""
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {key: limiter.state() for key, limiter in limiters.items()}
+
+
+rate_limiters = RateLimiterRegistry()
@@ -0,0 +1,214 @@
+import re
+import math
+import logging
+import threading
+from collections import Counter, OrderedDict
+from typing import List, Tuple
+
+from document_extractor import format_documents, file_content_hash
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 600
+CHUNK_OVERLAP = 80
+BM25_K1 = 1.5
+BM25_B = 0.75
+INDEX_CACHE_SIZE = 64
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+|[\u4e00-\u9fff]+")
+_CJK_PATTERN = re.compile(r"[\u4e00-\u9fff]")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    将文本切分为检索词项：英文和数字按单词切分，连续的中文按字二元组切分（单字则保留单字）。
+    """
+    terms = []
+    for match in _TOKEN_PATTERN.finditer(text.lower()):
+        token = match.group(0)
+        if _CJK_PATTERN.match(token):
+            if len(token) == 1:
+                terms.append(token)
+            else:
+                terms.extend(token[i:i + 2] for i in range(len(token) - 1))
+        else:
+            terms.append(token)
+    return terms
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估计文本的token数：中文每字约1个token，其它字符约4个字符1个token。"""
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    return cjk_count + (len(text) - cjk_count) // 4 + 1
+
+
+def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    """
+    按段落将文本合并为长度约为 chunk_size 的片段，超长段落按固定窗口切分，相邻窗口保留 overlap 个字符的重叠。
+    """
+    chunks = []
+    current = ""
+    for paragraph in re.split(r"\n\s*\n|\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) > chunk_size:
+            if current:
+                chunks.append(current)
+                current = ""
+            step = max(chunk_size - overlap, 1)
+            for start in range(0, len(paragraph), step):
+                chunks.append(paragraph[start:start + chunk_size])
+                if start + chunk_size >= len(paragraph):
+                    break
+            continue
+        if current and len(current) + len(paragraph) + 1 > chunk_size:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class DocumentIndex:
+    """单个文档的倒排索引，保存分块、词频与文档频率，供 BM25 打分使用。"""
+
+    def __init__(self, text: str):
+        self.chunks = chunk_text(text)
+        self.lengths = []
+        self.postings = {}
+        self.doc_freq = Counter()
+        for chunk_id, chunk in enumerate(self.chunks):
+            term_freq = Counter(tokenize(chunk))
+            self.lengths.append(sum(term_freq.values()))
+            for term, freq in term_freq.items():
+                self.postings.setdefault(term, []).append((chunk_id, freq))
+                self.doc_freq[term] += 1
+        self.total_length = sum(self.lengths)
+
+
+_index_cache = OrderedDict()
+_index_cache_lock = threading.Lock()
+
+
+def build_index(content_hash: str, text: str) -> DocumentIndex:
+    """为文档构建（或复用已缓存的）倒排索引，以内容哈希为键。"""
+    with _index_cache_lock:
+        index = _index_cache.get(content_hash)
+        if index is not None:
+            _index_cache.move_to_end(content_hash)
+            return index
+
+    index = DocumentIndex(text)
+    logger.info(f"已构建检索索引: {content_hash[:12]}, 片段数: {len(index.chunks)}")
+    with _index_cache_lock:
+        _index_cache[content_hash] = index
+        while len(_index_cache) > INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return index
+
+
+def evict_index(content_hash: str, remaining_paths=None):
+    """
+    删除内容哈希对应的检索索引。如果其它仍在使用的文件内容相同，则保留索引。
+
+    :param content_hash: 即将被删除的文件的内容哈希。
+    :param remaining_paths: 删除后仍然保留的文件路径列表。
+    """
+    for other_path in remaining_paths or []:
+        try:
+            if file_content_hash(other_path) == content_hash:
+                logger.info(f"其它文件仍引用相同内容，保留检索索引: {content_hash[:12]}")
+                return
+        except FileNotFoundError:
+            continue
+    with _index_cache_lock:
+        _index_cache.pop(content_hash, None)
+
+
+def search(indices: List[DocumentIndex], query: str, top_k: int) -> List[Tuple[float, int, int]]:
+    """
+    在多个文档索引上以 BM25 打分检索，词项统计量按整个语料合并计算。
+
+    :return: 按得分降序排列的 (得分, 文档序号, 片段序号) 列表。
+    """
+    query_terms = set(tokenize(query))
+    total_chunks = sum(len(index.chunks) for index in indices)
+    if not query_terms or total_chunks == 0:
+        return []
+
+    avg_length = sum(index.total_length for index in indices) / total_chunks or 1
+    scores = {}
+    for term in query_terms:
+        doc_freq = sum(index.doc_freq.get(term, 0) for index in indices)
+        if doc_freq == 0:
+            continue
+        idf = math.log(1 + (total_chunks - doc_freq + 0.5) / (doc_freq + 0.5))
+        for doc_id, index in enumerate(indices):
+            for chunk_id, freq in index.postings.get(term, ()):
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * index.lengths[chunk_id] / avg_length)
+                key = (doc_id, chunk_id)
+                scores[key] = scores.get(key, 0.0) + idf * freq * (BM25_K1 + 1) / (freq + norm)
+
+    ranked = sorted(((score, doc_id, chunk_id) for (doc_id, chunk_id), score in scores.items()), reverse=True)
+    return ranked[:top_k]
+
+
+def build_context(documents, query: str, top_k: int = 12, token_budget: int = 12000, related_only: bool = False) -> str:
+    """
+    为出题构造学习材料上下文。
+    语料总量不超过预算时原样返回全部内容；否则先按 BM25 选出与查询最相关的 top_k 个片段，
+    再用在全文中均匀分布的片段填满剩余预算，保证知识点覆盖面。
+
+    :param documents: (文件名, 内容哈希, 文本) 列表。
+    :param query: 检索查询，例如用户要求与题型，或题干。
+    :param top_k: 按相关性选取的片段数上限。
+    :param token_budget: 上下文的token预算。
+    :param related_only: 只返回与查询相关的片段（用于单题再生成），没有任何命中时才退回均匀覆盖。
+    :return: 带来源标记的上下文字符串。
+    """
+    if not related_only:
+        full_content = format_documents(documents)
+        if estimate_tokens(full_content) <= token_budget:
+            return full_content
+
+    indices = [build_index(content_hash, text) for _, content_hash, text in documents]
+    selected = []
+    selected_keys = set()
+    used_tokens = 0
+
+    def try_select(doc_id, chunk_id):
+        nonlocal used_tokens
+        key = (doc_id, chunk_id)
+        if key in selected_keys:
+            return True
+        cost = estimate_tokens(indices[doc_id].chunks[chunk_id])
+        if used_tokens + cost > token_budget:
+            return False
+        selected.append(key)
+        selected_keys.add(key)
+        used_tokens += cost
+        return True
+
+    for _, doc_id, chunk_id in search(indices, query, top_k):
+        try_select(doc_id, chunk_id)
+
+    all_chunks = [(doc_id, chunk_id) for doc_id, index in enumerate(indices) for chunk_id in range(len(index.chunks))]
+    fill_coverage = not related_only or not selected
+    if fill_coverage and all_chunks and used_tokens < token_budget:
+        average_cost = max(sum(estimate_tokens(indices[d].chunks[c]) for d, c in all_chunks) // len(all_chunks), 1)
+        slots = max((token_budget - used_tokens) // average_cost, 1)
+        stride = max(len(all_chunks) / slots, 1)
+        position = 0.0
+        while position < len(all_chunks):
+            try_select(*all_chunks[int(position)])
+            position += stride
+
+    logger.info(f"检索完成: 共 {len(all_chunks)} 个片段，选取 {len(selected)} 个，约 {used_tokens} tokens")
+
+    parts = []
+    for doc_id, chunk_id in sorted(selected):
+        filename = documents[doc_id][0]
+        parts.append(f"--- 来自文件: {filename} (片段 {chunk_id + 1}) ---\n{indices[doc_id].chunks[chunk_id]}")
+    return "\n\n".join(parts)
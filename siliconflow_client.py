@@ -1,37 +1,924 @@
 import os
-from openai import OpenAI, APIError
-from typing import List, Dict, Generator, Union
+import json
+import httpx
+import asyncio
+from openai import OpenAI, AsyncOpenAI, APIError, APIConnectionError, InternalServerError, RateLimitError
+from typing import List, Dict, Generator, Union, Callable
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from prompt_manager import get_prompt
+from llm_json_parser import repair_json_objects
+from single_flight import SingleFlight
+from rate_limiter import rate_limiters, backoff_delay, parse_retry_after, LimiterTimeout, ACQUIRE_TIMEOUT
+from llm_cassette import llm_cassette
+from cancellation import CancelScope, RequestCancelled, DeadlineExceeded
+from metrics import (Trace, LLM_CALLS, LLM_CALL_DURATION, LLM_OUTPUT_BYTES, LLM_RETRIES, LLM_STREAMS_CANCELLED,
+                     LLM_TIME_TO_FIRST_TOKEN, LLM_TOKENS_PER_SECOND)
+import hashlib
 import logging
+import threading
 import time
 
 logger = logging.getLogger(__name__)
 
+SECURITY_CACHE_SIZE = 1024
+SECURITY_CACHE_TTL = 3600
+
+CLIENT_POOL_SIZE = 32
+CLIENT_IDLE_TIMEOUT = 300
+# 被淘汰的客户端在关闭前保留的时间，确保仍在进行的流式响应能够读完
+CLIENT_RETIRE_GRACE = 900
+MAX_CONNECTIONS_PER_CLIENT = 20
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class SecurityVerdictCache:
+    """
+    安全检查结论的 LRU/TTL 缓存，以待检查内容的哈希为键。
+    相同的用户输入在有效期内不再重复调用模型。
+    """
+
+    def __init__(self, max_size: int = SECURITY_CACHE_SIZE, ttl: float = SECURITY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, content: str) -> str:
+        return hashlib.sha256(f"{model}\n{content}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            verdict, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return verdict
+
+    def put(self, key: str, verdict: bool):
+        with self._lock:
+            self._entries[key] = (verdict, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+security_verdict_cache = SecurityVerdictCache()
+
+
+_ssl_context = None
+_ssl_context_lock = threading.Lock()
+
+
+def _shared_ssl_context():
+    """所有客户端共用的 SSL 上下文。加载 CA 证书需要数十毫秒，不在每次创建客户端时重复（异步模式下会阻塞事件循环）。"""
+    global _ssl_context
+    with _ssl_context_lock:
+        if _ssl_context is None:
+            _ssl_context = httpx.create_ssl_context()
+        return _ssl_context
+
+
+class ClientRegistry:
+    """
+    进程级的 OpenAI 客户端注册表，按 (API Key 哈希, base_url) 复用客户端及其 httpx 连接池。
+    容量有上限，空闲超时或超出容量的客户端会被淘汰，并在宽限期后关闭。
+    """
+
+    def __init__(self, max_size: int = CLIENT_POOL_SIZE, idle_timeout: float = CLIENT_IDLE_TIMEOUT,
+                 retire_grace: float = CLIENT_RETIRE_GRACE):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.retire_grace = retire_grace
+        self._clients = OrderedDict()
+        self._retired = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _http_client_options() -> dict:
+        return {
+            "http2": HTTP2_AVAILABLE,
+            "verify": _shared_ssl_context(),
+            "limits": httpx.Limits(
+                max_connections=MAX_CONNECTIONS_PER_CLIENT,
+                max_keepalive_connections=MAX_CONNECTIONS_PER_CLIENT,
+                keepalive_expiry=CLIENT_IDLE_TIMEOUT,
+            ),
+            "timeout": httpx.Timeout(600.0, connect=10.0),
+        }
+
+    def _make_client(self, api_key: str, base_url: str):
+        # 重试由 _call_llm_with_retry 统一负责，关闭 SDK 自带的重试，避免重试次数叠加
+        return OpenAI(api_key=api_key, base_url=base_url, http_client=httpx.Client(**self._http_client_options()),
+                      max_retries=0)
+
+    def _close_client(self, client):
+        client.close()
+
+    def get(self, api_key: str, base_url: str) -> OpenAI:
+        key = (hashlib.sha256(api_key.encode("utf-8")).hexdigest(), base_url)
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            entry = self._clients.get(key)
+            if entry is not None:
+                entry[1] = now
+                self._clients.move_to_end(key)
+                return entry[0]
+
+            client = self._make_client(api_key, base_url)
+            self._clients[key] = [client, now]
+            logger.info(f"创建新的LLM客户端. base_url: {base_url}, HTTP/2: {HTTP2_AVAILABLE}, 当前客户端数: {len(self._clients)}")
+            while len(self._clients) > self.max_size:
+                _, (evicted, _) = self._clients.popitem(last=False)
+                self._retired.append((evicted, now))
+            return client
+
+    def _sweep(self, now: float):
+        """淘汰空闲超时的客户端，并关闭宽限期已过的已淘汰客户端。调用方需持有锁。"""
+        for key in [k for k, (_, last_used) in self._clients.items() if now - last_used > self.idle_timeout]:
+            evicted, _ = self._clients.pop(key)
+            self._retired.append((evicted, now))
+
+        still_retired = []
+        for client, retired_at in self._retired:
+            if now - retired_at > self.retire_grace:
+                self._close_client(client)
+            else:
+                still_retired.append((client, retired_at))
+        self._retired = still_retired
+
+    def close_all(self):
+        with self._lock:
+            for client, _ in self._clients.values():
+                self._close_client(client)
+            for client, _ in self._retired:
+                self._close_client(client)
+            self._clients.clear()
+            self._retired = []
+
+
+class AsyncClientRegistry(ClientRegistry):
+    """
+    异步服务模式使用的 AsyncOpenAI 客户端注册表，复用与淘汰策略与 ClientRegistry 相同。
+    客户端绑定创建它的事件循环，只应在该事件循环中使用。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._closing = set()
+
+    def _make_client(self, api_key: str, base_url: str):
+        return AsyncOpenAI(api_key=api_key, base_url=base_url,
+                           http_client=httpx.AsyncClient(**self._http_client_options()), max_retries=0)
+
+    def _close_client(self, client):
+        try:
+            task = asyncio.get_running_loop().create_task(client.close())
+        except RuntimeError:
+            # 没有运行中的事件循环（例如进程退出时），连接随进程释放
+            return
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+
+client_registry = ClientRegistry()
+async_client_registry = AsyncClientRegistry()
+_security_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="security-check")
+
+
+class _LimitedStream:
+    """包装上游流，在流读完、出错或被关闭时归还限制器中的并发位置。"""
+
+    def __init__(self, stream, limiter, latency: float, kind: str):
+        self._stream = stream
+        self._iterator = self._make_iterator(stream)
+        self._limiter = limiter
+        self._latency = latency
+        self._kind = kind
+        self._released = False
+
+    @staticmethod
+    def _make_iterator(stream):
+        return iter(stream)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            self._release("ok")
+            raise
+        except Exception:
+            self._release("error")
+            raise
+
+    def _release(self, outcome: str):
+        if not self._released:
+            self._released = True
+            self._limiter.release(outcome, latency=self._latency, kind=self._kind)
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            # 调用方提前关闭的流同样视为上游调用成功
+            self._release("ok")
+
+    def __del__(self):
+        if not self._released:
+            self._release("ok")
+
+
+class _AsyncLimitedStream(_LimitedStream):
+    """_LimitedStream 的异步版本，包装 AsyncOpenAI 的流式响应。"""
+
+    @staticmethod
+    def _make_iterator(stream):
+        return stream.__aiter__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._iterator.__anext__()
+        except StopAsyncIteration:
+            self._release("ok")
+            raise
+        except Exception:
+            self._release("error")
+            raise
+
+    async def aclose(self):
+        try:
+            await self._stream.close()
+        finally:
+            self._release("ok")
+
+
+def _acquire_options(cancel_scope: CancelScope) -> dict:
+    """限制器等待配额的参数：不超过请求的剩余时间，请求取消时放弃等待。"""
+    if cancel_scope is None:
+        return {}
+    remaining = cancel_scope.remaining()
+    return {
+        "timeout": ACQUIRE_TIMEOUT if remaining is None else min(ACQUIRE_TIMEOUT, remaining),
+        "cancelled": lambda: cancel_scope.cancelled,
+    }
+
+
+def _request_options(cancel_scope: CancelScope) -> dict:
+    """单次调用（流式时为每次读取）的超时不超过请求的剩余时间。"""
+    remaining = cancel_scope.remaining() if cancel_scope is not None else None
+    return {} if remaining is None else {"timeout": max(remaining, 0.001)}
+
+
+def _retryable_failure(error):
+    """
+    只有 429、5xx 与连接/超时错误可以重试。
+
+    :return: 可重试时为 (限制器的调用结果, 重试原因, Retry-After 秒数)，否则为 None。
+    """
+    if isinstance(error, RateLimitError):
+        return "throttled", "throttled", parse_retry_after(error.response.headers)
+    if isinstance(error, InternalServerError):
+        return "error", "server_error", parse_retry_after(error.response.headers)
+    if isinstance(error, APIConnectionError):
+        return "error", "connection", None
+    return None
+
+
+def _retry_delay(attempt: int, retries: int, retry_after, error, cancel_scope: CancelScope, model: str) -> float:
+    """
+    计算下一次重试前的等待时间并记录重试。请求已取消或剩余时间不足以等待时抛出对应的异常。
+    """
+    delay = backoff_delay(attempt, retry_after)
+    if cancel_scope is not None:
+        if cancel_scope.cancelled:
+            LLM_CALLS.inc(model=model, outcome="cancelled")
+            raise cancel_scope.error() from error
+        remaining = cancel_scope.remaining()
+        if remaining is not None and remaining <= delay:
+            logger.warning(f"LLM API调用失败 (尝试 {attempt + 1}/{retries}): {error}。"
+                           f"请求剩余时间 {remaining:.2f} 秒，不足以等待重试.")
+            LLM_CALLS.inc(model=model, outcome="cancelled")
+            raise DeadlineExceeded() from error
+    LLM_RETRIES.inc(model=model, reason=_retryable_failure(error)[1])
+    logger.warning(f"LLM API调用失败 (尝试 {attempt + 1}/{retries}): {error}。{delay:.2f}秒后重试...")
+    return delay
+
+
 def _call_llm_with_retry(
     client: OpenAI,
     retries: int = 3,
+    cancel_scope: CancelScope = None,
     **kwargs,
 ):
     """
     通过重试机制调用OpenAI聊天补全API。
 
+    每次尝试前从该 API Key 的限制器获取配额；只有 429、5xx 与连接/超时错误会重试，
+    按带抖动的指数退避等待，并遵守服务器返回的 Retry-After。其他错误直接抛出。
+    流式调用在流结束前一直占用并发窗口中的位置。
+
+    指定 cancel_scope 时，等待配额、单次调用的超时与退避等待都不超过请求的剩余时间；
+    请求被取消或剩余时间不足以再次重试时抛出 RequestCancelled / DeadlineExceeded。
+
     :param client: OpenAI客户端实例。
-    :param retries: 重试次数。
+    :param retries: 最多尝试次数。
+    :param cancel_scope: 所属请求的取消范围。
     :param kwargs: 传递给 client.chat.completions.create 的参数。
     :return: API调用结果。
     """
+    limiter = rate_limiters.get(client.api_key)
+    model = kwargs.get("model")
+    stream = bool(kwargs.get("stream"))
+    kind = f"{model}:{'stream' if stream else 'complete'}"
     last_exception = None
     for attempt in range(retries):
+        if cancel_scope is not None:
+            cancel_scope.raise_if_cancelled()
         try:
-            return client.chat.completions.create(**kwargs)
-        except APIError as e:
-            logger.warning(f"LLM API调用失败 (尝试 {attempt + 1}/{retries}): {e}。1秒后重试...")
+            limiter.acquire(**_acquire_options(cancel_scope))
+        except LimiterTimeout:
+            if cancel_scope is not None:
+                cancel_scope.raise_if_cancelled()
+            raise
+        started = time.monotonic()
+        try:
+            response = client.chat.completions.create(**kwargs, **_request_options(cancel_scope))
+        except BaseException as e:
+            failure = _retryable_failure(e)
+            if failure is None:
+                limiter.release("error")
+                LLM_CALLS.inc(model=model, outcome="error")
+                raise
+            outcome, _, retry_after = failure
+            limiter.release(outcome, retry_after=retry_after)
+            last_exception = e
+        else:
+            LLM_CALLS.inc(model=model, outcome="ok")
+            latency = time.monotonic() - started
+            if stream:
+                # 流式调用返回时已收到响应头，首包延迟可以反映上游的排队情况
+                return _LimitedStream(response, limiter, latency, kind)
+            # 非流式调用的耗时主要取决于输出长度，不作为延迟信号
+            limiter.release("ok", kind=kind)
+            return response
+
+        if attempt + 1 < retries:
+            delay = _retry_delay(attempt, retries, retry_after, last_exception, cancel_scope, model)
+            if cancel_scope is None:
+                time.sleep(delay)
+            elif cancel_scope.wait(delay):
+                LLM_CALLS.inc(model=model, outcome="cancelled")
+                raise cancel_scope.error() from last_exception
+    logger.error(f"LLM API在 {retries} 次尝试后仍然失败。")
+    LLM_CALLS.inc(model=model, outcome="error")
+    raise last_exception
+
+
+async def _acall_llm_with_retry(
+    client: AsyncOpenAI,
+    retries: int = 3,
+    cancel_scope: CancelScope = None,
+    **kwargs,
+):
+    """
+    _call_llm_with_retry 的异步版本，重试、限流与截止时间的处理相同。
+    客户端断开时所在任务被取消，CancelledError 直接向上传播，占用的配额按调用成功归还。
+    """
+    limiter = rate_limiters.get(client.api_key)
+    model = kwargs.get("model")
+    stream = bool(kwargs.get("stream"))
+    kind = f"{model}:{'stream' if stream else 'complete'}"
+    last_exception = None
+    for attempt in range(retries):
+        if cancel_scope is not None:
+            cancel_scope.raise_if_cancelled()
+        try:
+            await limiter.acquire_async(**_acquire_options(cancel_scope))
+        except LimiterTimeout:
+            if cancel_scope is not None:
+                cancel_scope.raise_if_cancelled()
+            raise
+        started = time.monotonic()
+        try:
+            response = await client.chat.completions.create(**kwargs, **_request_options(cancel_scope))
+        except asyncio.CancelledError:
+            limiter.release("ok")
+            LLM_CALLS.inc(model=model, outcome="cancelled")
+            raise
+        except BaseException as e:
+            failure = _retryable_failure(e)
+            if failure is None:
+                limiter.release("error")
+                LLM_CALLS.inc(model=model, outcome="error")
+                raise
+            outcome, _, retry_after = failure
+            limiter.release(outcome, retry_after=retry_after)
             last_exception = e
-            time.sleep(1)
+        else:
+            LLM_CALLS.inc(model=model, outcome="ok")
+            latency = time.monotonic() - started
+            if stream:
+                return _AsyncLimitedStream(response, limiter, latency, kind)
+            limiter.release("ok", kind=kind)
+            return response
+
+        if attempt + 1 < retries:
+            await asyncio.sleep(_retry_delay(attempt, retries, retry_after, last_exception, cancel_scope, model))
     logger.error(f"LLM API在 {retries} 次尝试后仍然失败。")
+    LLM_CALLS.inc(model=model, outcome="error")
     raise last_exception
 
 
+llm_single_flight = SingleFlight()
+
+
+class _InstrumentedStream:
+    """包装流式响应，在流结束或被关闭时记录耗时、首 token 延迟、输出速率与字节数。"""
+
+    def __init__(self, stream, model: str, started: float):
+        self._stream = stream
+        self._iterator = self._make_iterator(stream)
+        self._model = model
+        self._started = started
+        self._first_token_at = None
+        self._output_bytes = 0
+        self._content_chunks = 0
+        self._completion_tokens = None
+        self._finished = False
+
+    @staticmethod
+    def _make_iterator(stream):
+        return iter(stream)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._iterator)
+        except StopIteration:
+            self._finish()
+            raise
+        return self._observe(chunk)
+
+    def _observe(self, chunk):
+        content = chunk.choices[0].delta.content if chunk.choices else None
+        if content:
+            if self._first_token_at is None:
+                self._first_token_at = time.perf_counter()
+                LLM_TIME_TO_FIRST_TOKEN.observe(self._first_token_at - self._started, model=self._model)
+            self._output_bytes += len(content.encode("utf-8"))
+            self._content_chunks += 1
+        usage = getattr(chunk, "usage", None)
+        if usage is not None and usage.completion_tokens:
+            self._completion_tokens = usage.completion_tokens
+        return chunk
+
+    def _finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        finished_at = time.perf_counter()
+        LLM_CALL_DURATION.observe(finished_at - self._started, model=self._model, call="stream")
+        LLM_OUTPUT_BYTES.observe(self._output_bytes, model=self._model, call="stream")
+        if self._first_token_at is not None and finished_at > self._first_token_at:
+            # 上游没有返回 usage 时以内容块数近似 token 数
+            tokens = self._completion_tokens or self._content_chunks
+            LLM_TOKENS_PER_SECOND.observe(tokens / (finished_at - self._first_token_at), model=self._model, call="stream")
+
+    def close(self):
+        try:
+            close = getattr(self._stream, "close", None)
+            if close:
+                close()
+        finally:
+            self._finish()
+
+
+class _AsyncInstrumentedStream(_InstrumentedStream):
+    """_InstrumentedStream 的异步版本。"""
+
+    @staticmethod
+    def _make_iterator(stream):
+        return stream.__aiter__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await self._iterator.__anext__()
+        except StopAsyncIteration:
+            self._finish()
+            raise
+        return self._observe(chunk)
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            self._finish()
+
+
+class _CancellableStream:
+    """
+    包装流式响应，所属请求被取消（客户端断开或超出截止时间）时关闭上游流，之后的读取抛出 RequestCancelled。
+
+    取消通常发生在其它线程中：流空闲时立即关闭；正在读取时不并发关闭，而是在当前数据块返回后由读取方关闭。
+    """
+
+    def __init__(self, stream, cancel_scope: CancelScope, model: str):
+        self._stream = stream
+        self._iterator = iter(stream)
+        self._cancel_scope = cancel_scope
+        self._model = model
+        self._lock = threading.Lock()
+        self._reading = False
+        self._close_requested = False
+        self._closed = False
+        self._finished = False
+        cancel_scope.add_callback(self._on_cancel)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._cancel_scope.cancelled:
+            self.close()
+            raise self._cancel_scope.error()
+        with self._lock:
+            if self._closed:
+                raise StopIteration
+            self._reading = True
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            self._finished = True
+            self._cancel_scope.remove_callback(self._on_cancel)
+            raise
+        finally:
+            with self._lock:
+                self._reading = False
+                close_requested = self._close_requested
+            if close_requested:
+                self.close()
+
+    def _on_cancel(self):
+        with self._lock:
+            if self._closed:
+                return
+            if self._reading:
+                self._close_requested = True
+                return
+            self._closed = True
+        self._close_upstream()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._close_upstream()
+
+    def _close_upstream(self):
+        self._cancel_scope.remove_callback(self._on_cancel)
+        if self._cancel_scope.reason is not None and not self._finished:
+            logger.info(f"请求已取消，关闭上游流. Model: {self._model}, 原因: {self._cancel_scope.reason}")
+            LLM_STREAMS_CANCELLED.inc(model=self._model, reason=self._cancel_scope.reason)
+        close = getattr(self._stream, "close", None)
+        if close:
+            close()
+
+
+def _call_llm(client: OpenAI, cancel_scope: CancelScope = None, **kwargs):
+    """
+    经过请求合并层调用模型：同一 API Key 下参数完全相同的并发调用共享一次上游调用，
+    temperature 为 0 的确定性调用结果会被缓存。上游调用经过录制/回放层（见 llm_cassette）。
+
+    :param client: OpenAI客户端实例。
+    :param cancel_scope: 所属请求的取消范围。流式响应在请求取消时关闭，重试与超时受请求截止时间约束。
+    :param kwargs: 传递给 client.chat.completions.create 的参数。
+    """
+    key = llm_single_flight.make_key(client.api_key, client.base_url, kwargs)
+    stream = bool(kwargs.get("stream"))
+    model = kwargs.get("model")
+    started = time.perf_counter()
+
+    def call():
+        return llm_single_flight.call(
+            key,
+            lambda: llm_cassette.call(kwargs, lambda: _call_llm_with_retry(client, cancel_scope=cancel_scope, **kwargs)),
+            stream=stream,
+            cacheable=kwargs.get("temperature") == 0,
+        )
+
+    try:
+        response = call()
+    except RequestCancelled:
+        if cancel_scope is not None and cancel_scope.cancelled:
+            raise
+        # 合并到的领头调用属于另一个已取消的请求，由本请求重新发起
+        logger.info("合并的上游调用因其它请求取消而中止，重新发起调用.")
+        response = call()
+    if stream:
+        instrumented = _InstrumentedStream(response, model, started)
+        return _CancellableStream(instrumented, cancel_scope, model) if cancel_scope is not None else instrumented
+
+    _observe_completion(response, model, time.perf_counter() - started)
+    return response
+
+
+def _observe_completion(response, model: str, duration: float):
+    """记录非流式调用的耗时、输出字节数与输出速率。"""
+    content = response.choices[0].message.content or ""
+    LLM_CALL_DURATION.observe(duration, model=model, call="complete")
+    LLM_OUTPUT_BYTES.observe(len(content.encode("utf-8")), model=model, call="complete")
+    usage = getattr(response, "usage", None)
+    if usage is not None and usage.completion_tokens and duration > 0:
+        LLM_TOKENS_PER_SECOND.observe(usage.completion_tokens / duration, model=model, call="complete")
+
+
+class _AsyncCancellableStream:
+    """
+    _CancellableStream 的异步版本。异步流只在事件循环中读取，不存在并发关闭的问题：
+    超出截止时间时在下一次读取前关闭上游流；客户端断开时所在任务被取消，由调用方的 aclose 关闭上游流。
+    """
+
+    def __init__(self, stream, cancel_scope: CancelScope, model: str):
+        self._stream = stream
+        self._cancel_scope = cancel_scope
+        self._model = model
+        self._closed = False
+        self._finished = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._cancel_scope.cancelled:
+            await self.aclose()
+            raise self._cancel_scope.error()
+        if self._closed:
+            raise StopAsyncIteration
+        try:
+            return await self._stream.__anext__()
+        except StopAsyncIteration:
+            self._finished = True
+            raise
+
+    async def aclose(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._cancel_scope.reason is not None and not self._finished:
+            logger.info(f"请求已取消，关闭上游流. Model: {self._model}, 原因: {self._cancel_scope.reason}")
+            LLM_STREAMS_CANCELLED.inc(model=self._model, reason=self._cancel_scope.reason)
+        await self._stream.aclose()
+
+
+async def _acall_llm(client: AsyncOpenAI, cancel_scope: CancelScope = None, **kwargs):
+    """
+    _call_llm 的异步版本。异步路径不经过请求合并层与录制/回放层，直接调用上游（仍受限流与重试约束）。
+
+    :return: 非流式时为响应对象，流式时为异步迭代的数据块流（需要以 aclose 关闭）。
+    """
+    stream = bool(kwargs.get("stream"))
+    model = kwargs.get("model")
+    started = time.perf_counter()
+    response = await _acall_llm_with_retry(client, cancel_scope=cancel_scope, **kwargs)
+    if stream:
+        instrumented = _AsyncInstrumentedStream(response, model, started)
+        return _AsyncCancellableStream(instrumented, cancel_scope, model) if cancel_scope is not None else instrumented
+    _observe_completion(response, model, time.perf_counter() - started)
+    return response
+
+
+def _check_content_safety(client: OpenAI, model: str, user_content: str, trace: Trace = None,
+                          cancel_scope: CancelScope = None):
+    """
+    对用户输入进行内容安全检查，结论写入缓存。不安全时抛出 ValueError。
+    耗时记录为 trace 的 security_check 阶段。
+    """
+    with (trace or Trace("invoke_llm")).span("security_check"):
+        _run_content_safety_check(client, model, user_content, cancel_scope)
+
+
+def _cached_security_verdict(cache_key) -> bool:
+    """查询缓存的安全结论。缓存为不安全时抛出 ValueError，命中缓存时返回 True。"""
+    cached_verdict = security_verdict_cache.get(cache_key)
+    if cached_verdict is None:
+        return False
+    logger.info("内容安全检查命中缓存.")
+    if not cached_verdict:
+        raise ValueError("输入内容被判定为不安全，已拒绝处理。")
+    return True
+
+
+def _security_check_request(model: str, user_content: str) -> dict:
+    """构造安全检查调用的参数。"""
+    # 从 prompt_manager 获取安全检查提示词
+    security_prompt = get_prompt("security_check_prompt")
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": security_prompt},
+            {"role": "user", "content": f"请审查以下内容：\n\n---\n{user_content}\n---"}
+        ],
+        "stream": False,
+        "temperature": 0.7,
+        "max_tokens": 20,
+    }
+
+
+def _record_security_verdict(cache_key, security_response):
+    """根据安全检查的模型返回写入缓存，不安全时抛出 ValueError。"""
+    security_result = security_response.choices[0].message.content.strip().lower()
+    if "unsafe" in security_result:
+        logger.warning(f"内容安全检查失败，模型返回: {security_result}")
+        security_verdict_cache.put(cache_key, False)
+        raise ValueError("输入内容被判定为不安全，已拒绝处理。")
+    logger.info("内容安全检查通过.")
+    security_verdict_cache.put(cache_key, True)
+
+
+def _run_content_safety_check(client: OpenAI, model: str, user_content: str, cancel_scope: CancelScope = None):
+    cache_key = security_verdict_cache.make_key(model, user_content)
+    if _cached_security_verdict(cache_key):
+        return
+
+    try:
+        logger.info("执行内容安全检查.")
+        request = _security_check_request(model, user_content)
+        security_response = _call_llm(client, cancel_scope=cancel_scope, **request)
+        _record_security_verdict(cache_key, security_response)
+
+    except FileNotFoundError:
+        # 如果提示文件不存在，可以选择是抛出异常还是记录警告后继续
+        logger.warning("警告: 未找到 'security_check_prompt.txt'，跳过内容安全检查。")
+    except APIError as e:
+        logger.error(f"内容安全检查过程中调用模型失败: {e}")
+        raise e
+
+
+async def _acheck_content_safety(client: AsyncOpenAI, model: str, user_content: str, trace: Trace = None,
+                                 cancel_scope: CancelScope = None):
+    """_check_content_safety 的异步版本。"""
+    with (trace or Trace("invoke_llm")).span("security_check"):
+        cache_key = security_verdict_cache.make_key(model, user_content)
+        if _cached_security_verdict(cache_key):
+            return
+        try:
+            logger.info("执行内容安全检查.")
+            request = _security_check_request(model, user_content)
+            security_response = await _acall_llm(client, cancel_scope=cancel_scope, **request)
+            _record_security_verdict(cache_key, security_response)
+        except FileNotFoundError:
+            logger.warning("警告: 未找到 'security_check_prompt.txt'，跳过内容安全检查。")
+        except APIError as e:
+            logger.error(f"内容安全检查过程中调用模型失败: {e}")
+            raise e
+
+
+class _GatedStream:
+    """
+    乐观流式：主生成流与安全检查并行进行，在安全结论到达前缓存收到的数据块。
+    结论为安全时依次放行缓存与后续数据块；不安全时关闭上游流并抛出 ValueError。
+
+    读完、出错或被关闭时关闭上游流并取消尚未开始的安全检查；尚未开始读取就被关闭时同样如此。
+    """
+
+    def __init__(self, llm_stream, verdict):
+        self._stream = llm_stream
+        self._iterator = iter(llm_stream)
+        self._verdict = verdict
+        self._buffered = deque()
+        self._released = False
+        self._exhausted = False
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+        try:
+            return self._next_chunk()
+        except BaseException:
+            self.close()
+            raise
+
+    def _next_chunk(self):
+        while not self._released:
+            if self._exhausted:
+                # 上游在安全结论到达前已经结束
+                self._verdict.result()
+                self._released = True
+                break
+            try:
+                chunk = next(self._iterator)
+            except StopIteration:
+                self._exhausted = True
+                continue
+            self._buffered.append(chunk)
+            if self._verdict.done():
+                self._verdict.result()
+                self._released = True
+        if self._buffered:
+            return self._buffered.popleft()
+        if self._exhausted:
+            raise StopIteration
+        return next(self._iterator)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._verdict.cancel()
+        close = getattr(self._stream, "close", None)
+        if close:
+            close()
+
+
+async def _agate_stream(llm_stream, verdict: asyncio.Task):
+    """_GatedStream 的异步版本，verdict 为并行执行安全检查的任务。"""
+    buffered = []
+    released = False
+    try:
+        async for chunk in llm_stream:
+            if not released:
+                if not verdict.done():
+                    buffered.append(chunk)
+                    continue
+                verdict.result()
+                released = True
+                for buffered_chunk in buffered:
+                    yield buffered_chunk
+                buffered = []
+            yield chunk
+        if not released:
+            await verdict
+            for buffered_chunk in buffered:
+                yield buffered_chunk
+    finally:
+        if not verdict.done():
+            verdict.cancel()
+        await llm_stream.aclose()
+
+
+async def _aiter_texts(texts: List[str]):
+    """将本地修复得到的文本以异步迭代的形式返回，与流式调用的返回保持一致。"""
+    for text in texts:
+        yield text
+
+
+def _user_content(messages: List[Dict[str, str]], user_inputs: List[str] = None) -> str:
+    """需要进行安全检查的内容：调用方标记的用户输入，未标记时退回全部消息内容。"""
+    if user_inputs is None:
+        logger.warning("调用方未标记用户输入，安全检查将覆盖全部消息内容。")
+        return "\n".join([msg.get("content", "") for msg in messages])
+    return "\n---\n".join([text for text in user_inputs if text and text.strip()])
+
+
+def _reformat_messages(formatting_prompt: str, first_call_output: str) -> List[Dict[str, str]]:
+    """增强模式本地修复失败时，第二次格式化调用的消息。"""
+    return [
+        {
+            "role": "user",
+            "content": f"你是一个JSON格式化专家。你的任务是将一段可能不完全符合格式的文本，严格修正为连续的、无缝拼接的JSON对象流。\n\n"
+                       f"**极端重要规则**:\n"
+                       f"1. **绝对禁止**在第一个JSON对象之前或最后一个JSON对象之后，输出任何说明性文字、注释或任何非JSON内容。\n"
+                       f"2. 你的输出流必须**只能**是连续的、无缝拼接的JSON对象。例如: {{\"key\": \"value\"}}{{\"key\": \"value\"}}。\n"
+                       f"3. 每个JSON对象都必须严格遵守JSON语法，**严禁**使用悬挂逗号（trailing commas）。\n\n"
+                       f"**JSON对象结构参考**:\n"
+                       f"每个JSON对象都应该像下面这个例子一样，但字段内容需根据'待格式化内容'来填充:\n"
+                       f"```json\n{formatting_prompt}\n```\n\n"
+                       f"**待格式化内容**:\n---\n{first_call_output}\n---\n\n"
+                       f"请立即开始输出格式化后的JSON流。"
+        }
+    ]
+
+
+REFORMAT_MODEL = 'Pro/Qwen/Qwen2.5-7B-Instruct'
+
+
 def invoke_llm(
     api_key: str,
     model: str,
@@ -40,7 +927,12 @@ def invoke_llm(
     temperature: float = 1.0,
     max_tokens: int = 4096,
     enhanced_structured_output: bool = False,
-    formatting_prompt: str = None
+    formatting_prompt: str = None,
+    user_inputs: List[str] = None,
+    optimistic_security_check: bool = False,
+    output_validator: Callable[[Dict], bool] = None,
+    trace: Trace = None,
+    cancel_scope: CancelScope = None,
 ) -> Union[Generator[str, None, None], str]:
     """
     Invokes the SiliconFlow Large Language Model.
@@ -52,66 +944,51 @@ def invoke_llm(
     :param temperature: The sampling temperature.
     :param max_tokens: The maximum number of tokens to generate.
     :param enhanced_structured_output: Whether to enable enhanced structured output.
-    :param formatting_prompt: The formatting prompt for secondary streaming.
+    :param formatting_prompt: The formatting prompt for the remote reformat pass, used only when local repair fails.
+    :param user_inputs: The user-supplied fragments embedded in the messages. Only these are
+                        sent to the safety check; an empty list skips it, None checks all messages.
+    :param optimistic_security_check: Start generating while the safety check is still running and hold
+                                      the output back until the verdict arrives.
+    :param output_validator: In enhanced mode, checks that each locally repaired JSON object has the expected schema.
+    :param trace: The caller's request trace. Stages (safety check, enhanced-mode calls, local repair) are recorded on it.
+    :param cancel_scope: The caller's request cancellation scope. Upstream streams are closed when the request is
+                         cancelled, and retries and timeouts are bounded by the request deadline.
     :return: A generator if stream is True, otherwise a string with the full response.
     """
     if not api_key:
         raise ValueError("API Key 不能为空")
 
-    client = OpenAI(
-        api_key=api_key,
-        base_url=os.environ.get("SILICONFLOW_API_BASE", "https://api.siliconflow.cn/v1"),
+    client = client_registry.get(
+        api_key,
+        os.environ.get("SILICONFLOW_API_BASE", "https://api.siliconflow.cn/v1"),
     )
 
-    # 提取用户输入内容进行安全检查
-    user_content = "\n".join([msg.get("content", "") for msg in messages])
+    # 只对调用方显式标记的用户输入进行安全检查；未标记时退回检查全部消息内容
+    user_content = _user_content(messages, user_inputs)
 
+    trace = trace or Trace("invoke_llm")
+    verdict = None
     if user_content.strip():
-        try:
-            # 从 prompt_manager 获取安全检查提示词
-            logger.info("执行内容安全检查.")
-            security_prompt = get_prompt("security_check_prompt")
-            security_check_messages = [
-                {"role": "system", "content": security_prompt},
-                {"role": "user", "content": f"请审查以下内容：\n\n---\n{user_content}\n---"}
-            ]
-
-            security_response = _call_llm_with_retry(
-                client,
-                model=model,
-                messages=security_check_messages,
-                stream=False,
-                temperature=0.7,
-                max_tokens=20,
-            )
-            security_result = security_response.choices[0].message.content.strip().lower()
-
-            if "unsafe" in security_result:
-                logger.warning(f"内容安全检查失败，模型返回: {security_result}")
-                raise ValueError("输入内容被判定为不安全，已拒绝处理。")
-            else:
-                logger.info("内容安全检查通过.")
-
-        except FileNotFoundError:
-            # 如果提示文件不存在，可以选择是抛出异常还是记录警告后继续
-            logger.warning("警告: 未找到 'security_check_prompt.txt'，跳过内容安全检查。")
-        except APIError as e:
-            logger.error(f"内容安全检查过程中调用模型失败: {e}")
-            raise e
+        if optimistic_security_check:
+            verdict = _security_executor.submit(_check_content_safety, client, model, user_content, trace, cancel_scope)
+        else:
+            _check_content_safety(client, model, user_content, trace, cancel_scope)
 
     # 如果启用了增强结构化输出
     if enhanced_structured_output and formatting_prompt:
         # 1. 第一次调用，非流式，获取完整输出
         logger.info(f"开始增强模式第一次LLM调用. Model: {model}, Temp: {temperature}")
         try:
-            initial_response = _call_llm_with_retry(
-                client,
-                model=model,
-                messages=messages,
-                stream=False, # 强制非流式
-                temperature=temperature,
-                max_tokens=max_tokens,
-            )
+            with trace.span("enhanced_first_call", model=model):
+                initial_response = _call_llm(
+                    client,
+                    cancel_scope=cancel_scope,
+                    model=model,
+                    messages=messages,
+                    stream=False, # 强制非流式
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                )
             first_call_output = initial_response.choices[0].message.content
             logger.info(f"增强模式第一次LLM调用成功. Output length: {len(first_call_output)}")
         except APIError as e:
@@ -119,44 +996,158 @@ def invoke_llm(
             logger.error(f"增强模式下，第一次调用模型失败: {e}")
             raise e
 
-        # 2. 第二次调用，使用格式化提示词，流式返回
-        reformat_messages = [
-            {
-                "role": "user",
-                "content": f"你是一个JSON格式化专家。你的任务是将一段可能不完全符合格式的文本，严格修正为连续的、无缝拼接的JSON对象流。\n\n"
-                           f"**极端重要规则**:\n"
-                           f"1. **绝对禁止**在第一个JSON对象之前或最后一个JSON对象之后，输出任何说明性文字、注释或任何非JSON内容。\n"
-                           f"2. 你的输出流必须**只能**是连续的、无缝拼接的JSON对象。例如: {{\"key\": \"value\"}}{{\"key\": \"value\"}}。\n"
-                           f"3. 每个JSON对象都必须严格遵守JSON语法，**严禁**使用悬挂逗号（trailing commas）。\n\n"
-                           f"**JSON对象结构参考**:\n"
-                           f"每个JSON对象都应该像下面这个例子一样，但字段内容需根据'待格式化内容'来填充:\n"
-                           f"```json\n{formatting_prompt}\n```\n\n"
-                           f"**待格式化内容**:\n---\n{first_call_output}\n---\n\n"
-                           f"请立即开始输出格式化后的JSON流。"
-            }
-        ]
-        
+        if verdict is not None:
+            verdict.result()
+
+        # 2. 先在本地修复并校验JSON，成功时无需第二次模型调用
+        with trace.span("json_repair"):
+            repaired_objects = repair_json_objects(first_call_output, output_validator)
+        if repaired_objects is not None:
+            logger.info(f"增强模式本地JSON修复成功，共 {len(repaired_objects)} 个对象，跳过格式化调用.")
+            repaired_texts = [json.dumps(obj, ensure_ascii=False) for obj in repaired_objects]
+            return iter(repaired_texts) if stream else "".join(repaired_texts)
+
+        # 3. 本地修复失败时，退回使用格式化提示词的第二次调用，流式返回
+        logger.warning("增强模式本地JSON修复失败，回退到模型格式化调用.")
+        reformat_messages = _reformat_messages(formatting_prompt, first_call_output)
+
         # 返回第二次调用的流
         logger.info("开始增强模式第二次LLM调用 (流式格式化).")
-        return _call_llm_with_retry(
-            client,
-            model='Pro/Qwen/Qwen2.5-7B-Instruct',
-            messages=reformat_messages,
-            stream=stream,
-            temperature=0.0,
-            max_tokens=max_tokens,
-        )
+        # 流式调用只统计到收到响应头为止，输出阶段的耗时记录在模型调用的直方图中
+        with trace.span("enhanced_reformat_call", model=REFORMAT_MODEL):
+            return _call_llm(
+                client,
+                cancel_scope=cancel_scope,
+                model=REFORMAT_MODEL,
+                messages=reformat_messages,
+                stream=stream,
+                temperature=0.0,
+                max_tokens=max_tokens,
+            )
 
     # 原始逻辑：如果未启用增强模式
     logger.info(f"开始标准LLM调用. Model: {model}, Stream: {stream}, Temp: {temperature}")
-    return _call_llm_with_retry(
+    response = _call_llm(
         client,
+        cancel_scope=cancel_scope,
         model=model,
         messages=messages,
         stream=stream,
         temperature=temperature,
         max_tokens=max_tokens,
     )
+    if verdict is None:
+        return response
+    if stream:
+        return _GatedStream(response, verdict)
+    verdict.result()
+    return response
+
+
+async def ainvoke_llm(
+    api_key: str,
+    model: str,
+    messages: List[Dict[str, str]],
+    stream: bool = False,
+    temperature: float = 1.0,
+    max_tokens: int = 4096,
+    enhanced_structured_output: bool = False,
+    formatting_prompt: str = None,
+    user_inputs: List[str] = None,
+    optimistic_security_check: bool = False,
+    output_validator: Callable[[Dict], bool] = None,
+    trace: Trace = None,
+    cancel_scope: CancelScope = None,
+):
+    """
+    Async version of invoke_llm for the ASGI serving mode. Parameters are the same.
+
+    Upstream calls go through a shared AsyncOpenAI client, so a single event loop can hold hundreds of
+    concurrent streams. Single-flight coalescing and cassette record/replay apply only to the sync path.
+
+    :return: An async iterator if stream is True (close it with aclose), otherwise a string with the full response.
+    """
+    if not api_key:
+        raise ValueError("API Key 不能为空")
+
+    client = async_client_registry.get(
+        api_key,
+        os.environ.get("SILICONFLOW_API_BASE", "https://api.siliconflow.cn/v1"),
+    )
+    user_content = _user_content(messages, user_inputs)
+
+    trace = trace or Trace("invoke_llm")
+    verdict = None
+    if user_content.strip():
+        check = _acheck_content_safety(client, model, user_content, trace, cancel_scope)
+        if optimistic_security_check:
+            verdict = asyncio.ensure_future(check)
+        else:
+            await check
+
+    try:
+        if enhanced_structured_output and formatting_prompt:
+            logger.info(f"开始增强模式第一次LLM调用. Model: {model}, Temp: {temperature}")
+            try:
+                with trace.span("enhanced_first_call", model=model):
+                    initial_response = await _acall_llm(
+                        client,
+                        cancel_scope=cancel_scope,
+                        model=model,
+                        messages=messages,
+                        stream=False,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                    )
+                first_call_output = initial_response.choices[0].message.content
+                logger.info(f"增强模式第一次LLM调用成功. Output length: {len(first_call_output)}")
+            except APIError as e:
+                logger.error(f"增强模式下，第一次调用模型失败: {e}")
+                raise e
+
+            if verdict is not None:
+                await verdict
+
+            with trace.span("json_repair"):
+                repaired_objects = repair_json_objects(first_call_output, output_validator)
+            if repaired_objects is not None:
+                logger.info(f"增强模式本地JSON修复成功，共 {len(repaired_objects)} 个对象，跳过格式化调用.")
+                repaired_texts = [json.dumps(obj, ensure_ascii=False) for obj in repaired_objects]
+                return _aiter_texts(repaired_texts) if stream else "".join(repaired_texts)
+
+            logger.warning("增强模式本地JSON修复失败，回退到模型格式化调用.")
+            logger.info("开始增强模式第二次LLM调用 (流式格式化).")
+            with trace.span("enhanced_reformat_call", model=REFORMAT_MODEL):
+                return await _acall_llm(
+                    client,
+                    cancel_scope=cancel_scope,
+                    model=REFORMAT_MODEL,
+                    messages=_reformat_messages(formatting_prompt, first_call_output),
+                    stream=stream,
+                    temperature=0.0,
+                    max_tokens=max_tokens,
+                )
+
+        logger.info(f"开始标准LLM调用. Model: {model}, Stream: {stream}, Temp: {temperature}")
+        response = await _acall_llm(
+            client,
+            cancel_scope=cancel_scope,
+            model=model,
+            messages=messages,
+            stream=stream,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+    except BaseException:
+        if verdict is not None and not verdict.done():
+            verdict.cancel()
+        raise
+    if verdict is None:
+        return response
+    if stream:
+        return _agate_stream(response, verdict)
+    await verdict
+    return response
 
 
 if __name__ == "__main__":
@@ -0,0 +1,249 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_SIZE = 256
+RESPONSE_CACHE_TTL = 600
+
+
+class ResponseCache:
+    """确定性（temperature 为 0）响应的 LRU/TTL 缓存。流式响应以数据块列表的形式保存。"""
+
+    def __init__(self, max_size: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class _Flight:
+    """一次正在进行的上游调用。流式调用的数据块保存在 chunks 中，供所有订阅者按各自的进度读取。"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.ready = False
+        self.response = None
+        self.error = None
+        self.iterator = None
+        self.chunks = []
+        self.done = False
+        self.stream_error = None
+        self.reading = False
+        self.subscribers = 0
+
+
+_END = object()
+
+
+class _Subscription:
+    """
+    一个订阅者对共享上游流的读取进度。
+
+    在读完、出错或被关闭时退订；与生成器不同，尚未开始读取就被关闭的订阅同样会退订，
+    否则共享的上游流将永远等待这个订阅者。
+    """
+
+    def __init__(self, single_flight, key, flight, cacheable):
+        self._single_flight = single_flight
+        self._key = key
+        self._flight = flight
+        self._cacheable = cacheable
+        self._index = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+        try:
+            chunk = self._single_flight._next_chunk(self._key, self._flight, self._index, self._cacheable)
+        except BaseException:
+            self.close()
+            raise
+        if chunk is _END:
+            self.close()
+            raise StopIteration
+        self._index += 1
+        return chunk
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._single_flight._unsubscribe(self._key, self._flight)
+
+    def __del__(self):
+        self.close()
+
+
+class SingleFlight:
+    """
+    请求合并层：键相同的并发调用只向上游发起一次。
+
+    非流式调用的跟随者等待领头调用的结果；流式调用的所有订阅者共享同一个上游流，
+    由需要下一个数据块的订阅者负责从上游读取（不额外占用线程），其他订阅者从缓冲中回放，
+    因此中途加入的订阅者也能收到完整输出。所有订阅者都退出时关闭上游流。
+    可缓存的调用成功完成后写入 ResponseCache，之后的相同调用直接回放。
+    """
+
+    def __init__(self, cache: ResponseCache = None):
+        self.cache = cache or ResponseCache()
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._metrics = {"upstream_calls": 0, "coalesced": 0, "cache_hits": 0, "aborted_streams": 0}
+
+    @staticmethod
+    def make_key(api_key: str, base_url, request: dict) -> str:
+        """由 API Key 的哈希、接口地址与规范化的请求参数生成键。不同 API Key 的请求从不共享结果。"""
+        payload = json.dumps({
+            "api_key": hashlib.sha256((api_key or "").encode("utf-8")).hexdigest(),
+            "base_url": str(base_url),
+            "request": request,
+        }, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def call(self, key: str, fn, stream: bool = False, cacheable: bool = False):
+        """
+        :param key: make_key() 生成的键。
+        :param fn: 实际发起上游调用的无参函数，流式时返回可迭代的数据块流。
+        :param stream: 是否为流式调用。
+        :param cacheable: 结果是否确定，可以写入响应缓存。
+        :return: 非流式时为响应对象，流式时为数据块迭代器（可提前 close()）。
+        """
+        if cacheable:
+            cached = self.cache.get(key)
+            if cached is not None:
+                with self._lock:
+                    self._metrics["cache_hits"] += 1
+                return iter(cached) if stream else cached
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+                self._metrics["upstream_calls"] += 1
+            else:
+                self._metrics["coalesced"] += 1
+            flight.subscribers += 1
+
+        if leader:
+            try:
+                flight.response = fn()
+                if stream:
+                    flight.iterator = iter(flight.response)
+            except Exception as e:
+                flight.error = e
+            with flight.condition:
+                flight.ready = True
+                flight.condition.notify_all()
+            if flight.error is not None or not stream:
+                self._remove(key, flight)
+                if flight.error is None and cacheable:
+                    self.cache.put(key, flight.response)
+        else:
+            with flight.condition:
+                flight.condition.wait_for(lambda: flight.ready)
+
+        if flight.error is not None or not stream:
+            self._unsubscribe(key, flight)
+            if flight.error is not None:
+                raise flight.error
+            return flight.response
+        return self._subscribe(key, flight, cacheable)
+
+    def _remove(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def _unsubscribe(self, key, flight):
+        with self._lock:
+            flight.subscribers -= 1
+            abandoned = flight.subscribers == 0 and flight.iterator is not None and not flight.done
+            if abandoned and self._flights.get(key) is flight:
+                del self._flights[key]
+            if abandoned:
+                self._metrics["aborted_streams"] += 1
+        if abandoned:
+            logger.info("共享的上游流已没有订阅者，关闭上游流.")
+            close = getattr(flight.response, "close", None)
+            if close:
+                close()
+
+    def _subscribe(self, key, flight, cacheable):
+        return _Subscription(self, key, flight, cacheable)
+
+    def _next_chunk(self, key, flight, index, cacheable):
+        """返回第 index 个数据块，缓冲中没有时由当前订阅者从上游读取；流结束时返回 _END。"""
+        while True:
+            with flight.condition:
+                flight.condition.wait_for(lambda: index < len(flight.chunks) or flight.done or not flight.reading)
+                if index < len(flight.chunks):
+                    return flight.chunks[index]
+                if flight.done:
+                    if flight.stream_error is not None:
+                        raise flight.stream_error
+                    return _END
+                flight.reading = True
+
+            # 由当前订阅者在锁外读取上游的下一个数据块
+            finished = False
+            try:
+                next_chunk = next(flight.iterator)
+            except StopIteration:
+                finished = True
+            except Exception as e:
+                flight.stream_error = e
+                finished = True
+            with flight.condition:
+                if finished:
+                    flight.done = True
+                else:
+                    flight.chunks.append(next_chunk)
+                flight.reading = False
+                flight.condition.notify_all()
+            if finished:
+                self._remove(key, flight)
+                if flight.stream_error is None and cacheable:
+                    self.cache.put(key, list(flight.chunks))
+
+    def metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["in_flight"] = len(self._flights)
+        metrics["cached_responses"] = len(self.cache)
+        return metrics
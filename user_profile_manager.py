@@ -1,42 +1,19 @@
 import json
-import os
 import siliconflow_client
 import prompt_manager
+from config_store import config_store
+from llm_json_parser import stream_json_with_events
 import logging
 
 logger = logging.getLogger(__name__)
 
-CONFIG_FILE = "config.json"
-
 def load_config():
-    """安全地加载配置，确保所有必需的键都存在，防止因文件不完整而出错。"""
-    default_profile = "该用户暂无画像，请根据本次答题情况生成一份初始画像。"
-    defaults = {
-        "temperature": 1.0,
-        "enhanced_structured_output": False,
-        "user_profile": default_profile
-    }
-
-    if not os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(defaults, f, indent=4, ensure_ascii=False)
-        return defaults
-
-    try:
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            # 先加载默认值，再用文件中的设置覆盖，确保配置完整
-            config = defaults.copy()
-            loaded_config = json.load(f)
-            config.update(loaded_config)
-            return config
-    except (json.JSONDecodeError, FileNotFoundError):
-        # 如果文件损坏或不存在，返回一份完整的默认配置
-        return defaults
+    """从共享配置服务读取配置快照，所有必需的键都已由默认值补齐。"""
+    return config_store.get()
 
 def save_config(config_data):
     """保存配置文件"""
-    with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(config_data, f, indent=4, ensure_ascii=False)
+    config_store.replace(config_data)
 
 def get_user_profile():
     """获取当前用户画像。"""
@@ -49,9 +26,7 @@ def set_user_profile(profile_text: str):
     """
     直接设置或手动修改用户画像。
     """
-    config = load_config()
-    config["user_profile"] = profile_text
-    save_config(config)
+    config_store.update({"user_profile": profile_text})
     logger.info(f"用户画像已保存. 新长度: {len(profile_text)}")
 
 def update_user_profile(grading_summary: str, api_key: str):
@@ -84,7 +59,8 @@ def update_user_profile(grading_summary: str, api_key: str):
             messages=messages,
             stream=False,
             temperature=0.5, # 使用较低的温度以获得更一致的画像分析
-            enhanced_structured_output=False
+            enhanced_structured_output=False,
+            user_inputs=[current_profile],
         )
         
         # 假设客户端返回与OpenAI客户端兼容的对象
@@ -102,4 +78,84 @@ def update_user_profile(grading_summary: str, api_key: str):
 
     except Exception as e:
         logger.error(f"调用LLM更新用户画像时出错: {e}")
-        return None 
\ No newline at end of file
+        return None
+
+
+def apply_profile_delta(current_profile: str, delta: dict) -> str:
+    """
+    将结构化的画像修改（replace / remove / append）应用到当前画像上。
+    找不到原文的 replace 会把新句子追加到末尾，找不到原文的 remove 会被忽略。
+    """
+    profile = current_profile or ""
+    appended = []
+    for item in delta.get("replace", []) or []:
+        old, new = str(item.get("old", "")), str(item.get("new", ""))
+        if old and old in profile:
+            profile = profile.replace(old, new, 1)
+        elif new:
+            appended.append(new)
+    for sentence in delta.get("remove", []) or []:
+        sentence = str(sentence)
+        if sentence:
+            profile = profile.replace(sentence, "", 1)
+    appended.extend(str(sentence) for sentence in delta.get("append", []) or [] if sentence)
+    if appended:
+        profile = "".join([profile.rstrip(), *appended]) if profile.strip() else "".join(appended)
+    return profile.strip()
+
+def update_user_profile_one_pass(questions, user_answers, api_key: str, structured_delta: bool = False):
+    """
+    根据答题记录和当前画像，用一次LLM调用直接得到新的用户画像，省去单独生成答题总结的一轮调用。
+
+    Args:
+        questions (list): 试卷题目（包含标准答案）。
+        user_answers (list): 学生提交的答案。
+        api_key (str): 用于调用LLM的API Key。
+        structured_delta (bool): 让模型输出结构化的画像修改，而不是完整的新画像。
+
+    Returns:
+        str: 更新后的用户画像文本，如果更新失败则返回None。
+    """
+    current_profile = get_user_profile()
+    logger.info(f"开始使用LLM单次更新用户画像. 结构化修改: {structured_delta}")
+
+    update_prompt = prompt_manager.get_prompt(
+        "update_user_profile_one_pass_prompt",
+        current_profile=current_profile,
+        questions_with_answers=json.dumps(questions, ensure_ascii=False, indent=2),
+        user_answers=json.dumps(user_answers, ensure_ascii=False, indent=2),
+        structured_delta=structured_delta,
+    )
+
+    try:
+        response = siliconflow_client.invoke_llm(
+            api_key=api_key,
+            model="Qwen/Qwen2.5-72B-Instruct",
+            messages=[{"role": "user", "content": update_prompt}],
+            stream=False,
+            temperature=0.5,
+            enhanced_structured_output=False,
+            user_inputs=[current_profile, json.dumps(user_answers, ensure_ascii=False)],
+        )
+        content = response.choices[0].message.content.strip()
+
+        if structured_delta:
+            deltas = [event["data"] for event in stream_json_with_events(iter([content])) if event["type"] == "end"]
+            if not deltas:
+                logger.warning(f"LLM返回的画像修改无法解析，更新操作已跳过: {content[:100]}")
+                return None
+            updated_profile = apply_profile_delta(current_profile, deltas[0])
+        else:
+            updated_profile = content
+
+        if not updated_profile:
+            logger.warning("LLM返回了空的用户画像，更新操作已跳过。")
+            return None
+
+        set_user_profile(updated_profile)
+        logger.info(f"LLM单次更新用户画像成功. 新长度: {len(updated_profile)}")
+        return updated_profile
+
+    except Exception as e:
+        logger.error(f"调用LLM单次更新用户画像时出错: {e}")
+        return None
@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from question_bank import DATA_DIR, normalize_question
+from question_types import question_fingerprint
+
+logger = logging.getLogger(__name__)
+
+NOTEBOOK_PATH = os.path.join(DATA_DIR, "wrong_answers.sqlite3")
+SECONDS_PER_DAY = 86400
+INITIAL_EASINESS = 2.5
+MIN_EASINESS = 1.3
+# SM-2 中回答质量不低于该值视为"记住了"
+PASSING_QUALITY = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS review_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    fingerprint TEXT NOT NULL UNIQUE,
+    topic TEXT NOT NULL,
+    source_key TEXT NOT NULL DEFAULT '',
+    question TEXT NOT NULL,
+    user_answer TEXT NOT NULL,
+    score REAL NOT NULL,
+    full_score REAL NOT NULL,
+    feedback TEXT NOT NULL DEFAULT '',
+    repetitions INTEGER NOT NULL DEFAULT 0,
+    interval_days REAL NOT NULL DEFAULT 0,
+    easiness REAL NOT NULL DEFAULT 2.5,
+    lapses INTEGER NOT NULL DEFAULT 0,
+    review_count INTEGER NOT NULL DEFAULT 0,
+    due_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    last_reviewed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_review_items_due ON review_items (due_at);
+CREATE INDEX IF NOT EXISTS idx_review_items_topic_due ON review_items (topic, due_at);
+CREATE INDEX IF NOT EXISTS idx_review_items_source_due ON review_items (source_key, due_at);
+"""
+
+
+def answer_quality(score, full_score) -> int:
+    """把得分率映射为 SM-2 的回答质量 0-5。"""
+    if not full_score:
+        return 0
+    return max(0, min(5, round(5 * float(score) / float(full_score))))
+
+
+def sm2_schedule(quality: int, repetitions: int, interval_days: float, easiness: float):
+    """
+    SM-2 调度：根据本次回答质量计算新的 (repetitions, interval_days, easiness)。
+    质量低于 PASSING_QUALITY 时重新开始计数，次日复习。
+    """
+    if quality >= PASSING_QUALITY:
+        if repetitions == 0:
+            interval_days = 1
+        elif repetitions == 1:
+            interval_days = 6
+        else:
+            interval_days = round(interval_days * easiness, 1)
+        repetitions += 1
+    else:
+        repetitions = 0
+        interval_days = 1
+    easiness = max(MIN_EASINESS, easiness + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+    return repetitions, interval_days, easiness
+
+
+class WrongAnswerNotebook:
+    """
+    错题本：基于 SQLite 保存批改过的错题，并按 SM-2 间隔重复算法安排复习。
+
+    首次答错（未得满分）的题目立即到期；之后每次批改都按得分率更新复习间隔。
+    到期查询走 due_at 上的索引，只读取需要的行。
+    """
+
+    def __init__(self, path: str = NOTEBOOK_PATH):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def record_results(self, questions, user_answers, results, source_key: str = "", now: float = None) -> dict:
+        """
+        记录一次批改的结果。
+
+        已在错题本中的题目按本次得分更新复习计划；不在错题本中且未得满分的题目被加入错题本。
+
+        :param questions: 试卷题目列表。
+        :param user_answers: 学生答案列表。
+        :param results: {题目索引: {"score": ..., "feedback": ...}}，只包含批改成功的题目。
+        :param source_key: 题目所属参考资料的来源键。
+        :return: {"added": 新增错题数, "reviewed": 更新复习计划的题目数}
+        """
+        now = time.time() if now is None else now
+        added = reviewed = 0
+        with self._connect() as conn:
+            for index, result in results.items():
+                question = normalize_question(questions[index]) if 0 <= index < len(questions) else None
+                if question is None:
+                    continue
+                fingerprint = question_fingerprint(question)
+                full_score = question.get("score") or 0
+                try:
+                    score = float(result.get("score", 0))
+                except (TypeError, ValueError):
+                    continue
+                quality = answer_quality(score, full_score)
+                user_answer = json.dumps(user_answers[index] if index < len(user_answers) else None, ensure_ascii=False)
+                feedback = str(result.get("feedback", ""))
+
+                row = conn.execute(
+                    "SELECT id, repetitions, interval_days, easiness, lapses FROM review_items WHERE fingerprint = ?",
+                    (fingerprint,),
+                ).fetchone()
+                if row is not None:
+                    repetitions, interval_days, easiness = sm2_schedule(
+                        quality, row["repetitions"], row["interval_days"], row["easiness"]
+                    )
+                    conn.execute(
+                        "UPDATE review_items SET user_answer = ?, score = ?, full_score = ?, feedback = ?, "
+                        "repetitions = ?, interval_days = ?, easiness = ?, lapses = ?, review_count = review_count + 1, "
+                        "due_at = ?, last_reviewed_at = ? WHERE id = ?",
+                        (user_answer, score, full_score, feedback, repetitions, interval_days, easiness,
+                         row["lapses"] + (quality < PASSING_QUALITY), now + interval_days * SECONDS_PER_DAY, now, row["id"]),
+                    )
+                    reviewed += 1
+                elif score < full_score:
+                    conn.execute(
+                        "INSERT INTO review_items (fingerprint, topic, source_key, question, user_answer, score, "
+                        "full_score, feedback, easiness, due_at, created_at, last_reviewed_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (fingerprint, str(questions[index].get("topic") or question["question_type"]), source_key,
+                         json.dumps(question, ensure_ascii=False), user_answer, score, full_score, feedback,
+                         INITIAL_EASINESS, now, now, now),
+                    )
+                    added += 1
+        if added or reviewed:
+            logger.info(f"错题本已更新. 新增: {added}, 更新复习计划: {reviewed}")
+        return {"added": added, "reviewed": reviewed}
+
+    def due_items(self, limit: int = 10, topic: str = None, source_key: str = None, now: float = None) -> list:
+        """
+        查询已到期的错题，最早到期的排在前面。
+
+        :return: 字典列表，包含 question、user_answer、score、feedback 与复习计划字段。
+        """
+        now = time.time() if now is None else now
+        query = "SELECT * FROM review_items WHERE due_at <= ?"
+        params = [now]
+        if topic:
+            query += " AND topic = ?"
+            params.append(topic)
+        if source_key:
+            query += " AND source_key = ?"
+            params.append(source_key)
+        query += " ORDER BY due_at LIMIT ?"
+        params.append(limit)
+        return [self._row_to_item(row) for row in self._connect().execute(query, params)]
+
+    def stats(self, now: float = None) -> dict:
+        now = time.time() if now is None else now
+        row = self._connect().execute(
+            "SELECT COUNT(*) AS total, COALESCE(SUM(due_at <= ?), 0) AS due FROM review_items", (now,)
+        ).fetchone()
+        return {"total": row["total"], "due": row["due"]}
+
+    @staticmethod
+    def _row_to_item(row) -> dict:
+        return {
+            "id": row["id"],
+            "topic": row["topic"],
+            "source_key": row["source_key"],
+            "question": json.loads(row["question"]),
+            "user_answer": json.loads(row["user_answer"]),
+            "score": row["score"],
+            "full_score": row["full_score"],
+            "feedback": row["feedback"],
+            "repetitions": row["repetitions"],
+            "interval_days": row["interval_days"],
+            "easiness": row["easiness"],
+            "lapses": row["lapses"],
+            "due_at": row["due_at"],
+        }
+
+
+wrong_answer_notebook = WrongAnswerNotebook()